@@ -0,0 +1,243 @@
+"""Локальные заглушки Telegram Bot API, OpenAI и ЮKassa для нагрузочного теста.
+
+Один HTTP-сервер на случайном порту, сервисы различаются префиксом пути:
+    /telegram/bot<token>/<method>, /telegram/file/bot<token>/<path>
+    /openai/v1/chat/completions (обычный и потоковый ответ)
+    /openai/v1/embeddings (детерминированные векторы: хеширование слов)
+    /yookassa/v3/payments
+Задержка каждого сервиса настраивается; все вызовы пишутся в журнал
+(время, сервис, метод, chat_id) — по нему считается время до первого ответа.
+"""
+import hashlib
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image, ImageDraw
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+REPLY_WORDS = ("Конечно", ", вот", " ответ", " на", " ваш", " запрос", ".")
+
+
+def sample_png():
+    image = Image.new("L", (1200, 400), 255)
+    draw = ImageDraw.Draw(image)
+    for row in range(6):
+        draw.text((40, 40 + row * 55), "Invoice 2025-%02d total 1 234,56 RUB" % row, fill=0)
+    out = BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+def sample_pdf(pages=3):
+    # С текстовым слоем: распознаётся через PyMuPDF, без Tesseract
+    out = BytesIO()
+    pdf = canvas.Canvas(out, pagesize=A4)
+    for page in range(pages):
+        for row in range(40):
+            pdf.drawString(40, 800 - row * 18, f"Page {page + 1}, line {row + 1}: contract terms and conditions")
+        pdf.showPage()
+    pdf.save()
+    return out.getvalue()
+
+
+def fake_embedding(text, dim=1536):
+    # Хеширование слов в dim измерений: одинаковые слова — похожие векторы
+    vector = [0.0] * dim
+    for word in text.lower().split():
+        value = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+        vector[value % dim] += 1.0 if value >> 63 else -1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+class FakeServices:
+    def __init__(self, telegram_latency=0.05, openai_latency=1.0, openai_chunk_delay=0.05, yookassa_latency=0.3,
+                 host="127.0.0.1", port=0):
+        self.latency = {"telegram": telegram_latency, "openai": openai_latency, "yookassa": yookassa_latency}
+        self.openai_chunk_delay = openai_chunk_delay
+        self.files = {"png": sample_png(), "pdf": sample_pdf()}
+        self.calls = []             # (время, сервис, метод, chat_id)
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fakes", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def record(self, service, method, chat_id=None):
+        with self._lock:
+            self.calls.append((time.monotonic(), service, method, str(chat_id) if chat_id is not None else None))
+
+    def last_call(self):
+        with self._lock:
+            return self.calls[-1][0] if self.calls else None
+
+    def counts(self):
+        result = {}
+        with self._lock:
+            for _, service, method, _ in self.calls:
+                key = f"{service}.{method}"
+                result[key] = result.get(key, 0) + 1
+        return result
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    # --- Ответы сервисов ---
+    def telegram(self, method, params):
+        chat_id = params.get("chat_id")
+        self.record("telegram", method, chat_id)
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            message = {
+                "message_id": int(params.get("message_id") or self.next_message_id()),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"},
+                "text": params.get("text", ""),
+            }
+            if method == "sendDocument":
+                message["document"] = {"file_id": f"doc-{uuid.uuid4().hex}", "file_unique_id": uuid.uuid4().hex[:16]}
+            return message
+        if method == "getFile":
+            file_id = params["file_id"]
+            ext = "pdf" if file_id.endswith(".pdf") else "png"
+            return {"file_id": file_id, "file_unique_id": file_id, "file_path": f"files/{file_id}.{ext}"}
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        return True
+
+    def openai_reply(self, model, stream):
+        self.record("openai", "stream" if stream else "completion")
+        if not stream:
+            return {
+                "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(REPLY_WORDS)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 120, "completion_tokens": 12, "total_tokens": 132},
+            }
+        chunks = []
+        for word in REPLY_WORDS:
+            chunks.append({"id": "chatcmpl-stream", "object": "chat.completion.chunk", "created": int(time.time()),
+                           "model": model, "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]})
+        return chunks
+
+    def openai_embeddings(self, model, inputs):
+        self.record("openai", "embeddings")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        return {"object": "list", "model": model,
+                "data": [{"object": "embedding", "index": idx, "embedding": fake_embedding(text)}
+                         for idx, text in enumerate(inputs)],
+                "usage": {"prompt_tokens": 8 * len(inputs), "total_tokens": 8 * len(inputs)}}
+
+    def yookassa_payment(self, body):
+        self.record("yookassa", "payments", (body.get("metadata") or {}).get("chat_id"))
+        payment_id = str(uuid.uuid4())
+        return {
+            "id": payment_id, "status": "pending", "paid": False,
+            "amount": body.get("amount"), "description": body.get("description"),
+            "metadata": body.get("metadata") or {},
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.example/checkout/{payment_id}"},
+            "recipient": {"account_id": "1", "gateway_id": "1"}, "test": True, "refundable": False,
+        }
+
+    def _handler_class(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, fmt, *args):
+                pass
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _json(self, payload, status=200):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _raw(self, data, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._route(b"")
+
+            def do_POST(self):
+                self._route(self._body())
+
+            def _route(self, body):
+                url = urlparse(self.path)
+                parts = url.path.strip("/").split("/")
+                service = parts[0]
+                time.sleep(services.latency.get(service, 0))
+                if service == "telegram" and parts[1] == "file":
+                    ext = parts[-1].rsplit(".", 1)[-1]
+                    services.record("telegram", "download")
+                    return self._raw(services.files["pdf" if ext == "pdf" else "png"], "application/octet-stream")
+                if service == "telegram":
+                    # telebot передаёт параметры в query string; файлы — multipart в теле
+                    params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                    if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                        params.update({k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()})
+                    return self._json({"ok": True, "result": services.telegram(parts[-1], params)})
+                if service == "openai" and url.path.endswith("/chat/completions"):
+                    request = json.loads(body or b"{}")
+                    reply = services.openai_reply(request.get("model"), request.get("stream"))
+                    if not request.get("stream"):
+                        return self._json(reply)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.end_headers()
+                    try:
+                        for chunk in reply + ["[DONE]"]:
+                            line = chunk if chunk == "[DONE]" else json.dumps(chunk, ensure_ascii=False)
+                            self._chunk(f"data: {line}\n\n".encode("utf-8"))
+                            time.sleep(services.openai_chunk_delay)
+                        self._chunk(b"")
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass  # клиент оборвал поток (таймаут и переход на запасную модель)
+                    return None
+                if service == "openai" and url.path.endswith("/embeddings"):
+                    request = json.loads(body or b"{}")
+                    return self._json(services.openai_embeddings(request.get("model"), request.get("input")))
+                if service == "yookassa" and url.path.endswith("/payments"):
+                    return self._json(services.yookassa_payment(json.loads(body or b"{}")))
+                return self._json({"ok": False, "description": f"unknown path {url.path}"}, status=404)
+
+            def _chunk(self, data):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+        return Handler
@@ -0,0 +1,342 @@
+"""Нагрузочный тест /webhook на локальных заглушках Telegram, OpenAI и ЮKassa.
+
+Бот запускается отдельным процессом (python bot_main.py) во временной папке,
+внешние API подменяются через TELEGRAM_API_URL / OPENAI_API_BASE / YOOKASSA_API_URL
+(заглушки — bench/fakes.py). Трасса — JSONL, одно событие на строку:
+    {"at": 0.25, "type": "text", "chat_id": 100001, "text": "Привет"}
+Типы: text, callback, photo, pdf, payment. Трассы лежат в bench/traces/.
+
+Отчёт: пропускная способность (приём и полная обработка), p50/p95/p99 времени
+ответа /webhook и времени до первого исходящего сообщения в чат, пиковый RSS бота.
+Время до первого ответа сопоставляется по chat_id в порядке событий — если в одном
+чате события идут чаще, чем бот отвечает, оценка приблизительная.
+
+    python bench/loadtest.py --generate 500 --rate 20 --out bench/traces/mixed.jsonl
+    python bench/loadtest.py bench/traces/mixed.jsonl --openai-latency 0.8
+    python bench/loadtest.py bench/traces/mixed.jsonl --speed 0 --concurrency 32 --env WEBHOOK_WORKERS=16
+    python bench/loadtest.py bench/traces/mixed.jsonl --workers 4     # gunicorn, 4 процесса
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fakes import FakeServices
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TOKEN = "123456:LOADTEST"
+REPLY_METHODS = ("sendMessage", "editMessageText", "sendDocument")
+PROMPTS = [
+    "Напиши пост про запуск нового кафе в центре города",
+    "Объясни, как работает квантовый компьютер, простыми словами",
+    "Придумай три варианта слогана для магазина спортивной одежды",
+    "Сделай краткое резюме статьи о налогах для самозанятых",
+    "Составь план контента для Instagram на неделю",
+]
+BUTTONS = ["📄 Тарифы", "💡 Сменить стиль", "📘 Правила", "📋 Главное меню", "📂 Business Pro"]
+TARIFF_CODES = ["gpt35_lite", "gpt35_pro", "gpt4o_lite", "gpt4o_pro"]
+TARIFF_DESCRIPTIONS = ["GPT-3.5 Lite", "GPT-3.5 Pro", "GPT-3.5 Max", "GPT-4o Lite", "GPT-4o Pro"]
+# Доля событий каждого типа в синтетической трассе
+MIX = [("text", 0.62), ("button", 0.10), ("callback", 0.08), ("photo", 0.07), ("pdf", 0.05), ("payment", 0.08)]
+
+
+# --- Синтетическая трасса ---
+def generate_trace(events, rate, chats=None, seed=42):
+    rnd = random.Random(seed)
+    chats = chats or max(10, events // 5)
+    files = []
+    trace = []
+    at = 0.0
+    kinds, weights = zip(*MIX)
+    for _ in range(events):
+        at += rnd.expovariate(rate)
+        chat_id = 100000 + rnd.randrange(chats)
+        kind = rnd.choices(kinds, weights)[0]
+        event = {"at": round(at, 4), "type": kind, "chat_id": chat_id}
+        if kind == "text":
+            event["text"] = rnd.choice(PROMPTS)
+        elif kind == "button":
+            event.update(type="text", text=rnd.choice(BUTTONS))
+        elif kind == "callback":
+            event["data"] = "tariff:" + rnd.choice(TARIFF_CODES)
+        elif kind in ("photo", "pdf"):
+            # Часть файлов присылают повторно — так работает и кеш OCR
+            if files and rnd.random() < 0.2:
+                event["file"] = rnd.choice(files)
+                event["type"] = "pdf" if event["file"].endswith(".pdf") else "photo"
+            else:
+                event["file"] = f"file{len(files)}" + (".pdf" if kind == "pdf" else "")
+                files.append(event["file"])
+        elif kind == "payment":
+            event["description"] = rnd.choice(TARIFF_DESCRIPTIONS)
+            event["payment_id"] = f"pay-{len(trace)}"
+        trace.append(event)
+    return trace
+
+
+def load_trace(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_trace(trace, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for event in trace:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+# --- Запросы к боту ---
+def build_request(event, update_id):
+    # -> (путь, JSON)
+    chat = {"id": event["chat_id"], "type": "private", "first_name": "Load"}
+    user = {"id": event["chat_id"], "is_bot": False, "first_name": "Load"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user}
+    kind = event["type"]
+    if kind == "payment":
+        return "/yookassa/webhook", {
+            "type": "notification", "event": "payment.succeeded",
+            "object": {"id": event["payment_id"], "status": "succeeded", "paid": True,
+                       "description": event["description"], "metadata": {"chat_id": str(event["chat_id"])}},
+        }
+    if kind == "callback":
+        return "/webhook", {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": "loadtest", "data": event["data"],
+            "message": dict(message, text="📦 Выберите тариф:")}}
+    if kind == "photo":
+        message["photo"] = [{"file_id": event["file"], "file_unique_id": event["file"], "width": 1200, "height": 400}]
+    elif kind == "pdf":
+        message["document"] = {"file_id": event["file"], "file_unique_id": event["file"].replace(".pdf", ""),
+                               "file_name": "document.pdf", "mime_type": "application/pdf"}
+    else:
+        message["text"] = event["text"]
+    return "/webhook", {"update_id": update_id, "message": message}
+
+
+class Replayer:
+    def __init__(self, base_url, concurrency):
+        self.base_url = base_url
+        self.results = []   # (событие, время отправки, время ответа /webhook, HTTP-статус)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="client")
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def _send(self, event, update_id):
+        path, payload = build_request(event, update_id)
+        started = time.monotonic()
+        try:
+            status = self._session().post(self.base_url + path, json=payload, timeout=30).status_code
+        except requests.RequestException:
+            status = None
+        with self._lock:
+            self.results.append((event, started, time.monotonic() - started, status))
+
+    def replay(self, trace, speed):
+        # speed=0 — без пауз, ограничивает только число клиентских потоков
+        started = time.monotonic()
+        for update_id, event in enumerate(trace, start=1):
+            if speed:
+                delay = started + event["at"] / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._executor.submit(self._send, event, update_id)
+        self._executor.shutdown(wait=True)
+        return started
+
+
+# --- Отчёт ---
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def first_reply_latencies(results, calls):
+    # Для каждого события — первое исходящее сообщение в этот чат после него (в порядке событий)
+    replies = {}
+    for at, service, method, chat_id in calls:
+        if service == "telegram" and method in REPLY_METHODS and chat_id:
+            replies.setdefault(chat_id, []).append(at)
+    by_chat = {}
+    for event, started, _, status in sorted(results, key=lambda r: r[1]):
+        if status == 200:
+            by_chat.setdefault(str(event["chat_id"]), []).append((event["type"], started))
+    latencies, missing = {}, 0
+    for chat_id, events in by_chat.items():
+        times = replies.get(chat_id, [])
+        idx = 0
+        for kind, started in events:
+            while idx < len(times) and times[idx] < started:
+                idx += 1
+            if idx == len(times):
+                missing += 1
+                continue
+            latencies.setdefault(kind, []).append(times[idx] - started)
+            idx += 1
+    return latencies, missing
+
+
+def fmt_ms(values):
+    return " ".join(f"p{p}={percentile(values, p) * 1000:7.1f} мс" for p in (50, 95, 99))
+
+
+def wait_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"бот завершился при старте с кодом {process.returncode}")
+        try:
+            if requests.get(base_url + "/webhook/stats", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("бот не ответил за отведённое время")
+
+
+def wait_drained(base_url, fakes, quiet, timeout):
+    # Очереди бота пусты и заглушки давно не получали вызовов
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            busy = (requests.get(base_url + "/webhook/stats", timeout=2).json()["depth"]
+                    + requests.get(base_url + "/stats/outbox", timeout=2).json()["depth"])
+            llm = requests.get(base_url + "/stats/llm", timeout=2).json()
+            busy += llm["running"] + llm["queued"]
+        except requests.RequestException:
+            busy = 1
+        last = fakes.last_call()
+        if not busy and (last is None or time.monotonic() - last > quiet):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", nargs="?", help="файл трассы (JSONL)")
+    parser.add_argument("--generate", type=int, metavar="N", help="сгенерировать синтетическую трассу из N событий")
+    parser.add_argument("--rate", type=float, default=20, help="событий в секунду для --generate")
+    parser.add_argument("--chats", type=int, help="число разных чатов для --generate")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="куда сохранить сгенерированную трассу (без прогона)")
+    parser.add_argument("--speed", type=float, default=1.0, help="множитель скорости воспроизведения, 0 — без пауз")
+    parser.add_argument("--concurrency", type=int, default=16, help="клиентских потоков")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=1.0, help="до первого токена, с")
+    parser.add_argument("--openai-chunk-delay", type=float, default=0.05)
+    parser.add_argument("--yookassa-latency", type=float, default=0.3)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="запустить через gunicorn с N процессами (0 — python bot_main.py)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменные окружения бота")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочую папку (логи, state.db, метрики)")
+    args = parser.parse_args()
+
+    if args.generate:
+        trace = generate_trace(args.generate, args.rate, chats=args.chats, seed=args.seed)
+        if args.out:
+            save_trace(trace, args.out)
+            print(f"Трасса: {len(trace)} событий, {trace[-1]['at']:.1f} с → {args.out}")
+            return
+    elif args.trace:
+        trace = load_trace(args.trace)
+    else:
+        parser.error("нужен файл трассы или --generate N")
+
+    fakes = FakeServices(args.telegram_latency, args.openai_latency, args.openai_chunk_delay,
+                         args.yookassa_latency).start()
+    workdir = tempfile.mkdtemp(prefix="neiro-loadtest-")
+    env = dict(os.environ)
+    env.pop("WEBHOOK_URL", None)
+    env.update({
+        "PYTHONPATH": ROOT,
+        "PYTHONUNBUFFERED": "1",
+        "PORT": str(args.port),
+        "TELEGRAM_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": fakes.url + "/telegram",
+        "OPENAI_API_KEY": "sk-loadtest",
+        "OPENAI_API_BASE": fakes.url + "/openai/v1",
+        "YOOKASSA_SHOP_ID": "loadtest",
+        "YOOKASSA_SECRET_KEY": "loadtest",
+        "YOOKASSA_API_URL": fakes.url + "/yookassa/v3",
+    })
+    if args.workers:
+        env["WEB_CONCURRENCY"] = str(args.workers)
+        command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"), "bot_main:app"]
+    else:
+        command = [sys.executable, os.path.join(ROOT, "bot_main.py")]
+    env.update(item.split("=", 1) for item in args.env)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "w", encoding="utf-8") as log:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            boot_started = time.monotonic()
+            wait_ready(base_url, process)
+            print(f"Бот готов за {time.monotonic() - boot_started:.2f} с, событий в трассе: {len(trace)}")
+
+            replayer = Replayer(base_url, args.concurrency)
+            started = replayer.replay(trace, args.speed)
+            accepted_at = time.monotonic()
+            drained = wait_drained(base_url, fakes, quiet=max(1.0, args.openai_latency * 2), timeout=args.drain_timeout)
+            done_at = fakes.last_call() or accepted_at
+            with open(os.path.join(workdir, "metrics.txt"), "w", encoding="utf-8") as f:
+                f.write(requests.get(base_url + "/metrics", timeout=5).text)
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            fakes.stop()
+
+    # ru_maxrss — в КБ (Linux), максимум по процессам бота (воркеры gunicorn, пул OCR), а не сумма
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results = replayer.results
+    acks = [latency for _, _, latency, status in results if status == 200]
+    statuses = {}
+    for _, _, _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies, missing = first_reply_latencies(results, fakes.calls)
+
+    print(f"Событий: {len(results)}, статусы: {statuses}" + ("" if drained else "  ⚠️ очереди не опустели"))
+    print(f"Приём:     {len(results) / (accepted_at - started):8.1f} событий/с")
+    print(f"Обработка: {len(results) / max(done_at - started, 1e-9):8.1f} событий/с (до последнего исходящего вызова)")
+    print(f"Ответ /webhook:        {fmt_ms(acks)}")
+    every = [value for values in latencies.values() for value in values]
+    print(f"До первого сообщения:  {fmt_ms(every)}  (без ответа: {missing})")
+    for kind in sorted(latencies):
+        print(f"  {kind:<9} n={len(latencies[kind]):<5} {fmt_ms(latencies[kind])}")
+    print(f"Пиковый RSS бота (самый большой процесс): {peak_rss_mb:.1f} МБ")
+    print("Вызовы заглушек: " + ", ".join(f"{k}={v}" for k, v in sorted(fakes.counts().items())))
+    if args.keep:
+        print(f"Рабочая папка (bot.log, metrics.txt, state.db): {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Сравнение предобработки для OCR: прежняя PIL-версия против NumPy/OpenCV.
+
+Набор фикстур — папка с картинками (*.png, *.jpg, *.jpeg, *.tif) и, по желанию,
+эталонным текстом рядом: invoice.png + invoice.txt. Без папки фикстуры генерируются:
+известный текст, наклон, шум и неравномерная подсветка (детерминированно, --seed),
+так что цифры воспроизводимы из репозитория. Для картинок с эталоном считается
+точность Tesseract (доля совпавших символов), для всех — скорость.
+
+    python bench/ocr_preprocess.py --repeat 5
+    python bench/ocr_preprocess.py --synthetic 12 --deskew
+    python bench/ocr_preprocess.py path/to/fixtures --deskew --no-ocr
+"""
+import argparse
+import difflib
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+import pytesseract
+
+import ocr
+from export import FONT_CANDIDATES
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+
+def load_fixtures(directory):
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(name)
+        if ext.lower() not in IMAGE_EXTS:
+            continue
+        truth_path = os.path.join(directory, base + ".txt")
+        truth = None
+        if os.path.exists(truth_path):
+            with open(truth_path, "r", encoding="utf-8") as f:
+                truth = f.read()
+        image = Image.open(os.path.join(directory, name))
+        image.load()
+        fixtures.append((name, image, truth))
+    return fixtures
+
+
+SYNTHETIC_LINES = [
+    "Счёт на оплату № {n} от 14.03.2025",
+    "Поставщик: ООО «Ромашка», ИНН 7701234567",
+    "Покупатель: ИП Иванов Сергей Петрович",
+    "Услуги по договору аренды за март: 48 500,00 руб.",
+    "НДС 20%: 8 083,33 руб. Итого к оплате: 48 500,00 руб.",
+    "Invoice {n}, due date 31.03.2025, total 48500.00 RUB",
+]
+SYNTHETIC_LINES_LATIN = [
+    "Invoice {n} dated 14.03.2025",
+    "Supplier: Romashka LLC, tax ID 7701234567",
+    "Customer: Ivanov Sergey, sole proprietor",
+    "Office rent for March: 48 500.00 RUB",
+    "VAT 20%: 8 083.33 RUB. Total due: 48 500.00 RUB",
+    "Payment due 31.03.2025, account 40702810900000012345",
+]
+
+
+def synthetic_fixtures(count=6, seed=0):
+    # Как фото документа с телефона: наклон до ±4°, шум, подсветка с одного края.
+    # Кириллица — если найден TTF-шрифт (как в export.py), иначе текст латиницей
+    rng = random.Random(seed)
+    font_path = next((path for path in FONT_CANDIDATES if path and os.path.exists(path)), None)
+    if font_path:
+        font, lines = ImageFont.truetype(font_path, 34), SYNTHETIC_LINES
+    else:
+        font, lines = ImageFont.load_default(34), SYNTHETIC_LINES_LATIN
+    fixtures = []
+    for idx in range(count):
+        text = "\n".join(line.format(n=f"2025-{idx + 1:03d}") for line in lines)
+        image = Image.new("L", (1400, 700), 255)
+        ImageDraw.Draw(image).multiline_text((60, 80), text, font=font, fill=20, spacing=30)
+        image = image.rotate(rng.uniform(-4, 4), resample=Image.BICUBIC, expand=True, fillcolor=255)
+        pixels = np.asarray(image, dtype=np.float32)
+        shade = np.linspace(rng.uniform(0.45, 0.75), 1.0, pixels.shape[1], dtype=np.float32)
+        noise = np.random.default_rng(seed * 1000 + idx).normal(0, rng.uniform(8, 25), pixels.shape)
+        pixels = np.clip(pixels * shade + noise, 0, 255).astype(np.uint8)
+        fixtures.append((f"synthetic-{idx + 1}.png", Image.fromarray(pixels), text))
+    return fixtures
+
+
+def normalize(text):
+    return " ".join(text.lower().split())
+
+
+def accuracy(recognized, truth):
+    return difflib.SequenceMatcher(None, normalize(recognized), normalize(truth)).ratio()
+
+
+def bench(name, fn, fixtures, repeat, run_ocr, lang):
+    timings = []
+    pixels = 0
+    for _ in range(repeat):
+        for _, image, _ in fixtures:
+            start = time.perf_counter()
+            fn(image)
+            timings.append(time.perf_counter() - start)
+            pixels += image.width * image.height
+
+    scores = []
+    ocr_timings = []
+    if run_ocr:
+        for _, image, truth in fixtures:
+            processed = fn(image)
+            start = time.perf_counter()
+            text = pytesseract.image_to_string(processed, lang=lang)
+            ocr_timings.append(time.perf_counter() - start)
+            if truth is not None:
+                scores.append(accuracy(text, truth))
+
+    total = sum(timings)
+    print(f"\n== {name}")
+    print(f"  предобработка: {statistics.mean(timings) * 1000:8.1f} мс/изобр (p50 {statistics.median(timings) * 1000:.1f} мс),"
+          f" {pixels / total / 1e6:6.1f} Мпикс/с")
+    if ocr_timings:
+        print(f"  tesseract:     {statistics.mean(ocr_timings) * 1000:8.1f} мс/изобр")
+    if scores:
+        print(f"  точность:      {statistics.mean(scores) * 100:6.2f}% (на {len(scores)} изобр. с эталоном)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures", nargs="?", help="папка с изображениями и эталонными .txt (без неё — синтетические)")
+    parser.add_argument("--synthetic", type=int, default=6, help="сколько синтетических фикстур сгенерировать")
+    parser.add_argument("--seed", type=int, default=0, help="seed синтетических фикстур")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов замера скорости")
+    parser.add_argument("--lang", default=ocr.OCR_LANG)
+    parser.add_argument("--deskew", action="store_true", help="включить выравнивание наклона в новой версии")
+    parser.add_argument("--no-ocr", action="store_true", help="только скорость предобработки, без Tesseract")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        fixtures = load_fixtures(args.fixtures)
+        if not fixtures:
+            sys.exit(f"В {args.fixtures} нет изображений")
+    else:
+        fixtures = synthetic_fixtures(args.synthetic, args.seed)
+    print(f"Фикстур: {len(fixtures)}, с эталоном: {sum(1 for f in fixtures if f[2] is not None)}")
+
+    bench("legacy (PIL, порог 140)", ocr.preprocess_image_for_ocr_legacy, fixtures,
+          args.repeat, not args.no_ocr, args.lang)
+    bench("numpy/opencv (адаптивный порог)",
+          lambda image: ocr.preprocess_image_for_ocr(image, deskew=args.deskew), fixtures,
+          args.repeat, not args.no_ocr, args.lang)
+
+
+if __name__ == "__main__":
+    main()
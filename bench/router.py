@@ -0,0 +1,126 @@
+"""Микро-бенчмарк маршрутизации текстовых сообщений.
+
+Сравнивает прежнюю схему (цепочка лямбд telebot + сборка словаря запрещённых
+слов на каждый запрос) с MessageRouter/StyleFilter из router.py.
+Зависимостей, кроме стандартной библиотеки, нет.
+
+    python bench/router.py --messages 200000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from router import MessageRouter, StyleFilter
+
+MODES = ["психолог", "копирайтер", "юморист", "деловой", "философ", "профессор", "гопник", "истории"]
+BUTTONS = ["📂 Business Pro", "📄 Тарифы", "♻️ Сброс пробника", "💡 Сменить стиль", "📘 Правила",
+           "📋 Главное меню", "🚀 Запустить Neiro Max", "📞 Поддержка"]
+NAME_PHRASES = ["как тебя зовут", "твоё имя", "ты кто", "как звать", "называешься", "назови себя"]
+FORBIDDEN = {
+    "копирайтер": ["психолог", "депресс", "поддерж", "тревож"],
+    "деловой": ["юмор", "шутк", "прикол"],
+    "гопник": ["академ", "научн", "профессор"],
+    "профессор": ["шутк", "гопник", "жиза"]
+}
+PROMPTS = [
+    "Напиши пост про запуск нового кафе в центре города",
+    "Объясни, как работает квантовый компьютер, простыми словами и с примерами",
+    "Придумай три варианта слогана для магазина спортивной одежды",
+    "Мне тревожно перед собеседованием, что делать?",
+    "Сделай краткое резюме статьи о налогах для самозанятых в 2025 году",
+]
+
+
+def noop(message):
+    return None
+
+
+def legacy_chain():
+    # Порядок и условия — как у прежних @bot.message_handler
+    return [
+        lambda m: m.text == "📂 Business Pro",
+        lambda m: m.text == "📄 Тарифы",
+        lambda m: m.text == "♻️ Сброс пробника",
+        lambda m: m.text == "💡 Сменить стиль",
+        lambda m: m.text == "📘 Правила",
+        lambda m: any(phrase in m.text.lower() for phrase in NAME_PHRASES),
+        lambda m: m.text == "📋 Главное меню",
+        lambda m: m.text == "🚀 Запустить Neiro Max",
+        lambda m: m.text == "📞 Поддержка",
+        lambda m: m.text.lower() in [x.lower() for x in MODES],
+        lambda m: m.text == "🚀 Запустить Neiro Max",
+        lambda m: True,
+    ]
+
+
+def legacy_route(chain, message, mode):
+    for idx, check in enumerate(chain):
+        if check(message):
+            if idx == len(chain) - 1:
+                forbidden = {k: list(v) for k, v in FORBIDDEN.items()}
+                any(word in message.text.lower() for word in forbidden.get(mode, []))
+            return idx
+
+
+def build_router():
+    router = MessageRouter()
+    router.exact(*BUTTONS)(noop)
+    router.contains(*NAME_PHRASES)(noop)
+    router.exact_ci(*MODES)(noop)
+    style_filter = StyleFilter(FORBIDDEN)
+
+    def prompt(message):
+        style_filter.violation(message.mode, message.text)
+    router.default(prompt)
+    return router
+
+
+def workload(n, seed=42):
+    rnd = random.Random(seed)
+    messages = []
+    for _ in range(n):
+        roll = rnd.random()
+        if roll < 0.3:
+            text = rnd.choice(BUTTONS)
+        elif roll < 0.4:
+            text = rnd.choice(MODES).capitalize()
+        elif roll < 0.45:
+            text = "Слушай, " + rnd.choice(NAME_PHRASES) + "?"
+        else:
+            text = rnd.choice(PROMPTS)
+        messages.append(SimpleNamespace(text=text, mode=rnd.choice(MODES)))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200_000)
+    args = parser.parse_args()
+
+    messages = workload(args.messages)
+    chain = legacy_chain()
+    router = build_router()
+
+    start = time.perf_counter()
+    for message in messages:
+        legacy_route(chain, message, message.mode)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for message in messages:
+        router.dispatch(message)
+    compiled = time.perf_counter() - start
+
+    print(f"Сообщений: {len(messages)}")
+    print(f"  legacy (цепочка лямбд): {legacy / len(messages) * 1e9:8.0f} нс/сообщение")
+    print(f"  MessageRouter:          {compiled / len(messages) * 1e9:8.0f} нс/сообщение")
+    print(f"  ускорение:              {legacy / compiled:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,105 +1,260 @@
 
-import os
-import json
 import time
-from pathlib import Path
+BOOT_STARTED = time.perf_counter()  # для STARTUP_PROFILE: время до первого запроса
+
+import os
+
+if __name__ == "__main__":
+    # Локальный запуск — тоже через gunicorn (один процесс по умолчанию): процессы пула OCR
+    # (forkserver) импортируют главный модуль, и bot_main в этой роли запускался бы в каждом из них
+    import sys
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.execv(sys.executable, [sys.executable, "-m", "gunicorn", "-c", os.path.join(here, "gunicorn.conf.py"),
+                              "--pythonpath", here, "bot_main:app"])
+
+import hashlib
+import atexit
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import nullcontext
 from io import BytesIO
 
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
-import pytesseract
-from telebot import TeleBot, types
-from docx import Document
-from reportlab.pdfgen import canvas
+from telebot import TeleBot, types, apihelper
+from telebot.apihelper import ApiTelegramException
 import openai
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from yookassa import Configuration, Payment
 
+from state_store import StateStore
+from cache import TTLCache
+from workers import ChatWorkerPool, ChatFileLocks
+from streaming import StreamingReply
+from outbox import Outbox, configure_http_session
+from payment_events import PaymentEvents, PaymentStoreError
+from expiry import ExpiryScheduler
+from history_store import HistoryStore
+import metrics
+from metrics import timed, count_error
+from ocr_cache import OcrCache, content_key, unique_key
+from doc_analysis import DocumentAnalyzer, OutOfTokens, iter_docx_pages
+from llm_scheduler import (LLMScheduler, LLMBusyError, LLMRateLimited, PRIORITY_ADMIN, PRIORITY_PAID, PRIORITY_TRIAL,
+                           PRIORITY_BACKGROUND, is_retryable, is_server_error)
+from latency import LatencyTracker
+from summarizer import Summarizer, saved_tokens, is_summary
+from vector_memory import VectorMemory, HashingEmbedder, OpenAIEmbedder
+from router import MessageRouter, StyleFilter
+from tokens import count_tokens, message_tokens, with_tokens, to_api, fit_history, prompt_tokens, TOKENS_PER_REPLY
+
+
+def env_map(name, cast=str, default=None):
+    # "ключ=значение,ключ=значение" из переменной окружения поверх значений по умолчанию
+    result = dict(default or {})
+    for item in filter(None, os.getenv(name, "").split(",")):
+        key, value = item.split("=", 1)
+        result[key.strip()] = cast(value.strip())
+    return result
+
+
 # === КОНФИГ ===
 YOOKASSA_SHOP_ID = os.getenv("YOOKASSA_SHOP_ID")
 YOOKASSA_SECRET_KEY = os.getenv("YOOKASSA_SECRET_KEY")
 Configuration.account_id = YOOKASSA_SHOP_ID
 Configuration.secret_key = YOOKASSA_SECRET_KEY
-def preprocess_image_for_ocr(image: Image.Image) -> Image.Image:
-    # Перевод в оттенки серого
-    gray = image.convert('L')
-
-    # Усиление контраста
-    enhancer = ImageEnhance.Contrast(gray)
-    gray = enhancer.enhance(2.0)
-
-    # Чистим шум
-    gray = gray.filter(ImageFilter.MedianFilter(size=3))
-
-    # Бинаризация (черно-белое изображение)
-    bw = gray.point(lambda x: 0 if x < 140 else 255, '1')
-
-    return bw
-
+# Адреса внешних API можно подменить (локальные заглушки в bench/loadtest.py)
+Configuration.api_url = os.getenv("YOOKASSA_API_URL", Configuration.api_url)
 
 USED_TRIALS_FILE = "used_trials.json"
 TRIAL_TIMES_FILE = "trial_times.json"
+SUBSCRIPTIONS_FILE = "subscriptions.json"
+TOKEN_USAGE_FILE = "token_usage.json"
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "state.db")
+PAYMENT_RETURN_URL = "https://t.me/NeiroMaxBot"
+PAYMENT_LINK_TTL = int(os.getenv("PAYMENT_LINK_TTL", 1800))  # 30 минут
+PAYMENT_PREFETCH = os.getenv("PAYMENT_PREFETCH", "0") == "1"
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", 0.5))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WARMUP = os.getenv("WARMUP", "1") == "1"                 # фоновый импорт OCR/экспорта после старта
+WARMUP_DELAY = float(os.getenv("WARMUP_DELAY", 1.0))
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "0") == "1"  # печатать время до первого запроса
+# Число процессов gunicorn (см. gunicorn.conf.py). Больше одного — состояние общее через SQLite,
+# а лимиты «на бота» (Telegram, OpenAI, OCR) делятся между процессами поровну
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+MULTI_WORKER = WEB_CONCURRENCY > 1
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")  # снимки метрик процессов (только при MULTI_WORKER)
+NEXT_STEP_TTL = int(os.getenv("NEXT_STEP_TTL", 600))  # сколько ждать ввода после кнопки (ID для сброса и т.п.)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", 30)) / WEB_CONCURRENCY  # сообщений/с на бота
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", 1))       # сообщений/с в личный чат
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))  # сек между правками сообщения
+OCR_DPI = int(os.getenv("OCR_DPI", 300))
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+OCR_MAX_PAGES = int(os.getenv("OCR_MAX_PAGES", 50))
+OCR_PROGRESS_EVERY = int(os.getenv("OCR_PROGRESS_EVERY", 5))  # сообщение о прогрессе каждые N страниц
+OCR_DESKEW = os.getenv("OCR_DESKEW", "0") == "1"
+OCR_DEBUG_DIR = os.getenv("OCR_DEBUG_DIR")  # если задан — сохраняем картинку, поданную в Tesseract
+OCR_CACHE_FILE = os.getenv("OCR_CACHE_FILE", "ocr_cache.db")
+OCR_CACHE_TTL = int(os.getenv("OCR_CACHE_TTL", 30 * 86400))  # 30 дней
+OCR_CACHE_MB = int(os.getenv("OCR_CACHE_MB", 200))
+# Business Pro «Анализ документа»: заметки по фрагментам кешируются по хешу документа
+DOC_CACHE_FILE = os.getenv("DOC_CACHE_FILE", "doc_cache.db")
+DOC_CACHE_MB = int(os.getenv("DOC_CACHE_MB", 200))
+DOC_MAP_MODEL = os.getenv("DOC_MAP_MODEL", "gpt-3.5-turbo")      # заметки по фрагментам
+DOC_CHUNK_TOKENS = int(os.getenv("DOC_CHUNK_TOKENS", 2500))
+DOC_REDUCE_TOKENS = int(os.getenv("DOC_REDUCE_TOKENS", 6000))    # заметок в итоговом запросе
+DOC_CONCURRENCY = int(os.getenv("DOC_CONCURRENCY", 4))           # запросов на один документ одновременно
+DOC_MAX_CHUNKS = int(os.getenv("DOC_MAX_CHUNKS", 80))
+DOC_SESSION_TTL = int(os.getenv("DOC_SESSION_TTL", 2 * 3600))    # сколько отвечать на вопросы по документу
+DOC_PROGRESS_EVERY = int(os.getenv("DOC_PROGRESS_EVERY", 5))     # сообщение о прогрессе каждые N фрагментов
+LLM_MAX_CONCURRENCY = max(1, int(os.getenv("LLM_MAX_CONCURRENCY", 8)) // WEB_CONCURRENCY)
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 200))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 60))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+EXPORT_CACHE_SIZE = int(os.getenv("EXPORT_CACHE_SIZE", 256))
+EXPORT_CACHE_TTL = int(os.getenv("EXPORT_CACHE_TTL", 3600))
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 6 * 3600))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 5000))
+RESPONSE_CACHE_MAX_HISTORY = int(os.getenv("RESPONSE_CACHE_MAX_HISTORY", 0))  # кешируем только «с чистого листа»
+# Стили, где важна вариативность ответа — кеш не используется
+RESPONSE_CACHE_SKIP_MODES = set(filter(None, os.getenv("RESPONSE_CACHE_SKIP_MODES", "юморист,истории").split(",")))
 MEMORY_DIR = "memory"
 ADMIN_ID = 1034982624
 MAX_HISTORY = 20
+HISTORY_CACHE_BYTES = int(os.getenv("HISTORY_CACHE_MB", 64)) * 1024 * 1024
 TRIAL_TOKEN_LIMIT = 10_000
+# Бюджет токенов на промпт (история + системное + запрос), с запасом под ответ
+MODEL_PROMPT_BUDGETS = {
+    "gpt-3.5-turbo": 12_000,
+    "gpt-4o": 24_000,
+}
+DEFAULT_PROMPT_BUDGET = 8_000
+# Сводка длинных диалогов: порог токенов истории по модели ("модель=токены,..."; 0 — не сворачивать)
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "gpt-3.5-turbo")
+SUMMARY_THRESHOLDS = env_map("SUMMARY_THRESHOLDS", int, {"gpt-3.5-turbo": 3_000, "gpt-4o": 2_000})
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", 6))  # последние сообщения всегда дословно
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 400))
+# Долгая память: в этих стилях в промпт идут последние ходы + похожие фрагменты из прошлых разговоров
+LONG_MEMORY_MODES = set(filter(None, os.getenv("LONG_MEMORY_MODES", "психолог,копирайтер").split(",")))
+LONG_MEMORY_TOP_K = int(os.getenv("LONG_MEMORY_TOP_K", 3))
+LONG_MEMORY_RECENT = int(os.getenv("LONG_MEMORY_RECENT", 6))  # сообщений дословно
+EMBEDDINGS_PROVIDER = os.getenv("EMBEDDINGS_PROVIDER", "openai")  # openai — через API, hash — локально (тесты)
+EMBEDDINGS_MODEL = os.getenv("EMBEDDINGS_MODEL", "text-embedding-3-small")
+# Порог похожести свой у провайдера: у хеширования слов косинусы заметно ниже, чем у настоящих эмбеддингов
+LONG_MEMORY_MIN_SCORE = float(os.getenv("LONG_MEMORY_MIN_SCORE", 0.3 if EMBEDDINGS_PROVIDER == "openai" else 0.1))
+# Заменять историю последними ходами + найденным — только со смысловым поиском; с hash найденное
+# лишь добавляется к обычной истории
+LONG_MEMORY_REPLACES_HISTORY = EMBEDDINGS_PROVIDER == "openai"
+# Бюджет задержки: потолок по модели, фактический — по p95 последних запросов того же вида.
+# Потоковые ответы — до первого токена, обычные — до полного ответа (длинный ответ gpt-4o — 20+ с).
+# Не уложились или 5xx — запрос уходит на запасную модель
+MODEL_LATENCY_BUDGETS = env_map("MODEL_LATENCY_BUDGETS", float, {"gpt-4o": 15.0, "gpt-3.5-turbo": 10.0})
+MODEL_RESPONSE_BUDGETS = env_map("MODEL_RESPONSE_BUDGETS", float, {"gpt-4o": 90.0, "gpt-3.5-turbo": 60.0})
+MODEL_FALLBACKS = env_map("MODEL_FALLBACKS", str, {"gpt-4o": "gpt-3.5-turbo"})
+LATENCY_MIN_BUDGET = float(os.getenv("LATENCY_MIN_BUDGET", 3.0))
+LATENCY_MIN_RESPONSE_BUDGET = float(os.getenv("LATENCY_MIN_RESPONSE_BUDGET", 30.0))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 60))  # для последней модели в цепочке
 TRIAL_DURATION_SECONDS = 86400  # 24 часа
+EXPIRY_WARN_BEFORE = int(os.getenv("EXPIRY_WARN_BEFORE", 86400))  # предупреждение за сутки до конца тарифа
+EXPIRY_RESCAN_INTERVAL = int(os.getenv("EXPIRY_RESCAN_INTERVAL", 3600))  # пересборка кучи из store (другие воркеры)
 BOT_NAME = "Neiro Max"
 
-user_token_limits = {}
-user_modes = {}
-user_histories = {}
-user_models = {}
-trial_start_times = {}
+# === Единое хранилище состояния (SQLite WAL + кеш в памяти) ===
+# Бакеты: subscriptions, used_trials, trial_times, token_usage, modes, models
+# Ключи — всегда str(chat_id)
+store = StateStore(STATE_DB_FILE, shared=MULTI_WORKER)
+store.import_json("subscriptions", SUBSCRIPTIONS_FILE)
+store.import_json("used_trials", USED_TRIALS_FILE)
+store.import_json("trial_times", TRIAL_TIMES_FILE)
+store.import_json("token_usage", TOKEN_USAGE_FILE)
+atexit.register(store.close)
+
+
+def get_subscription(chat_id):
+    return store.get("subscriptions", chat_id)
+
+def set_subscription(chat_id, data):
+    store.set("subscriptions", chat_id, data)
+
+def get_tokens_used(chat_id):
+    return store.get("token_usage", chat_id, 0)
+
+def add_tokens_used(chat_id, amount):
+    return store.update("token_usage", chat_id, lambda used: (used or 0) + amount, 0)
+
+def get_trial_start(chat_id):
+    return store.get("trial_times", chat_id)
+
+def ensure_trial_started(chat_id):
+    return store.update("trial_times", chat_id, lambda started: started or time.time())
+
+def reset_trial(chat_id):
+    store.delete("used_trials", chat_id)
+    store.delete("trial_times", chat_id)
+
+def get_mode(chat_id):
+    return store.get("modes", chat_id, "копирайтер")
+
+def set_mode(chat_id, mode):
+    store.set("modes", chat_id, mode)
+
+def get_model(chat_id, default="gpt-3.5-turbo"):
+    return store.get("models", chat_id, default)
+
+def set_model(chat_id, model):
+    store.set("models", chat_id, model)
+
 # ✅ Блок проверки подписки и пробника
+# Только чтение из памяти: предупреждения и окончание срока рассылает фоновый expiry (ExpiryScheduler)
 def check_access_and_notify(chat_id):
     now = time.time()
-    tokens_used = user_token_limits.get(chat_id, 0)
-
-    # === Проверка пробного периода ===
-    is_trial = str(chat_id) not in user_models or user_models[str(chat_id)] == "gpt-3.5-turbo"
-    trial_start = trial_start_times.get(str(chat_id))
-
-    if is_trial and trial_start:
-        time_elapsed = now - trial_start
-        if time_elapsed > TRIAL_DURATION_SECONDS or tokens_used >= TRIAL_TOKEN_LIMIT:
-            # ЖЁСТКАЯ БЛОКИРОВКА
-            bot.send_message(chat_id, "⛔ Пробный период завершён. Для продолжения выберите тариф.")
-            return False
+    tokens_used = get_tokens_used(chat_id)
 
     # === Проверка оплаченного тарифа ===
-    subscription_file = "subscriptions.json"
-    if os.path.exists(subscription_file):
-        with open(subscription_file, "r", encoding="utf-8") as f:
-            subscriptions = json.load(f)
-    else:
-        subscriptions = {}
-
-    sub_data = subscriptions.get(str(chat_id))
+    sub_data = get_subscription(chat_id)
     if sub_data:
         expires_at = sub_data.get("expires_at")
-        warned = sub_data.get("warned", False)
         token_limit = sub_data.get("token_limit", 100000)
 
         # Лимит токенов исчерпан — блок
         if tokens_used >= token_limit:
-            bot.send_message(chat_id, "⛔ Вы исчерпали лимит токенов. Пожалуйста, продлите подписку.")
+            outbox.send_message(chat_id, "⛔ Вы исчерпали лимит токенов. Пожалуйста, продлите подписку.")
             return False
 
         # Срок действия подписки истёк — блок
         if expires_at and now > expires_at:
-            bot.send_message(chat_id, "⛔ Срок действия вашего тарифа истёк. Пожалуйста, выберите новый тариф.")
+            outbox.send_message(chat_id, "⛔ Срок действия вашего тарифа истёк. Пожалуйста, выберите новый тариф.")
             return False
+        return True
 
-        # Предупреждение за 24 часа до окончания
-        if expires_at and not warned and expires_at - now <= 86400:
-            bot.send_message(chat_id, "⚠️ Ваш тариф заканчивается через 24 часа. Не забудьте продлить доступ.")
-            subscriptions[str(chat_id)]["warned"] = True
-            with open(subscription_file, "w", encoding="utf-8") as f:
-                json.dump(subscriptions, f, indent=2)
+    # === Проверка пробного периода (нет подписки — значит пробник, независимо от модели) ===
+    trial_start = get_trial_start(chat_id)
+    if trial_start and (now - trial_start > TRIAL_DURATION_SECONDS or tokens_used >= TRIAL_TOKEN_LIMIT):
+        # ⚠️ ЖЁСТКАЯ БЛОКИРОВКА + кнопки с тарифами
+        outbox.send_message(
+            chat_id,
+            "⛔ Пробный период завершён.\n\nВыберите тариф для продолжения работы:",
+            reply_markup=tariffs_keyboard()
+        )
+        if PAYMENT_PREFETCH:
+            # Прогреваем ссылки в фоне, чтобы нажатие на тариф было мгновенным
+            prefetch_payment_links(chat_id)
+        return False
 
     return True
 
 
+def tokens_left(chat_id):
+    # Сколько токенов ещё можно потратить по тарифу или пробнику (те же лимиты, что в check_access_and_notify)
+    sub_data = get_subscription(chat_id)
+    token_limit = sub_data.get("token_limit", 100000) if sub_data else TRIAL_TOKEN_LIMIT
+    return token_limit - get_tokens_used(chat_id)
+
+
 available_modes = {
     "психолог": "Ты — внимательный и эмпатичный психолог. Говори с заботой, мягко и поддерживающе.",
     "копирайтер": "Ты — профессиональный копирайтер. Пиши живо, увлекательно и убедительно.",
@@ -111,6 +266,129 @@ available_modes = {
     "истории": "Ты — рассказчик. Превращай каждый ответ в интересную историю."
 }
 
+# === Кеш ответов на одинаковые запросы (по стилю и модели) ===
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+
+def response_cache_key(prompt, mode, model, history):
+    if not RESPONSE_CACHE or mode in RESPONSE_CACHE_SKIP_MODES or len(history) > RESPONSE_CACHE_MAX_HISTORY:
+        return None
+    normalized = " ".join(prompt.lower().replace("ё", "е").split()).strip(" .!?…")
+    return (model, mode, normalized)
+
+
+# === Планировщик запросов к OpenAI: общий лимит, приоритеты, повторы ===
+llm = LLMScheduler(max_concurrency=LLM_MAX_CONCURRENCY, max_queue=LLM_MAX_QUEUE,
+                   queue_timeout=LLM_QUEUE_TIMEOUT, max_retries=LLM_MAX_RETRIES)
+
+
+def llm_priority(chat_id):
+    if is_admin(chat_id):
+        return PRIORITY_ADMIN
+    sub = get_subscription(chat_id)
+    if sub and (not sub.get("expires_at") or sub["expires_at"] > time.time()):
+        return PRIORITY_PAID
+    return PRIORITY_TRIAL
+
+
+# === Бюджеты задержки и запасные модели ===
+# Замеры раздельно: до первого токена (stream=True) и до полного ответа (stream=False)
+latency = {
+    True: LatencyTracker(MODEL_LATENCY_BUDGETS, min_budget=LATENCY_MIN_BUDGET),
+    False: LatencyTracker(MODEL_RESPONSE_BUDGETS, default_budget=60.0, min_budget=LATENCY_MIN_RESPONSE_BUDGET),
+}
+# Потоки, которые ждут первый чанк. Брошенные по бюджету запросы больше не повторяются и занимают
+# место в лимите llm, пока не закончатся, — поэтому всего в работе не больше LLM_MAX_CONCURRENCY * 2 запросов
+stream_opener = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY * 4, thread_name_prefix="llm-stream")
+
+
+def create_completion(model, messages, stream, read_timeout, retryable, abandoned=None):
+    # abandoned (threading.Event) — вызывающий ушёл на запасную модель: новых попыток не начинаем
+    def create():
+        if abandoned is not None and abandoned.is_set():
+            raise openai.error.Timeout("Запрос брошен по бюджету")
+        return openai.ChatCompletion.create(model=model, messages=to_api(messages), stream=stream,
+                                            request_timeout=(LLM_CONNECT_TIMEOUT, read_timeout))
+
+    if abandoned is not None:
+        retryable = (lambda e, retryable=retryable: not abandoned.is_set() and retryable(e))
+    return llm.retry(create, retryable=retryable)
+
+
+def first_chunk(model, messages, retryable, abandoned):
+    # -> (поток, первый чанк или None)
+    result = create_completion(model, messages, True, LLM_REQUEST_TIMEOUT, retryable, abandoned)
+    return result, next(result, None)
+
+
+def close_abandoned(future, release):
+    try:
+        if not future.cancelled() and future.exception() is None:
+            future.result()[0].close()
+    finally:
+        release()
+
+
+def open_stream(model, messages, budget, retryable):
+    # Бюджет — только до первого чанка. request_timeout — таймаут каждого чтения на весь поток,
+    # поэтому запрос идёт с обычным LLM_REQUEST_TIMEOUT (пауза посреди ответа его не обрывает),
+    # а первый чанк ждём здесь не дольше budget. budget=None — ждём сколько потребуется
+    abandoned = threading.Event()
+    future = stream_opener.submit(first_chunk, model, messages, retryable, abandoned)
+    try:
+        result, first = future.result(timeout=budget)
+    except FutureTimeout:
+        abandoned.set()
+        release = llm.occupy()
+        future.add_done_callback(lambda future: close_abandoned(future, release))
+        raise openai.error.Timeout(f"Первый чанк не пришёл за {budget:.1f} с") from None
+    return itertools.chain([first] if first is not None else [], result)
+
+
+def chat_completion(model, messages, stream=False):
+    # -> (модель, которая ответила; ответ или итератор чанков). Вызывать внутри llm.slot.
+    # Пока есть запасная модель, ждём не дольше бюджета и 5xx не повторяем — сразу переходим на неё
+    tracker = latency[bool(stream)]
+    while True:
+        fallback = MODEL_FALLBACKS.get(model)
+        retryable = (lambda e: is_retryable(e) and not is_server_error(e)) if fallback else is_retryable
+        started = time.perf_counter()
+        budget = None
+        try:
+            if stream:
+                budget = tracker.budget(model) if fallback else None
+                result = open_stream(model, messages, budget, retryable)
+            else:
+                budget = tracker.budget(model) if fallback else LLM_REQUEST_TIMEOUT
+                result = create_completion(model, messages, False, budget, retryable)
+        except Exception as e:
+            if not fallback or not is_server_error(e):
+                raise
+            if isinstance(e, openai.error.Timeout):
+                tracker.observe(model, budget)
+            metrics.counter("llm_fallbacks_total", "Переходы на запасную модель").inc(
+                model=model, fallback=fallback, reason=type(e).__name__)
+            print(f"[llm] {model}: {type(e).__name__} за {time.perf_counter() - started:.1f} с, переходим на {fallback}")
+            model = fallback
+            continue
+        elapsed = time.perf_counter() - started
+        tracker.observe(model, elapsed)
+        metrics.histogram("openai_first_token_seconds", "Время до первого токена (до ответа без стриминга)").observe(
+            elapsed, model=model, stream="true" if stream else "false")
+        return model, result
+
+
+def llm_error_text(error):
+    # Пользователю — понятное сообщение, сырой текст ошибки — только в лог
+    count_error("llm", error)
+    if isinstance(error, LLMRateLimited):
+        return f"⏳ Слишком много запросов подряд. Попробуйте через {int(error.retry_in) + 1} сек."
+    if isinstance(error, LLMBusyError):
+        return "⏳ Сейчас очень много запросов. Попробуйте через минуту."
+    print(f"[openai error] {type(error).__name__}: {error}")
+    return "⚠️ Не удалось получить ответ от модели. Попробуйте ещё раз чуть позже."
+
+
 def extract_chat_id_from_description(description):
     import re
     match = re.search(r'chat_id[:\s]*(\d+)', description)
@@ -119,61 +397,256 @@ def extract_chat_id_from_description(description):
 
 def create_payment(amount_rub, description, return_url, chat_id):
     try:
-        payment = Payment.create({
-            "amount": {"value": f"{amount_rub}.00", "currency": "RUB"},
-            "confirmation": {
-                "type": "redirect",
-                "return_url": return_url
-            },
-            "capture": True,
-            "description": description,  # Только название тарифа
-            "metadata": {
-                "chat_id": str(chat_id)
-            }
-        })
+        with timed("yookassa_create_payment_seconds", "Создание платежа в ЮKassa"):
+            payment = Payment.create({
+                "amount": {"value": f"{amount_rub}.00", "currency": "RUB"},
+                "confirmation": {
+                    "type": "redirect",
+                    "return_url": return_url
+                },
+                "capture": True,
+                "description": description,  # Только название тарифа
+                "metadata": {
+                    "chat_id": str(chat_id)
+                }
+            })
         print("✅ Ссылка на оплату:", payment.confirmation.confirmation_url)
         return payment.confirmation.confirmation_url
         return payment.confirmation.confirmation_url
     except Exception as e:
+        count_error("yookassa", e)
         print("❌ Ошибка при создании платежа:")
         import traceback
         traceback.print_exc()
         return None
-def load_used_trials():
-    if os.path.exists(USED_TRIALS_FILE):
-        with open(USED_TRIALS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
-def save_trial_times(data):
-    with open(TRIAL_TIMES_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-
-def load_token_usage():
-    if os.path.exists("token_usage.json"):
-        with open("token_usage.json", "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
-def save_token_usage(data):
-    with open("token_usage.json", "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
-
-def save_used_trials(data):
-    with open(USED_TRIALS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+
+
+# === Тарифы и ленивые ссылки на оплату ===
+# (код для callback, подпись кнопки, цена, описание платежа)
+TARIFFS = [
+    ("gpt35_lite", "GPT-3.5: Lite — 199₽", 199, "GPT-3.5 Lite"),
+    ("gpt35_pro", "GPT-3.5: Pro — 299₽", 299, "GPT-3.5 Pro"),
+    ("gpt35_max", "GPT-3.5: Max — 399₽", 399, "GPT-3.5 Max"),
+    ("gpt4o_lite", "GPT-4o: Lite — 299₽", 299, "GPT-4o Lite"),
+    ("gpt4o_pro", "GPT-4o: Pro — 499₽", 499, "GPT-4o Pro"),
+    ("gpt4o_max", "GPT-4o: Max — 999₽", 999, "GPT-4o Max"),
+]
+TARIFFS_BY_CODE = {code: (label, price, desc) for code, label, price, desc in TARIFFS}
+CB_TARIFF_PREFIX = "tariff:"
+
+payment_links = TTLCache(maxsize=4096, ttl=PAYMENT_LINK_TTL)
+_payment_link_locks = {}
+_payment_link_locks_guard = threading.Lock()
+payment_executor = ThreadPoolExecutor(max_workers=len(TARIFFS), thread_name_prefix="payment")
+
+
+def cached_payment_link(key):
+    # Ссылка, созданная до последней оплаты, уже оплачена — её не переиспользуем
+    # (сверка с paid_at нужна при нескольких процессах: кеш ссылок у каждого свой)
+    cached = payment_links.get(key)
+    if not cached:
+        return None
+    url, created_at = cached
+    if created_at <= (get_subscription(key[0]) or {}).get("paid_at", 0):
+        payment_links.pop(key)
+        return None
+    return url
+
+
+def get_payment_link(chat_id, code):
+    # Ссылка создаётся только для выбранного тарифа и переиспользуется в пределах TTL
+    key = (str(chat_id), code)
+    url = cached_payment_link(key)
+    if url:
+        return url
+    with _payment_link_locks_guard:
+        lock = _payment_link_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            url = cached_payment_link(key)
+            if url:
+                return url
+            label, price, desc = TARIFFS_BY_CODE[code]
+            created_at = time.time()
+            url = create_payment(price, desc, PAYMENT_RETURN_URL, chat_id)
+            if url:
+                payment_links.set(key, (url, created_at))
+            return url
+    finally:
+        # Блокировка нужна только на время создания — убираем и при раннем возврате, и при ошибке
+        with _payment_link_locks_guard:
+            _payment_link_locks.pop(key, None)
+
+
+def forget_payment_links(chat_id):
+    for code in TARIFFS_BY_CODE:
+        payment_links.pop((str(chat_id), code))
+
+
+def prefetch_payment_links(chat_id, codes=None):
+    # Заранее создаём ссылки параллельно, а не по очереди
+    codes = codes or list(TARIFFS_BY_CODE)
+    return payment_executor.map(lambda code: get_payment_link(chat_id, code), codes)
+
+
+def tariffs_keyboard():
+    markup = types.InlineKeyboardMarkup(row_width=1)
+    for code, label, price, desc in TARIFFS:
+        markup.add(types.InlineKeyboardButton(f"💳 {label}", callback_data=CB_TARIFF_PREFIX + code))
+    return markup
+
+
+# === Активация подписки по платежу (из фоновой очереди payment_events) ===
+SUBSCRIPTION_DAYS = 30
+# 🎯 Лимит токенов по тарифу (описание платежа = desc из TARIFFS)
+TARIFF_TOKEN_LIMITS = {
+    "GPT-3.5 Lite": 50000,
+    "GPT-3.5 Pro": 100000,
+    "GPT-3.5 Max": 1000000,
+    "GPT-4o Lite": 30000,
+    "GPT-4o Pro": 60000,
+    "GPT-4o Max": 1000000,
+}
+DEFAULT_TARIFF_TOKEN_LIMIT = 100000
+
+
+def parse_payment(obj):
+    # -> (chat_id, тариф, модель) или None.
+    # chat_id — из metadata; у старых ссылок он был в описании: "…:<chat_id>:<тариф>"
+    description = obj.get("description", "")
+    chat_id = (obj.get("metadata") or {}).get("chat_id")
+    tariff = description
+    if not chat_id and description.count(":") >= 2:
+        _, chat_id, tariff = description.split(":", 2)
+    if not chat_id or not str(chat_id).strip().lstrip("-").isdigit():
+        return None
+    if "gpt-4" in tariff.lower():
+        model = "gpt-4o"
+    elif "gpt-3.5" in tariff.lower() or tariff != description:  # в старом формате по умолчанию GPT-3.5
+        model = "gpt-3.5-turbo"
+    else:
+        return None
+    return str(chat_id).strip(), tariff.strip(), model
+
+
+def activate_payment(payment_id, obj):
+    # Идемпотентно по payment_id: id применённых платежей хранятся в самой подписке
+    parsed = parse_payment(obj)
+    if parsed is None:
+        print(f"[YooKassa] Платёж {payment_id}: не удалось определить chat_id или тариф ({obj.get('description')!r})")
+        return
+    chat_id, tariff, model = parsed
+    limit = TARIFF_TOKEN_LIMITS.get(tariff, DEFAULT_TARIFF_TOKEN_LIMIT)
+    used = get_tokens_used(chat_id)
+    applied = []
+
+    def extend(sub):
+        sub = dict(sub or {})
+        if payment_id in sub.get("payments", []):
+            return sub
+        now = time.time()
+        expires_at = sub.get("expires_at") or 0
+        active = expires_at > now
+        # Продление — от конца текущего срока; неизрасходованный лимит токенов сохраняется
+        sub.update(
+            model=model,
+            tariff=tariff,
+            activated_at=sub.get("activated_at", int(now)) if active else int(now),
+            expires_at=int(max(now, expires_at) + SUBSCRIPTION_DAYS * 86400),
+            token_limit=(max(sub.get("token_limit", 0), used) if active else used) + limit,
+            paid_at=now,
+            warned=False,
+            expired_notified=False,
+            payments=(sub.get("payments", []) + [payment_id])[-20:],
+        )
+        applied.append(sub)
+        return sub
+
+    store.update("subscriptions", chat_id, extend)
+    if not applied:
+        print(f"[YooKassa] Платёж {payment_id} уже применён для {chat_id}")
+        return
+    set_model(chat_id, model)
+    # Ссылки на оплату из кеша уже оплачены — при продлении создаём новые
+    forget_payment_links(chat_id)
+    expiry.schedule(chat_id, applied[0])
+    expires = time.strftime("%d.%m.%Y", time.localtime(applied[0]["expires_at"]))
+    print(f"[YooKassa] Подписка {tariff} для {chat_id} до {expires} (платёж {payment_id})")
+    outbox.send_message(chat_id, f"✅ Оплата прошла успешно!\nАктивирован тариф: <b>{tariff}</b>\nДоступ до {expires}",
+                        parse_mode="HTML")
+
+
+# === Окончание подписок: предупреждение за сутки и блокировка — из фонового expiry ===
+def notify_expiring(chat_ids):
+    for chat_id in chat_ids:
+        outbox.send_message(chat_id, "⚠️ Ваш тариф заканчивается через 24 часа. Не забудьте продлить доступ.")
+
+
+def notify_expired(chat_ids):
+    for chat_id in chat_ids:
+        outbox.send_message(chat_id, "⛔ Срок действия вашего тарифа истёк. Пожалуйста, выберите новый тариф.",
+                            reply_markup=tariffs_keyboard())
+    print(f"⌛ Истекли подписки: {len(chat_ids)}")
 
 def is_admin(chat_id):
     return int(chat_id) == ADMIN_ID
 
+# === История: LRU в памяти + append-only memory/<chat_id>.jsonl ===
+histories = HistoryStore(MEMORY_DIR, max_history=MAX_HISTORY, memory_budget=HISTORY_CACHE_BYTES, shared=MULTI_WORKER)
+
 def load_history(chat_id):
-    path = f"{MEMORY_DIR}/{chat_id}.json"
-    return json.load(open(path, "r", encoding="utf-8")) if os.path.exists(path) else []
+    return histories.load(chat_id)
+
+def append_history(chat_id, *messages):
+    histories.append(chat_id, *messages)
+
+
+# === Сводка старых ходов: дешёвая модель в фоне, с самым низким приоритетом в llm ===
+def summarize_turns(chat_id, previous, turns):
+    dialog = "\n".join(f"{'Пользователь' if m['role'] == 'user' else 'Ассистент'}: {m['content']}"
+                       for m in turns if m["role"] != "system")
+    messages = [
+        {"role": "system", "content": "Сожми диалог в краткую сводку на русском: факты о пользователе, "
+                                      "его цели, договорённости и важные детали. Без вступлений, не больше 150 слов."},
+        {"role": "user", "content": (f"Прежняя сводка:\n{previous}\n\n" if previous else "") + f"Новые реплики:\n{dialog}"},
+    ]
+    with timed("openai_request_seconds", "Запросы к OpenAI (со всеми повторами)", model=SUMMARY_MODEL, stream="false"):
+        response = llm.run(f"summary:{chat_id}", PRIORITY_BACKGROUND, lambda: openai.ChatCompletion.create(
+            model=SUMMARY_MODEL, messages=messages, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.3))
+    return response["choices"][0]["message"]["content"]
+
+
+summarizer = Summarizer(histories, summarize_turns, thresholds=SUMMARY_THRESHOLDS, keep_recent=SUMMARY_KEEP_RECENT,
+                        model=SUMMARY_MODEL)
+
+# === Долгая память: все ходы индексируются в memory/vectors, поиск — в LONG_MEMORY_MODES ===
+def run_embeddings(fn, urgent):
+    # Пачки ходов — фоном; эмбеддинг запроса ждёт ответ пользователю — не ставим его за фоновыми задачами
+    with llm.slot("embeddings", PRIORITY_PAID if urgent else PRIORITY_BACKGROUND, rate_limited=False):
+        return llm.retry(fn)
+
 
-def save_history(chat_id, history):
-    path = f"{MEMORY_DIR}/{chat_id}.json"
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(history[-MAX_HISTORY:], f, ensure_ascii=False, indent=2)
+if EMBEDDINGS_PROVIDER == "openai":
+    embedder = OpenAIEmbedder(EMBEDDINGS_MODEL, run=run_embeddings)
+else:
+    embedder = HashingEmbedder()
+vector_memory = VectorMemory(os.path.join(MEMORY_DIR, "vectors"), embedder, min_score=LONG_MEMORY_MIN_SCORE,
+                             shared=MULTI_WORKER)
+
+
+def recall_message(chat_id, prompt, recent, model):
+    # Похожие прошлые ходы (кроме тех, что и так в промпте) одним системным сообщением.
+    # Поиск не удался — отвечаем без него
+    try:
+        recalled = vector_memory.search(chat_id, prompt, k=LONG_MEMORY_TOP_K, skip_recent=len(recent) // 2)
+    except Exception as e:
+        count_error("long_memory", e)
+        print(f"⚠️ Долгая память недоступна: {type(e).__name__}: {e}")
+        return None
+    if not recalled:
+        return None
+    snippets = "\n---\n".join(text for _, text in recalled)
+    return with_tokens("system", f"Фрагменты прошлых разговоров с пользователем:\n{snippets}", model)
 
 # === Главное меню: показываем Business Pro всегда ===
 def main_menu(chat_id=None):
@@ -201,19 +674,23 @@ def format_buttons():
     markup.add(types.InlineKeyboardButton("📝 Word", callback_data="save_word"))
     return markup
 
-used_trials = load_used_trials()
-try:
-    with open(TRIAL_TIMES_FILE, "r", encoding="utf-8") as f:
-        trial_start_times = json.load(f)
-        print("🎯 trial_start_times загружен:", trial_start_times)
-except:
-    trial_start_times = {}
-    print("⚠️ trial_start_times не найден или пустой. Создан пустой словарь.")
-    pass
+print(f"🎯 Состояние загружено: {store.count('trial_times')} пробников, {store.count('subscriptions')} подписок")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
-bot = TeleBot(TELEGRAM_TOKEN)
+openai.api_base = os.getenv("OPENAI_API_BASE", openai.api_base)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL.rstrip("/") + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL.rstrip("/") + "/file/bot{0}/{1}"
+# threaded=False: хендлеры выполняются в нашем пуле воркеров (см. update_pool)
+bot = TeleBot(TELEGRAM_TOKEN, threaded=False)
+# Все текстовые кнопки и фразы разбираются одним диспетчером (см. route_text_message)
+router = MessageRouter()
+
+# Все исходящие сообщения — через очередь с лимитами Telegram и общим пулом соединений
+configure_http_session(WEBHOOK_WORKERS + OUTBOX_WORKERS + 4)
+outbox = Outbox(bot, workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE)
 # === Business Pro: минимальное меню ===
 # callback-ключи (простые, чтобы не конфликтовали)
 CB_BP_DOC   = "bp_doc"
@@ -229,154 +706,348 @@ def send_bp_menu(chat_id: int):
         types.InlineKeyboardButton("📊 Excel-ассистент", callback_data=CB_BP_EXCEL),
         types.InlineKeyboardButton("📝 Сгенерировать документ", callback_data=CB_BP_GEN),
     )
-    bot.send_message(chat_id, "Выберите функцию Business Pro:", reply_markup=kb)
+    outbox.send_message(chat_id, "Выберите функцию Business Pro:", reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.text == "📂 Business Pro")
+@router.exact("📂 Business Pro")
 def open_bp_menu(message):
     # если нужна проверка тарифа — скажи, добавлю условие отдельно
     send_bp_menu(message.chat.id)
 
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
-if WEBHOOK_URL:
-    bot.remove_webhook()
-    bot.set_webhook(url=WEBHOOK_URL)
-Path(MEMORY_DIR).mkdir(exist_ok=True)
 @bot.message_handler(commands=["start"])
 def handle_start(message):
     chat_id = str(message.chat.id)
 
     # Минимальная инициализация
-    user_modes[message.chat.id] = "копирайтер"
-    user_histories[message.chat.id] = []
+    set_mode(chat_id, "копирайтер")
 
     if message.chat.id == ADMIN_ID:
-        user_models[message.chat.id] = "gpt-4o"
+        set_model(chat_id, "gpt-4o")
     else:
-        user_models[message.chat.id] = "gpt-3.5-turbo"
+        set_model(chat_id, "gpt-3.5-turbo")
 
-    user_token_limits[message.chat.id] = 0
-
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         f"Привет! Я {BOT_NAME} — твой AI-ассистент 🤖\n\nНажми кнопку «🚀 Запустить Neiro Max» ниже, чтобы начать.",
         reply_markup=main_menu(message.chat.id)
     )
 
-from PIL import Image, ImageEnhance, ImageFilter
-from pdf2image import convert_from_bytes
-import pytesseract
-from io import BytesIO
+# Кеш распознанного текста: повторно присланные файлы не скачиваются и не распознаются
+ocr_results = OcrCache(OCR_CACHE_FILE, ttl=OCR_CACHE_TTL, max_bytes=OCR_CACHE_MB * 1024 * 1024)
+
+
+def observe_ocr_timings(timings):
+    # Этапы OCR, замеренные в дочерних процессах (растеризация, предобработка, Tesseract)
+    for stage, seconds in timings.items():
+        metrics.histogram("ocr_stage_seconds", "Этапы OCR").observe(seconds, stage=stage)
+
+
+def recognize_file(message, downloaded_file):
+    import ocr  # OpenCV/PyMuPDF/Tesseract грузятся при первом файле или фоновым прогревом (см. warmup)
+    debug_path = os.path.join(OCR_DEBUG_DIR, f"ocr_debug_{int(time.time())}.png") if OCR_DEBUG_DIR else None
+
+    notice = ''
+    if message.content_type == 'document' and message.document.mime_type == 'application/pdf':
+        # Страницы растеризуются и распознаются параллельно, окнами, по порядку
+        pages, total = [], 0
+        for page_no, total, page_text in ocr.iter_pdf_text(
+                downloaded_file, dpi=OCR_DPI, max_pages=OCR_MAX_PAGES, workers=OCR_WORKERS,
+                debug_path=debug_path, deskew=OCR_DESKEW, on_timings=observe_ocr_timings):
+            pages.append(page_text)
+            limit = min(total, OCR_MAX_PAGES)
+            if limit > OCR_PROGRESS_EVERY and page_no % OCR_PROGRESS_EVERY == 0 and page_no < limit:
+                outbox.send_message(message.chat.id, f"⏳ Распознано страниц: {page_no} из {limit}")
+        if total > OCR_MAX_PAGES:
+            notice = f"\n\n⚠️ Распознаны первые {OCR_MAX_PAGES} страниц из {total}."
+        text = '\n'.join(pages)
+    else:
+        text, timings = ocr.submit(ocr.ocr_image_bytes, downloaded_file, debug_path=debug_path,
+                                   deskew=OCR_DESKEW, workers=OCR_WORKERS).result()
+        observe_ocr_timings(timings)
+    return text.strip(), notice
+
 
 @bot.message_handler(content_types=['document', 'photo'])
+@timed("bot_handler_seconds", "Время обработки апдейта по хендлерам", handler="handle_ocr_file")
 def handle_ocr_file(message):
+    if message.content_type == 'document':
+        # PDF и DOCX — в анализ, только если пользователь выбрал «Анализ документа» в Business Pro
+        kind = doc_kind(message.document)
+        if kind and document_session(message.chat.id):
+            return analyze_document(message, kind)
+        if kind == "docx":
+            outbox.send_message(message.chat.id, "📄 Документы Word разбираются в 📂 Business Pro → "
+                                                 "«📄 Анализ документа». Выберите его и пришлите файл ещё раз.")
+            return
     try:
-        file_id = message.document.file_id if message.content_type == 'document' else message.photo[-1].file_id
-        file_info = bot.get_file(file_id)
-        downloaded_file = bot.download_file(file_info.file_path)
-        file_bytes = BytesIO(downloaded_file)
-
-        text = ''
-        if message.content_type == 'document' and message.document.mime_type == 'application/pdf':
-            images = convert_from_bytes(file_bytes.read(), dpi=300)
-        else:
-            img = Image.open(file_bytes)
-            images = [img]
+        source = message.document if message.content_type == 'document' else message.photo[-1]
+
+        # Сначала — по file_unique_id, ещё до скачивания
+        keys = [unique_key(source.file_unique_id)]
+        result = ocr_results.get(keys[0])
+        if result is None:
+            with timed("ocr_stage_seconds", "Этапы OCR", stage="download"):
+                file_info = bot.get_file(source.file_id)
+                downloaded_file = bot.download_file(file_info.file_path)
+            # Тот же файл мог прийти с другим file_unique_id — проверяем по содержимому
+            keys.append(content_key(downloaded_file))
+            result = ocr_results.get(keys[1])
+            if result is None:
+                text, notice = recognize_file(message, downloaded_file)
+                result = f"{text}{notice}" if text else ''
+            if result:
+                ocr_results.put(keys, result)
+
+        if not result:
+            result = '🧐 Не удалось распознать текст. Загрузите более чёткое изображение или PDF.'
+            # Выводим распознанный текст в консоль
+        print("📄 Результат OCR:\n", result)
 
-        for img in images:
-            # Предобработка изображения
-            processed_img = preprocess_image_for_ocr(img)
+        # Длинный текст уходит несколькими сообщениями, а не обрезается
+        outbox.send_long_message(message.chat.id, f"📄 Распознанный текст:\n\n{result}")
+    except Exception as e:
+        count_error("ocr", e)
+        outbox.send_message(message.chat.id, f"❌ Ошибка при обработке файла:\n{e}")
 
-            # OCR
-            text += pytesseract.image_to_string(processed_img, lang='rus+eng') + '\n'
 
-        text = text.strip()
-        if not text:
-            text = '🧐 Не удалось распознать текст. Загрузите более чёткое изображение или PDF.'
-            # Выводим распознанный текст в консоль
-        print("📄 Результат OCR:\n", text)
 
-        # Сохраняем изображение, поданное в Tesseract (для отладки)
-        try:
-            if images:
-                dbg_img = preprocess_image_for_ocr(images[0])
-                dbg_img.save(f"/tmp/ocr_debug_{int(time.time())}.png")
-        except Exception:
-            pass
 
-        bot.send_message(message.chat.id, f"📄 Распознанный текст:\n\n{text[:4000]}")
-    except Exception as e:
-        bot.send_message(message.chat.id, f"❌ Ошибка при обработке файла:\n{e}")
+# === Business Pro: анализ документа (map-reduce, см. doc_analysis.py) ===
+DOC_MIME_TYPES = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+}
+CB_BP_DOC_DONE = "bp_doc_done"
+doc_cache = OcrCache(DOC_CACHE_FILE, ttl=OCR_CACHE_TTL, max_bytes=DOC_CACHE_MB * 1024 * 1024)
+analyzer = DocumentAnalyzer(doc_cache, model=DOC_MAP_MODEL, chunk_tokens=DOC_CHUNK_TOKENS,
+                            reduce_tokens=DOC_REDUCE_TOKENS, concurrency=DOC_CONCURRENCY, max_chunks=DOC_MAX_CHUNKS)
+
+
+def doc_kind(document):
+    kind = DOC_MIME_TYPES.get(document.mime_type)
+    if kind is None and document.file_name:
+        kind = {"pdf": "pdf", "docx": "docx"}.get(document.file_name.rsplit(".", 1)[-1].lower())
+    return kind
+
+
+def document_session(chat_id):
+    # {"awaiting": True} — ждём файл; {"key", "name", ...} — отвечаем на вопросы по разобранному документу
+    session = store.get("documents", chat_id)
+    if session and time.time() - session.get("at", 0) > DOC_SESSION_TTL:
+        return None
+    return session
+
+
+def doc_done_keyboard():
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("✖️ Закончить с документом", callback_data=CB_BP_DOC_DONE))
+    return markup
+
+
+def llm_complete(chat_id):
+    # complete(system, user, model) для doc_analysis: частота уже проверена на весь разбор,
+    # токены всех шагов списываются пользователю — по модели, которая фактически ответила
+    priority = llm_priority(chat_id)
+
+    def complete(system, user, model):
+        messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
+        with llm.slot(chat_id, priority, rate_limited=False):
+            used_model, response = chat_completion(model, messages)
+        reply = response["choices"][0]["message"]["content"]
+        usage = response.get("usage") or {"prompt_tokens": prompt_tokens(messages, used_model),
+                                          "completion_tokens": count_tokens(reply, used_model)}
+        add_tokens_used(chat_id, usage["prompt_tokens"] + usage["completion_tokens"])
+        tokens_counter = metrics.counter("llm_tokens_total", "Токены по модели, которая фактически ответила")
+        tokens_counter.inc(usage["prompt_tokens"], model=used_model, kind="prompt")
+        tokens_counter.inc(usage["completion_tokens"], model=used_model, kind="completion")
+        return reply
+
+    return complete
 
 
+@bot.callback_query_handler(func=lambda call: call.data == CB_BP_DOC)
+def handle_bp_doc(call):
+    chat_id = str(call.message.chat.id)
+    bot.answer_callback_query(call.id)
+    store.set("documents", chat_id, {"awaiting": True, "at": time.time()})
+    outbox.send_message(chat_id, "📄 Пришлите документ PDF или DOCX.\nВ подписи к файлу можно сразу задать вопрос — "
+                                 "иначе сделаю общий анализ. Потом можно задавать уточняющие вопросы по документу.")
+
+
+@bot.callback_query_handler(func=lambda call: call.data == CB_BP_DOC_DONE)
+def handle_bp_doc_done(call):
+    chat_id = str(call.message.chat.id)
+    bot.answer_callback_query(call.id)
+    store.delete("documents", chat_id)
+    outbox.send_message(chat_id, "✅ Готово, возвращаемся к обычному диалогу.")
+
+
+def document_out_of_tokens(chat_id):
+    # Сжатие заметок остановлено по лимиту: готовые заметки в кеше, после продления продолжим
+    if check_access_and_notify(chat_id):
+        outbox.send_message(chat_id, "⛔ Не хватает лимита токенов на разбор документа. Пожалуйста, продлите подписку.")
+
+
+@timed("bot_handler_seconds", handler="analyze_document")
+def analyze_document(message, kind):
+    chat_id = str(message.chat.id)
+    if not check_access_and_notify(chat_id):
+        return
+    document = message.document
+    try:
+        llm.check_rate(chat_id, llm_priority(chat_id))
+        outbox.send_message(chat_id, "📄 Документ получен, анализирую…")
+        with timed("ocr_stage_seconds", "Этапы OCR", stage="download"):
+            data = bot.download_file(bot.get_file(document.file_id).file_path)
+        doc_key = analyzer.doc_key(content_key(data))
+
+        def pages():
+            # Постранично и лениво: следующая страница читается, пока модель разбирает предыдущие фрагменты
+            if kind == "pdf":
+                import ocr
+                for page_no, _, text in ocr.iter_pdf_text(data, dpi=OCR_DPI, max_pages=OCR_MAX_PAGES,
+                                                          workers=OCR_WORKERS, deskew=OCR_DESKEW,
+                                                          on_timings=observe_ocr_timings):
+                    yield page_no, text
+            else:
+                yield from iter_docx_pages(data)
+
+        def progress(done):
+            if done % DOC_PROGRESS_EVERY == 0:
+                outbox.send_message(chat_id, f"⏳ Разобрано фрагментов: {done}")
+
+        complete = llm_complete(chat_id)
+        # Доступ проверен один раз на весь разбор — фрагменты ограничены остатком токенов
+        notes, meta = analyzer.notes(doc_key, pages(), complete, on_progress=progress, budget=tokens_left(chat_id))
+        if not notes:
+            store.delete("documents", chat_id)
+            outbox.send_message(chat_id, "🧐 Не удалось извлечь текст из документа.")
+            return
+        if not check_access_and_notify(chat_id):
+            # Лимит кончился на заметках: они в кеше, после продления разбор продолжится с места остановки
+            return
+        name = document.file_name or ""
+        store.set("documents", chat_id, {"key": doc_key, "name": name, "pages": meta["pages"], "at": time.time()})
+        answer = analyzer.answer(doc_key, notes, message.caption, complete, get_model(chat_id), name,
+                                 budget=tokens_left(chat_id))
+    except OutOfTokens:
+        document_out_of_tokens(chat_id)
+        return
+    except (openai.error.OpenAIError, LLMBusyError, LLMRateLimited) as e:
+        count_error("doc_analysis", e)
+        outbox.send_message(chat_id, llm_error_text(e))
+        return
+    except Exception as e:
+        count_error("doc_analysis", e)
+        outbox.send_message(chat_id, f"❌ Ошибка при обработке файла:\n{e}")
+        return
+    if meta.get("out_of_tokens"):
+        answer += f"\n\n⚠️ Не хватило лимита токенов: разобраны первые {meta['pages']} стр."
+    elif meta.get("truncated"):
+        answer += f"\n\n⚠️ Документ большой: разобраны первые {meta['pages']} стр."
+    outbox.send_long_message(chat_id, answer, reply_markup=doc_done_keyboard())
+
+
+@timed("bot_handler_seconds", handler="answer_document_question")
+def answer_document_question(chat_id, question, session):
+    # Уточняющий вопрос: заметки берутся из кеша, заново выполняется только reduce
+    cached = analyzer.cached_notes(session["key"])
+    if cached is None:
+        store.delete("documents", chat_id)
+        outbox.send_message(chat_id, "⚠️ Документ больше не в кеше — пришлите файл ещё раз.")
+        return
+    try:
+        llm.check_rate(chat_id, llm_priority(chat_id))
+        answer = analyzer.answer(session["key"], cached[0], question, llm_complete(chat_id), get_model(chat_id),
+                                 session.get("name"), budget=tokens_left(chat_id))
+    except OutOfTokens:
+        document_out_of_tokens(chat_id)
+        return
+    except Exception as e:
+        count_error("doc_analysis", e)
+        outbox.send_message(chat_id, llm_error_text(e))
+        return
+    store.set("documents", chat_id, dict(session, at=time.time()))
+    outbox.send_long_message(chat_id, answer, reply_markup=doc_done_keyboard())
 
 
 # ===== Тарифы / меню =====
 # ===== Тарифы / меню =====
-@bot.message_handler(func=lambda msg: msg.text == "📄 Тарифы")
+@router.exact("📄 Тарифы")
 def handle_tariffs(message):
-    return_url = "https://t.me/NeiroMaxBot"
-    buttons = []
-    tariffs = [
-        ("GPT-3.5: Lite — 199₽", 199, "GPT-3.5 Lite"),
-        ("GPT-3.5: Pro — 299₽", 299, "GPT-3.5 Pro"),
-        ("GPT-3.5: Max — 399₽", 399, "GPT-3.5 Max"),
-        ("GPT-4o: Lite — 299₽", 299, "GPT-4o Lite"),
-        ("GPT-4o: Pro — 499₽", 499, "GPT-4o Pro"),
-        ("GPT-4o: Max — 999₽", 999, "GPT-4o Max"),
-        ("GPT-4o: Business Pro – 2000₽", 2000, "GPT-4o Business Pro"),
-    ]
+    # Клавиатура рисуется сразу, платёж создаётся только по нажатию
+    outbox.send_message(message.chat.id, "📦 Выберите тариф:", reply_markup=tariffs_keyboard())
 
-    bp_wip = False
-    for label, price, desc in tariffs:
-        # Business Pro — без оплаты, помечаем как "в разработке"
-        if "Business Pro" in desc:
-            bp_wip = True
-            continue
+    # Business Pro — без оплаты, помечаем как "в разработке"
+    outbox.send_message(
+        message.chat.id,
+        "🚧 GPT-4o: Business Pro находится в разработке. Оплата временно недоступна."
+    )
 
-        url = create_payment(price, desc, return_url, message.chat.id)
-        if url:
-            buttons.append(types.InlineKeyboardButton(f"💳 {label}", url=url))
 
-    markup = types.InlineKeyboardMarkup(row_width=1)
-    for btn in buttons:
-        markup.add(btn)
+@bot.callback_query_handler(func=lambda call: call.data.startswith(CB_TARIFF_PREFIX))
+@timed("bot_handler_seconds", handler="handle_tariff_choice")
+def handle_tariff_choice(call):
+    chat_id = call.message.chat.id
+    code = call.data[len(CB_TARIFF_PREFIX):]
+    if code not in TARIFFS_BY_CODE:
+        bot.answer_callback_query(call.id, "Тариф не найден")
+        return
+    bot.answer_callback_query(call.id, "⏳ Готовим ссылку на оплату...")
 
-    bot.send_message(message.chat.id, "📦 Выберите тариф:", reply_markup=markup)
+    label = TARIFFS_BY_CODE[code][0]
+    url = get_payment_link(chat_id, code)
+    if not url:
+        outbox.send_message(chat_id, "❌ Не удалось создать платёж. Попробуйте ещё раз чуть позже.")
+        return
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton(f"💳 Оплатить {label}", url=url))
+    outbox.send_message(chat_id, f"Тариф: <b>{label}</b>", reply_markup=markup, parse_mode="HTML")
 
-    if bp_wip:
-        bot.send_message(
-            message.chat.id,
-            "🚧 GPT-4o: Business Pro находится в разработке. Оплата временно недоступна."
-        )
 
 
+# Ожидание ввода после кнопки хранится в store, а не в памяти telebot (register_next_step_handler):
+# при нескольких процессах gunicorn ответ почти всегда приходит в другой процесс
+def expect_next_step(chat_id, step):
+    store.set("next_step", chat_id, {"step": step, "at": time.time()})
 
-@bot.message_handler(func=lambda msg: msg.text == "♻️ Сброс пробника")
+
+def pop_next_step(chat_id):
+    pending = store.get("next_step", chat_id)
+    if pending is None:
+        return None
+    store.delete("next_step", chat_id)
+    if time.time() - pending.get("at", 0) > NEXT_STEP_TTL:
+        return None
+    return NEXT_STEPS.get(pending.get("step"))
+
+
+@router.exact("♻️ Сброс пробника")
 def handle_reset_trial(message):
-    bot.send_message(message.chat.id, "Введи ID пользователя, которому сбросить пробный доступ (можно свой):")
-    bot.register_next_step_handler(message, reset_trial_by_id)
+    outbox.send_message(message.chat.id, "Введи ID пользователя, которому сбросить пробный доступ (можно свой):")
+    expect_next_step(message.chat.id, "reset_trial")
 
 def reset_trial_by_id(message):
     target_id = message.text.strip()
     if not target_id.isdigit():
-        bot.send_message(message.chat.id, "❌ Введи только цифры — это должен быть chat_id.")
+        outbox.send_message(message.chat.id, "❌ Введи только цифры — это должен быть chat_id.")
         return
-    if target_id in used_trials:
-        del used_trials[target_id]
-    trial_start_times.pop(target_id, None)
-    save_used_trials(used_trials)
-    bot.send_message(message.chat.id, f"✅ Пробный доступ сброшен для chat_id {target_id}.")
+    reset_trial(target_id)
+    outbox.send_message(message.chat.id, f"✅ Пробный доступ сброшен для chat_id {target_id}.")
+
 
-@bot.message_handler(func=lambda msg: msg.text == "💡 Сменить стиль")
+NEXT_STEPS = {"reset_trial": reset_trial_by_id}
+
+@router.exact("💡 Сменить стиль")
 def handle_change_style(message):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True)
     for mode in available_modes:
         markup.add(mode.capitalize())
     markup.add("📋 Главное меню")
-    bot.send_message(message.chat.id, "Выбери стиль общения:", reply_markup=markup)
+    outbox.send_message(message.chat.id, "Выбери стиль общения:", reply_markup=markup)
 
 
-@bot.message_handler(func=lambda msg: msg.text == "📘 Правила")
+@router.exact("📘 Правила")
 def handle_rules(message):
     rules_text = (
         "<b>Правила использования бота Neiro Max:</b>\n\n"
@@ -390,35 +1061,32 @@ def handle_rules(message):
         "• Ответы не являются истиной в последней инстанции.\n\n"
         "Спасибо, что выбрали Neiro Max!"
     )
-    bot.send_message(message.chat.id, rules_text, parse_mode="HTML")
-
+    outbox.send_message(message.chat.id, rules_text, parse_mode="HTML")
 
-@bot.message_handler(func=lambda msg: any(phrase in msg.text.lower() for phrase in [
-    "как тебя зовут", "твоё имя", "ты кто", "как звать", "называешься", "назови себя"
-]))
 
+@router.contains("как тебя зовут", "твоё имя", "ты кто", "как звать", "называешься", "назови себя")
 def handle_bot_name(message):
-    bot.send_message(message.chat.id, f"Я — {BOT_NAME}, твой персональный AI-ассистент 😉")
+    outbox.send_message(message.chat.id, f"Я — {BOT_NAME}, твой персональный AI-ассистент 😉")
 
 
 
-@bot.message_handler(func=lambda msg: msg.text == "📋 Главное меню")
+@router.exact("📋 Главное меню")
 def handle_main_menu(message):
-    bot.send_message(message.chat.id, "Главное меню:", reply_markup=main_menu(message.chat.id))
+    outbox.send_message(message.chat.id, "Главное меню:", reply_markup=main_menu(message.chat.id))
 
 
 
-@bot.message_handler(func=lambda msg: msg.text == "🚀 Запустить Neiro Max")
+@router.exact("🚀 Запустить Neiro Max")
 def handle_launch_neiro_max(message):
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "Готов к работе! Чем могу помочь?",
         reply_markup=main_menu(message.chat.id)
     )
 
-@bot.message_handler(func=lambda msg: msg.text == "📞 Поддержка")
+@router.exact("📞 Поддержка")
 def handle_support(message):
-    bot.send_message(
+    outbox.send_message(
         message.chat.id,
         "🛠 <b>Поддержка</b>\n\n"
         "Если возникли вопросы или проблемы, напишите разработчику:\n\n"
@@ -430,31 +1098,25 @@ def handle_support(message):
 
 
 
-@bot.message_handler(func=lambda msg: msg.text.lower() in [m.lower() for m in available_modes])
+@router.exact_ci(*available_modes)
 def handle_style_selection(message):
     chat_id = str(message.chat.id)
     selected = message.text.lower()
-    user_modes[chat_id] = selected
-    bot.send_message(chat_id, f"✅ Стиль общения изменён на: <b>{selected.capitalize()}</b>", parse_mode="HTML")
-@bot.message_handler(func=lambda msg: msg.text == "🚀 Запустить Neiro Max")
-def handle_launch(message):
-    chat_id = str(message.chat.id)
-
-    # Повторная инициализация (на всякий случай)
-    user_modes[message.chat.id] = "копирайтер"
-    user_histories[message.chat.id] = []
-    user_models[message.chat.id] = "gpt-3.5-turbo"
-    user_token_limits[message.chat.id] = 0
+    set_mode(chat_id, selected)
+    outbox.send_message(chat_id, f"✅ Стиль общения изменён на: <b>{selected.capitalize()}</b>", parse_mode="HTML")
 
-    bot.send_message(
-        message.chat.id,
-        "Готов к работе! Чем могу помочь? 😉",
-        reply_markup=main_menu(chat_id)
-    )
 
+# 🔒 Слова, не подходящие выбранному стилю (компилируются один раз)
+STYLE_FORBIDDEN = {
+    "копирайтер": ["психолог", "депресс", "поддерж", "тревож"],
+    "деловой": ["юмор", "шутк", "прикол"],
+    "гопник": ["академ", "научн", "профессор"],
+    "профессор": ["шутк", "гопник", "жиза"]
+}
+style_filter = StyleFilter(STYLE_FORBIDDEN)
 
 
-@bot.message_handler(func=lambda msg: True)
+@router.default
 def handle_prompt(message):
     chat_id = str(message.chat.id)
 
@@ -463,221 +1125,350 @@ def handle_prompt(message):
         return
 
     # ✅ Гарантируем, что старт пробника установлен
-    if chat_id not in trial_start_times:
-        trial_start_times[chat_id] = time.time()
-
-
-
-
-    # ✅ Проверка лимитов токенов и времени
-    tokens_used = user_token_limits.get(chat_id, 0)
-    time_elapsed = time.time() - trial_start_times[chat_id]
-    if time_elapsed > TRIAL_DURATION_SECONDS or tokens_used >= TRIAL_TOKEN_LIMIT:
-    # ⚠️ Уведомление о завершении пробника + кнопки с тарифами
-        return_url = "https://t.me/NeiroMaxBot"
-        buttons = []
-        tariffs = [
-            ("GPT-3.5: Lite — 199₽", 199, "GPT-3.5 Lite"),
-            ("GPT-3.5: Pro — 299₽", 299, "GPT-3.5 Pro"),
-            ("GPT-3.5: Max — 399₽", 399, "GPT-3.5 Max"),
-            ("GPT-4o: Lite — 299₽", 299, "GPT-4o Lite"),
-            ("GPT-4o: Pro — 499₽", 499, "GPT-4o Pro"),
-            ("GPT-4o: Max — 999₽", 999, "GPT-4o Max")
-        ]
-        for label, price, desc in tariffs:
-            url = create_payment(price, desc, return_url, chat_id)
-            if url:
-                buttons.append(types.InlineKeyboardButton(f"💳 {label}", url=url))
-        markup = types.InlineKeyboardMarkup(row_width=1)
-        for btn in buttons:
-            markup.add(btn)
-        bot.send_message(
-            chat_id,
-            "⛔ Пробный период завершён.\n\nВыберите тариф для продолжения работы:",
-            reply_markup=markup
-        )
+    ensure_trial_started(chat_id)
+
+    # 📄 Идёт работа с документом (Business Pro) — вопрос к нему, а не в обычный диалог
+    session = document_session(chat_id)
+    if session and session.get("key"):
+        answer_document_question(chat_id, message.text.strip(), session)
         return
+
     prompt = message.text.strip()
-    mode = user_modes.get(chat_id, "копирайтер")
-    model = user_models.get(chat_id, "gpt-3.5-turbo")
+    mode = get_mode(chat_id)
+    model = get_model(chat_id)
 
     # 🔒 Фильтрация по стилю
-    forbidden = {
-        "копирайтер": ["психолог", "депресс", "поддерж", "тревож"],
-        "деловой": ["юмор", "шутк", "прикол"],
-        "гопник": ["академ", "научн", "профессор"],
-        "профессор": ["шутк", "гопник", "жиза"]
-    }
-    if any(word in prompt.lower() for word in forbidden.get(mode, [])):
-        bot.send_message(chat_id, f"⚠️ Сейчас выбран стиль: <b>{mode.capitalize()}</b>.\nЗапрос не соответствует выбранному стилю.\nСначала измени стиль через кнопку 💡", parse_mode="HTML")
+    if style_filter.violation(mode, prompt):
+        outbox.send_message(chat_id, f"⚠️ Сейчас выбран стиль: <b>{mode.capitalize()}</b>.\nЗапрос не соответствует выбранному стилю.\nСначала измени стиль через кнопку 💡", parse_mode="HTML")
         return
 
-    # Загрузка истории
+    # Загрузка истории и обрезка под бюджет токенов модели
     history = load_history(chat_id)
-    messages = [{"role": "system", "content": available_modes[mode]}] + history + [{"role": "user", "content": prompt}]
-
+    system_msg = {"role": "system", "content": available_modes[mode]}
+    user_msg = with_tokens("user", prompt, model)
+    recent, recall = history, []
+    if mode in LONG_MEMORY_MODES:
+        # Вместо всей истории — сводка, последние ходы и найденное в долгой памяти
+        # (с hash-эмбеддингами найденное только дополняет историю)
+        head = history[:1] if history and is_summary(history[0]) else []
+        if LONG_MEMORY_REPLACES_HISTORY:
+            recent = head + history[len(head):][-LONG_MEMORY_RECENT:]
+        recall = list(filter(None, [recall_message(chat_id, prompt, recent[len(head):], model)]))
+    budget = (MODEL_PROMPT_BUDGETS.get(model, DEFAULT_PROMPT_BUDGET) - message_tokens(system_msg, model)
+              - message_tokens(user_msg, model) - sum(message_tokens(m, model) for m in recall) - TOKENS_PER_REPLY)
+    context, _ = fit_history(recent, max(0, budget), model)
+    messages = [system_msg] + recall + context + [user_msg]
+    # Экономия от сводки: сколько токенов заняли бы свёрнутые ходы, минус сама сводка
+    metrics.counter("prompt_tokens_total", "Токены промпта, отправленные в OpenAI").inc(
+        prompt_tokens(messages, model), model=model)
+    metrics.counter("prompt_tokens_saved_total", "Токены промпта, сэкономленные сводкой истории").inc(
+        saved_tokens(context), model=model)
+
+    stream = None
+    cache_key = response_cache_key(prompt, mode, model, history)
+    cached = response_cache.get(cache_key) if cache_key else None
     try:
-        response = openai.ChatCompletion.create(model=model, messages=messages)
-        reply = response["choices"][0]["message"]["content"].strip()
+        if cached:
+            reply, usage = cached
+        else:
+            if STREAM_REPLIES:
+                # Плейсхолдер сразу (ещё до очереди), дальше дописываем его по мере прихода токенов
+                stream = StreamingReply(outbox.blocking, chat_id, edit_interval=STREAM_EDIT_INTERVAL).start()
+            started = time.perf_counter()
+            with llm.slot(chat_id, llm_priority(chat_id)):
+                used_model, result = chat_completion(model, messages, stream=bool(stream))
+                if stream:
+                    for chunk in result:
+                        stream.feed(chunk["choices"][0]["delta"].get("content", ""))
+                    reply = stream.text.strip()
+                    # В потоковом режиме API не возвращает usage — считаем сами
+                    usage = {"prompt_tokens": prompt_tokens(messages, used_model),
+                             "completion_tokens": count_tokens(reply, used_model)}
+                else:
+                    reply = result["choices"][0]["message"]["content"].strip()
+                    usage = result.get("usage") or {"prompt_tokens": prompt_tokens(messages, used_model),
+                                                    "completion_tokens": count_tokens(reply, used_model)}
+            metrics.histogram("openai_request_seconds", "Запросы к OpenAI (со всеми повторами)").observe(
+                time.perf_counter() - started, model=used_model, stream="true" if stream else "false")
+            usage = dict(usage, model=used_model)
     except Exception as e:
-        bot.send_message(chat_id, f"Ошибка: {e}")
+        if stream:
+            stream.fail(llm_error_text(e))
+        else:
+            outbox.send_message(chat_id, llm_error_text(e))
         return
+    used_model = usage.get("model", model)
+    if cache_key and not cached and reply and used_model == model:
+        response_cache.set(cache_key, (reply, usage))
+
+    # ✅ Списываем реальные токены (запрос + ответ) и сохраняем историю
+    add_tokens_used(chat_id, usage["prompt_tokens"] + usage["completion_tokens"])
+    tokens_counter = metrics.counter("llm_tokens_total", "Токены по модели, которая фактически ответила")
+    tokens_counter.inc(usage["prompt_tokens"], model=used_model, kind="prompt")
+    tokens_counter.inc(usage["completion_tokens"], model=used_model, kind="completion")
+    assistant_msg = with_tokens("assistant", reply, used_model)
+    append_history(chat_id, user_msg, assistant_msg)
+    # В индекс — по словам пользователя (в них факты о нём), в промпт потом попадает весь ход
+    vector_memory.add(chat_id, f"Пользователь: {prompt}\nАссистент: {reply}", key=prompt)
+    # Длинная история — свернуть старые ходы в сводку (в фоне, ответ не ждёт)
+    summarizer.maybe_schedule(chat_id, model, history + [user_msg, assistant_msg])
+
+    if stream:
+        stream.finish(reply_markup=format_buttons())
+    else:
+        outbox.send_message(chat_id, reply, reply_markup=format_buttons())
+
+@bot.message_handler(content_types=['text'])
+def route_text_message(message):
+    # Единственный текстовый хендлер telebot: кнопки — dict, фразы — один regex.
+    # Ждём ввода после кнопки — сообщение уходит туда
+    handler = pop_next_step(message.chat.id) or router.resolve(message.text)
+    if handler is not None:
+        with timed("bot_handler_seconds", handler=handler.__name__):
+            handler(message)
+
+
+# === Экспорт в PDF/Word с кешем по версии истории ===
+# (формат, имя файла, функция из export.py) — сам модуль с reportlab/python-docx импортируется лениво
+EXPORT_FORMATS = {
+    "save_pdf": ("pdf", "neiro_max_output.pdf", "render_pdf"),
+    "save_word": ("docx", "neiro_max_output.docx", "render_docx"),
+}
+# (chat_id, версия истории, формат) -> {"data": bytes, "file_id": str}
+export_cache = TTLCache(maxsize=EXPORT_CACHE_SIZE, ttl=EXPORT_CACHE_TTL)
 
-    # ✅ Сохраняем токены и историю
-    user_token_limits[chat_id] = tokens_used + len(prompt)
-    history.append({"role": "user", "content": prompt})
-    history.append({"role": "assistant", "content": reply})
-    save_history(chat_id, history)
-
-    bot.send_message(chat_id, reply, reply_markup=format_buttons())
 
-@bot.callback_query_handler(func=lambda call: call.data in ["save_pdf", "save_word"])
+@bot.callback_query_handler(func=lambda call: call.data in EXPORT_FORMATS)
+@timed("bot_handler_seconds", handler="handle_file_format")
 def handle_file_format(call):
     chat_id = call.message.chat.id
-    history = load_history(str(chat_id))
-    text = "\n".join(m["content"] for m in history if m["role"] != "system")
-    if call.data == "save_pdf":
-        pdf_bytes = BytesIO()
-        pdf = canvas.Canvas(pdf_bytes)
-        y = 800
-        for line in text.split("\n"):
-            pdf.drawString(40, y, line)
-            y -= 15
-        pdf.save()
-        pdf_bytes.seek(0)
-        bot.send_document(chat_id, ("neiro_max_output.pdf", pdf_bytes))
+    import export
+    fmt, filename, render_name = EXPORT_FORMATS[call.data]
+    render = getattr(export, render_name)
+    bot.answer_callback_query(call.id)
+
+    key = (str(chat_id), histories.version(chat_id), fmt)
+    cached = export_cache.get(key)
+    if cached and cached.get("file_id"):
+        # Файл уже лежит у Telegram — отправляем по file_id, без повторной загрузки
+        try:
+            outbox.blocking.send_document(chat_id, cached["file_id"])
+            return
+        except ApiTelegramException as e:
+            print(f"[export] file_id устарел, отправляем заново: {e}")
+
+    if cached:
+        data = cached["data"]
     else:
-        doc = Document()
-        doc.add_paragraph(text)
-        word_bytes = BytesIO()
-        doc.save(word_bytes)
-        word_bytes.seek(0)
-        bot.send_document(chat_id, ("neiro_max_output.docx", word_bytes))
-
-print("🤖 Neiro Max запущен.")
+        out = BytesIO()
+        with timed("export_render_seconds", "Рендер PDF/DOCX", format=fmt):
+            render(export.export_paragraphs(load_history(chat_id)), out)
+        data = out.getvalue()
+
+    sent = outbox.blocking.send_document(chat_id, (filename, BytesIO(data)))
+    file_id = sent.document.file_id if sent and sent.document else None
+    export_cache.set(key, {"data": data, "file_id": file_id})
+
+# === Очередь входящих апдейтов ===
+def update_chat_key(update):
+    # Ключ очереди: chat_id, чтобы апдейты одного чата шли по порядку
+    for attr in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = getattr(update, attr, None)
+        if msg is not None:
+            return msg.chat.id
+    call = update.callback_query
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    return update.update_id
+
+
+UPDATE_TYPES = ("message", "edited_message", "callback_query", "channel_post", "edited_channel_post",
+                "my_chat_member", "chat_member", "pre_checkout_query", "inline_query")
+
+
+def update_type(update):
+    for attr in UPDATE_TYPES:
+        if getattr(update, attr, None) is not None:
+            return attr
+    return "other"
+
+
+# Несколько процессов: апдейты одного чата могут прийти в разные процессы — не выполняем их одновременно
+chat_locks = ChatFileLocks(os.path.join(MEMORY_DIR, ".chat_locks")) if MULTI_WORKER else None
+
+
+def process_update(update):
+    metrics.counter("bot_updates_total", "Входящие апдейты по типу").inc(type=update_type(update))
+    try:
+        with chat_locks.hold(update_chat_key(update)) if chat_locks else nullcontext():
+            bot.process_new_updates([update])
+    except Exception as e:
+        count_error("update", e)
+        raise
+
+
+update_pool = ChatWorkerPool(process_update, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE, name="update")
+# Сроки подписок: куча по expires_at, уведомления уходят по времени, а не при следующем сообщении
+expiry = ExpiryScheduler(store, notify_expiring, notify_expired, warn_before=EXPIRY_WARN_BEFORE,
+                         rescan_interval=EXPIRY_RESCAN_INTERVAL).start()
+# Платёжные уведомления: запись с дедупликацией по id платежа + фоновая активация
+payment_events = PaymentEvents(store, activate_payment).start()
+
+# Глубина очередей снимается в момент запроса /metrics
+metrics.gauge("update_queue_depth", update_pool.depth, "Апдейты в очереди на обработку")
+metrics.gauge("outbox_queue_depth", outbox.depth, "Сообщения в исходящей очереди")
+metrics.gauge("llm_running", lambda: llm.stats()["running"], "Запросы к OpenAI в работе")
+metrics.gauge("payment_queue_depth", payment_events.depth, "Платёжные события в очереди")
+metrics.gauge("expiry_scheduled", expiry.size, "Запланированные уведомления о сроке подписки")
+metrics.gauge("llm_queued", lambda: llm.stats()["queued"], "Запросы к OpenAI в ожидании слота")
+
+# === Отложенный старт: регистрация вебхука и прогрев тяжёлых модулей ===
+# Выполняются в фоне, когда сервер уже принимает запросы, — импорт bot_main не ходит в сеть
+def ensure_webhook():
+    # Идемпотентно: setWebhook только если URL или секрет поменялись (отпечаток хранится в store)
+    if not WEBHOOK_URL:
+        return
+    fingerprint = hashlib.sha256(f"{WEBHOOK_URL}|{WEBHOOK_SECRET or ''}".encode()).hexdigest()
+    try:
+        if bot.get_webhook_info().url == WEBHOOK_URL and store.get("meta", "webhook") == fingerprint:
+            print("🔗 Вебхук уже установлен, пропускаем")
+            return
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        store.set("meta", "webhook", fingerprint)
+        print(f"🔗 Вебхук установлен: {WEBHOOK_URL}")
+    except Exception as e:
+        count_error("webhook_setup", e)
+        print(f"❌ Не удалось установить вебхук: {e}")
+
+
+def warmup():
+    ensure_webhook()
+    if not WARMUP:
+        return
+    started = time.perf_counter()
+    import ocr
+    import export
+    export.pdf_font()
+    print(f"🔥 OCR и экспорт прогреты за {time.perf_counter() - started:.2f} с")
+
+
+warmup_timer = threading.Timer(WARMUP_DELAY, warmup)
+warmup_timer.daemon = True
+warmup_timer.start()
+
+BOOT_READY = time.perf_counter()
+print(f"🤖 Neiro Max запущен за {BOOT_READY - BOOT_STARTED:.2f} с.")
 app = Flask(__name__)
+startup = {"import": BOOT_READY - BOOT_STARTED}
+metrics.gauge("startup_seconds", lambda: {(("phase", phase),): seconds for phase, seconds in startup.items()},
+              "Холодный старт: импорт bot_main и первый запрос")
+
+
+if MULTI_WORKER:
+    # /metrics складывает снимки всех процессов; /stats/* — только ответивший процесс (см. X-Worker-Pid)
+    metrics.enable_multiprocess(METRICS_DIR)
+
+
+@app.after_request
+def add_worker_pid(response):
+    if MULTI_WORKER:
+        response.headers["X-Worker-Pid"] = str(os.getpid())
+    return response
+
+
+@app.before_request
+def report_first_request():
+    if "first_request" in startup:
+        return
+    startup["first_request"] = time.perf_counter() - BOOT_STARTED
+    if STARTUP_PROFILE:
+        print(f"⏱️ Первый запрос через {startup['first_request']:.3f} с после старта "
+              f"(импорт и инициализация {startup['import']:.3f} с)")
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    if request.headers.get("content-type") == "application/json":
-        json_string = request.get_data().decode("utf-8")
-        update = types.Update.de_json(json_string)
-        bot.process_new_updates([update])
-        return "!", 200
-    else:
+    if request.headers.get("content-type") != "application/json":
         return "Invalid content type", 403
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return "Forbidden", 403
+    try:
+        update = types.Update.de_json(request.get_data().decode("utf-8"))
+    except Exception as e:
+        print(f"[webhook] Некорректный апдейт: {e}")
+        return "Bad update", 400
+    if update is None:
+        return "Bad update", 400
 
-@app.route("/yookassa/webhook", methods=["POST"])
-def yookassa_webhook():
-    data = request.json
-    
+    # Кладём в очередь и сразу отвечаем; при переполнении — 503, Telegram повторит позже
+    if not update_pool.submit(update_chat_key(update), update, timeout=WEBHOOK_ENQUEUE_TIMEOUT):
+        print(f"[webhook] Очередь переполнена ({update_pool.depth()}), апдейт {update.update_id} отклонён")
+        return "Busy", 503
+    return "!", 200
 
-    # Проверяем статус
-    if data.get("object", {}).get("status") == "succeeded":
-        description = data.get("object", {}).get("description", "")
-        payment_id = data.get("object", {}).get("id")
 
-        # Получаем chat_id из описания
-        try:
-            parts = description.split(":")
-            chat_id = int(parts[1])
-            tariff = parts[2]
+@app.route("/webhook/stats", methods=["GET"])
+def webhook_stats():
+    return jsonify(update_pool.stats())
 
-            # Устанавливаем модель
-            if "gpt-4" in tariff.lower():
-                user_models[str(chat_id)] = "gpt-4o"
-            else:
-                user_models[str(chat_id)] = "gpt-3.5-turbo"
-
-            # Устанавливаем срок подписки (например, 30 дней)
-            now = int(time.time())
-            subscriptions_file = "subscriptions.json"
-            if os.path.exists(subscriptions_file):
-                with open(subscriptions_file, "r", encoding="utf-8") as f:
-                    subscriptions = json.load(f)
-            else:
-                subscriptions = {}
 
-            subscriptions[str(chat_id)] = {
-                "model": user_models[str(chat_id)],
-                "activated_at": now,
-                "expires_at": now + 30 * 24 * 60 * 60,
-                "token_limit": 100000,
-                "warned": False
-            }
+@app.route("/stats/outbox", methods=["GET"])
+def outbox_stats():
+    return jsonify(outbox.stats())
 
-            with open(subscriptions_file, "w", encoding="utf-8") as f:
-                json.dump(subscriptions, f, ensure_ascii=False, indent=2)
 
-            # Уведомляем пользователя
-            bot.send_message(chat_id, f"✅ Оплата прошла успешно! Вам активирован тариф: *{tariff}*", parse_mode="Markdown")
+@app.route("/stats/llm", methods=["GET"])
+def llm_stats():
+    return jsonify(dict(llm.stats(), latency={"first_token": latency[True].stats(), "response": latency[False].stats()}))
 
-        except Exception as e:
-            print(f"[webhook error] Ошибка при обработке описания: {e}")
-
-    if data.get('event') == 'payment.succeeded':
-        obj = data['object']
-        description = obj.get("description", "")
-        metadata = obj.get("metadata", {})
-        chat_id = metadata.get("chat_id")
-
-        if not chat_id:
-            return jsonify({"status": "chat_id missing"})
-
-        # Определяем модель
-        if "GPT-3.5" in description:
-            model = "gpt-3.5-turbo"
-        elif "GPT-4" in description:
-            model = "gpt-4o"
-        else:
-            return jsonify({"status": "unknown model"})
-
-        # 🔐 Защита от повторной отправки
-        if chat_id in user_models:
-            print(f"[Webhook] Модель уже активирована для chat_id={chat_id}")
-            return jsonify({"status": "already activated"})
-
-        # ✅ Активируем модель
-        user_models[chat_id] = model
-                # 🎯 Назначение лимита токенов по тарифу
-        token_limits = {
-            "GPT-3.5 Lite": 50000,
-            "GPT-3.5 Pro": 100000,
-            "GPT-3.5 Max": 1000000,
-            "GPT-4o Lite": 30000,
-            "GPT-4o Pro": 60000,
-            "GPT-4o Max": 1000000
-        }
-        token_limit = token_limits.get(description, 100000)
-
-        # 🗓️ Запись срока действия тарифа (30 дней)
-        subscription_file = "subscriptions.json"
-        try:
-            if os.path.exists(subscription_file):
-                with open(subscription_file, "r", encoding="utf-8") as f:
-                    subscriptions = json.load(f)
-            else:
-                subscriptions = {}
 
-            expires_at = int(time.time()) + 30 * 86400  # 30 дней вперёд
-            subscriptions[str(chat_id)] = {
-                "expires_at": expires_at,
-                "warned": False,
-                "token_limit": token_limit
-            }
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
-            with open(subscription_file, "w", encoding="utf-8") as f:
-                json.dump(subscriptions, f, indent=2)
 
-            print(f"[YooKassa] Подписка активирована для {chat_id} до {expires_at}")
-        except Exception as e:
-            print(f"[Ошибка записи подписки]: {e}")
+@app.route("/stats/cache", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "response": response_cache.stats(),
+        "payment_links": payment_links.stats(),
+        "history": histories.stats(),
+        "summaries": summarizer.stats(),
+        "long_memory": vector_memory.stats(),
+        "ocr": ocr_results.stats(),
+        "documents": doc_cache.stats(),
+        "export": export_cache.stats(),
+    })
 
-        bot.send_message(chat_id, f"✅ Оплата прошла успешно!\nАктивирован тариф: <b>{description}</b>", parse_mode="HTML")
-        return jsonify({"status": "ok"})
+@app.route("/yookassa/webhook", methods=["POST"])
+def yookassa_webhook():
+    # Только запись события и сразу 200 — активация в фоне (payment_events), повторы ЮKassa не плодят работу
+    data = request.get_json(silent=True) or {}
+    obj = data.get("object") or {}
+    if data.get("event", "payment.succeeded") != "payment.succeeded" or obj.get("status") != "succeeded":
+        return jsonify({"status": "ignored"})
+    payment_id = obj.get("id")
+    if not payment_id:
+        print(f"[YooKassa] Уведомление без id платежа: {data}")
+        return jsonify({"status": "ignored"})
 
-    return jsonify({"status": "ignored"})
+    try:
+        created = payment_events.submit(payment_id, obj)
+    except PaymentStoreError:
+        # Не подтверждаем: ЮKassa повторит уведомление, повтор заново попробует записать событие
+        print(f"[YooKassa] Платёж {payment_id} не сохранён на диск, отвечаем 503")
+        return jsonify({"status": "retry"}), 503
+    if not created:
+        print(f"[YooKassa] Повторное уведомление о платеже {payment_id}")
+        return jsonify({"status": "duplicate"})
+    return jsonify({"status": "accepted"})
 
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+@app.route("/stats/payments", methods=["GET"])
+def payments_stats():
+    return jsonify(payment_events.stats())
+
+
+@app.route("/stats/expiry", methods=["GET"])
+def expiry_stats():
+    return jsonify(expiry.stats())
+
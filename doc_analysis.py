@@ -0,0 +1,230 @@
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from metrics import counter, timed
+from tokens import count_tokens
+
+# === Анализ документов (Business Pro «Анализ документа») ===
+# Map-reduce: текст читается постранично (PDF — ocr.iter_pdf_text, DOCX — iter_docx_pages),
+# режется на фрагменты не больше chunk_tokens токенов; по каждому фрагменту дешёвая
+# модель пишет заметки (не больше concurrency запросов одного документа одновременно),
+# затем заметки сводятся в ответ на вопрос пользователя. Заметки не зависят от вопроса
+# и кешируются по хешу документа, как и сжатые (MERGE) заметки длинного документа —
+# уточняющие вопросы выполняют только шаг reduce.
+# budget — сколько токенов пользователь ещё может потратить: фрагменты перестают
+# отправляться, когда оценка расхода его исчерпала (перерасход — не больше одной волны запросов).
+
+MAP_PROMPT = ("Ты анализируешь фрагмент документа. Выпиши кратко и по пунктам всё существенное: суть, стороны, "
+              "суммы, даты и сроки, обязательства, условия, риски. Только то, что есть в тексте, без вступлений.")
+MERGE_PROMPT = ("Объедини заметки по частям документа в более короткие, сохранив все факты, цифры, даты "
+                "и номера страниц. Без вступлений.")
+REDUCE_PROMPT = ("Ты — аналитик документов. Отвечай на основе заметок по документу, ссылайся на страницы "
+                 "(«стр. 3»). Если в заметках нет ответа — так и скажи.")
+DEFAULT_TASK = ("Сделай структурированный анализ документа: о чём он, ключевые условия, суммы и сроки, "
+                "обязательства сторон, риски и на что обратить внимание.")
+
+
+class OutOfTokens(Exception):
+    # Лимит токенов пользователя кончился посреди сжатия заметок
+    pass
+
+
+def iter_docx_pages(data, page_chars=3000):
+    # У DOCX нет страниц: абзацы и строки таблиц по порядку, «страница» — около page_chars символов
+    from docx import Document
+    document = Document(BytesIO(data))
+    blocks = document.iter_inner_content() if hasattr(document, "iter_inner_content") else document.paragraphs
+    page, size, page_no = [], 0, 1
+    for block in blocks:
+        if hasattr(block, "rows"):
+            lines = [" | ".join(cell.text.strip() for cell in row.cells) for row in block.rows]
+        else:
+            lines = [block.text]
+        for line in filter(None, (line.strip() for line in lines)):
+            page.append(line)
+            size += len(line)
+            if size >= page_chars:
+                yield page_no, "\n".join(page)
+                page, size, page_no = [], 0, page_no + 1
+    if page:
+        yield page_no, "\n".join(page)
+
+
+def _split_page(text, max_tokens, model):
+    # Страница больше фрагмента — режем по строкам (сверхдлинную строку — по символам)
+    if count_tokens(text, model) <= max_tokens:
+        yield text
+        return
+    max_chars = max_tokens * 3
+    buf, tokens = [], 0
+    for line in text.splitlines():
+        for start in range(0, max(len(line), 1), max_chars):
+            piece = line[start:start + max_chars]
+            cost = count_tokens(piece, model) + 1
+            if buf and tokens + cost > max_tokens:
+                yield "\n".join(buf)
+                buf, tokens = [], 0
+            buf.append(piece)
+            tokens += cost
+    if buf:
+        yield "\n".join(buf)
+
+
+def iter_chunks(pages, max_tokens=2500, model="gpt-3.5-turbo"):
+    # (номер страницы, текст) -> (первая страница, последняя страница, текст не длиннее max_tokens)
+    buf, tokens, first, last = [], 0, None, None
+    for page_no, text in pages:
+        text = (text or "").strip()
+        if not text:
+            continue
+        for piece in _split_page(text, max_tokens, model):
+            cost = count_tokens(piece, model) + 1
+            if buf and tokens + cost > max_tokens:
+                yield first, last, "\n".join(buf)
+                buf, tokens, first = [], 0, None
+            if first is None:
+                first = page_no
+            last = page_no
+            buf.append(piece)
+            tokens += cost
+    if buf:
+        yield first, last, "\n".join(buf)
+
+
+def page_label(first, last):
+    return f"стр. {first}" if first == last else f"стр. {first}–{last}"
+
+
+class DocumentAnalyzer:
+    def __init__(self, cache, model="gpt-3.5-turbo", chunk_tokens=2500, reduce_tokens=6000, concurrency=4,
+                 max_chunks=80, workers=8, note_tokens=500):
+        self.cache = cache              # OcrCache: ключ -> текст (заметки и сведения о документе)
+        self.model = model              # модель для заметок по фрагментам (map)
+        self.chunk_tokens = chunk_tokens
+        self.reduce_tokens = reduce_tokens
+        self.concurrency = concurrency  # одновременных запросов на один документ
+        self.max_chunks = max_chunks
+        self.note_tokens = note_tokens  # оценка длины заметки — для расчёта расхода токенов
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="doc")
+
+    def doc_key(self, content_hash):
+        # Заметки зависят от модели и размера фрагмента — при их смене документ разбирается заново
+        return f"doc:{content_hash}:{self.model}:{self.chunk_tokens}"
+
+    # --- Map ---
+    def cached_notes(self, doc_key):
+        # -> (заметки, сведения о документе) или None, если документ разобран не полностью
+        meta = self.cache.get(doc_key + ":meta")
+        if meta is None:
+            return None
+        meta = json.loads(meta)
+        notes = []
+        for idx in range(meta["chunks"]):
+            note = self.cache.get(f"{doc_key}:{idx}")
+            if note is None:
+                return None
+            notes.append(note)
+        return notes, meta
+
+    def _note(self, doc_key, idx, first, last, text, complete):
+        note = complete(MAP_PROMPT, f"Фрагмент ({page_label(first, last)}):\n{text}", self.model).strip()
+        note = f"[{page_label(first, last)}]\n{note}"
+        self.cache.put([f"{doc_key}:{idx}"], note)
+        return note
+
+    def _cost(self, prompt, text):
+        # Оценка токенов на одну заметку: промпт + текст + ответ
+        return count_tokens(prompt, self.model) + count_tokens(text, self.model) + self.note_tokens
+
+    @timed("doc_analysis_seconds", "Этапы анализа документа", stage="map")
+    def notes(self, doc_key, pages, complete, on_progress=None, budget=None):
+        # pages — итератор (номер страницы, текст); читается лениво, вместе с отправкой фрагментов в модель.
+        # complete(system, user, model) -> текст. -> (заметки, сведения о документе)
+        # Разбор, остановленный по budget (out_of_tokens), из кеша не отдаётся: продолжится с места остановки
+        cached = self.cached_notes(doc_key)
+        if cached is not None and not cached[1].get("out_of_tokens"):
+            counter("doc_analysis_total", "Разборы документов").inc(cache="hit")
+            return cached
+        counter("doc_analysis_total", "Разборы документов").inc(cache="miss")
+        notes, pending, spent = [], deque(), 0
+        meta = {"chunks": 0, "pages": 0, "truncated": False, "out_of_tokens": False}
+
+        def collect():
+            _, future = pending.popleft()
+            notes.append(future.result() if hasattr(future, "result") else future)
+            if on_progress:
+                on_progress(len(notes))
+
+        try:
+            for idx, (first, last, text) in enumerate(iter_chunks(pages, self.chunk_tokens, self.model)):
+                if idx >= self.max_chunks:
+                    meta["truncated"] = True
+                    break
+                note = self.cache.get(f"{doc_key}:{idx}")  # часть фрагментов могла остаться от прерванного разбора
+                if note is None:
+                    if budget is not None and spent >= budget:
+                        meta["truncated"] = meta["out_of_tokens"] = True
+                        break
+                    spent += self._cost(MAP_PROMPT, text)
+                    note = self._executor.submit(self._note, doc_key, idx, first, last, text, complete)
+                meta["chunks"], meta["pages"] = idx + 1, last
+                pending.append((idx, note))
+                while len(pending) >= self.concurrency:
+                    collect()
+            while pending:
+                collect()
+        finally:
+            for _, future in pending:
+                if hasattr(future, "cancel"):
+                    future.cancel()
+        self.cache.put([doc_key + ":meta"], json.dumps(meta))
+        return notes, meta
+
+    # --- Reduce ---
+    def _merge(self, notes, complete, budget=None):
+        # Заметок больше, чем влезает в один запрос, — сжимаем группами (не больше concurrency запросов
+        # одновременно), пока не влезут. budget — как в notes(); кончился — OutOfTokens
+        spent = 0
+        while len(notes) > 1 and count_tokens("\n\n".join(notes), self.model) > self.reduce_tokens:
+            groups, group, size = [], [], 0
+            for note in notes:
+                cost = count_tokens(note, self.model)
+                if group and size + cost > self.reduce_tokens:
+                    groups.append(group)
+                    group, size = [], 0
+                group.append(note)
+                size += cost
+            groups.append(group)
+            if len(groups) == len(notes):
+                break  # каждая заметка сама по себе больше бюджета — дальше не сожмём
+            merged = []
+            for start in range(0, len(groups), self.concurrency):
+                if budget is not None and spent >= budget:
+                    raise OutOfTokens()
+                wave = ["\n\n".join(group) for group in groups[start:start + self.concurrency]]
+                spent += sum(self._cost(MERGE_PROMPT, text) for text in wave)
+                merged.extend(self._executor.map(lambda text: complete(MERGE_PROMPT, text, self.model).strip(), wave))
+            notes = merged
+        return notes
+
+    def merged_notes(self, doc_key, notes, complete, budget=None):
+        # Сжатые заметки от вопроса не зависят — кешируются рядом с заметками по фрагментам
+        key = doc_key + ":merged"
+        cached = self.cache.get(key)
+        if cached is not None:
+            cached = json.loads(cached)
+            if cached["chunks"] == len(notes):
+                return cached["notes"]
+        merged = self._merge(list(notes), complete, budget)
+        if merged != notes:
+            self.cache.put([key], json.dumps({"chunks": len(notes), "notes": merged}, ensure_ascii=False))
+        return merged
+
+    @timed("doc_analysis_seconds", "Этапы анализа документа", stage="reduce")
+    def answer(self, doc_key, notes, question, complete, model, name="", budget=None):
+        notes = self.merged_notes(doc_key, notes, complete, budget)
+        title = f" «{name}»" if name else ""
+        return complete(REDUCE_PROMPT, f"Заметки по документу{title}:\n\n" + "\n\n".join(notes)
+                        + f"\n\nЗадание: {question or DEFAULT_TASK}", model).strip()
@@ -0,0 +1,135 @@
+import heapq
+import threading
+import time
+
+# === Планировщик окончания подписок ===
+# Куча (время срабатывания, тип, chat_id, expires_at):
+#   "warn"   — за warn_before до конца подписки (предупреждение «тариф заканчивается»);
+#   "expire" — в момент окончания.
+# Продление не требует удаления из кучи: при срабатывании запись сверяется с текущим
+# expires_at подписки, устаревшие пропускаются. Всё, что наступило к моменту пробуждения,
+# обрабатывается одной пачкой. Отметка warned/expired_notified ставится атомарно через
+# store.update — при нескольких процессах уведомление уходит один раз.
+
+WARN = "warn"
+EXPIRE = "expire"
+FLAGS = {WARN: "warned", EXPIRE: "expired_notified"}
+
+
+class ExpiryScheduler:
+    def __init__(self, store, on_warn, on_expire, bucket="subscriptions", warn_before=86400, batch_size=500,
+                 rescan_interval=3600):
+        self.store = store
+        self.on_warn = on_warn        # fn(список chat_id)
+        self.on_expire = on_expire    # fn(список chat_id)
+        self.bucket = bucket
+        self.warn_before = warn_before
+        self.batch_size = batch_size
+        self.rescan_interval = rescan_interval
+        self.warned = 0
+        self.expired = 0
+        self._heap = []
+        self._cond = threading.Condition()
+        self._next_rescan = 0
+        self._thread = None
+
+    def start(self):
+        self.rescan()
+        self._thread = threading.Thread(target=self._run, name="expiry", daemon=True)
+        self._thread.start()
+        return self
+
+    # --- Планирование ---
+    def _entries(self, chat_id, sub):
+        expires_at = (sub or {}).get("expires_at")
+        if not expires_at:
+            return []
+        # Давно истёкшие (например, при первом запуске на старых данных) не будим уведомлениями
+        now = time.time()
+        entries = []
+        if not sub.get("warned") and expires_at > now:
+            entries.append((expires_at - self.warn_before, WARN, str(chat_id), expires_at))
+        if not sub.get("expired_notified") and expires_at > now - self.warn_before:
+            entries.append((expires_at, EXPIRE, str(chat_id), expires_at))
+        return entries
+
+    def schedule(self, chat_id, sub):
+        # Новая или продлённая подписка; старые записи в куче отсеются при срабатывании
+        entries = self._entries(chat_id, sub)
+        if not entries:
+            return
+        with self._cond:
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+            self._cond.notify()
+
+    def rescan(self):
+        # Полная пересборка кучи: подхватывает подписки, активированные другими процессами
+        heap = []
+        for chat_id, sub in self.store.items(self.bucket).items():
+            heap.extend(self._entries(chat_id, sub))
+        heapq.heapify(heap)
+        with self._cond:
+            self._heap = heap
+            self._next_rescan = time.time() + self.rescan_interval
+            self._cond.notify()
+
+    def size(self):
+        with self._cond:
+            return len(self._heap)
+
+    def stats(self):
+        with self._cond:
+            return {"scheduled": len(self._heap), "next_at": self._heap[0][0] if self._heap else None,
+                    "warned": self.warned, "expired": self.expired}
+
+    # --- Срабатывание ---
+    def _claim(self, kind, chat_id, expires_at):
+        # Отметка ставится, только если подписка не продлена и уведомление ещё не отправлено
+        flag = FLAGS[kind]
+        claimed = []
+
+        def mark(sub):
+            if sub and sub.get("expires_at") == expires_at and not sub.get(flag):
+                sub[flag] = True
+                claimed.append(True)
+            return sub
+
+        if self.store.get(self.bucket, chat_id) is not None:
+            self.store.update(self.bucket, chat_id, mark)
+        return bool(claimed)
+
+    def _take_due(self):
+        # Под self._cond: ждём ближайшего срока и забираем всё наступившее (не больше batch_size)
+        while True:
+            now = time.time()
+            if now >= self._next_rescan:
+                return None
+            if self._heap and self._heap[0][0] <= now:
+                batch = []
+                while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                    batch.append(heapq.heappop(self._heap))
+                return batch
+            deadline = min(self._heap[0][0] if self._heap else self._next_rescan, self._next_rescan)
+            self._cond.wait(deadline - now)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take_due()
+            if batch is None:
+                self.rescan()
+                continue
+            due = {WARN: [], EXPIRE: []}
+            for _, kind, chat_id, expires_at in batch:
+                if self._claim(kind, chat_id, expires_at):
+                    due[kind].append(chat_id)
+            try:
+                if due[WARN]:
+                    self.warned += len(due[WARN])
+                    self.on_warn(due[WARN])
+                if due[EXPIRE]:
+                    self.expired += len(due[EXPIRE])
+                    self.on_expire(due[EXPIRE])
+            except Exception as e:
+                print(f"❌ Ошибка уведомлений об окончании подписки: {e}")
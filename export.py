@@ -0,0 +1,92 @@
+import os
+
+from docx import Document
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import simpleSplit
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+# === Экспорт истории в PDF/DOCX ===
+# PDF: перенос по словам под ширину страницы и разбивка на страницы.
+# Каждая страница закрывается showPage() сразу, как только заполнена.
+# Для кириллицы нужен TTF-шрифт (DejaVu Sans); без него — встроенный Helvetica.
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+MARGIN = 40
+FONT_SIZE = 11
+LEADING = 15
+FONT_NAME = "NeiroSans"
+
+FONT_CANDIDATES = [
+    os.getenv("EXPORT_FONT_PATH", ""),
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+]
+
+_font = None
+
+
+def pdf_font():
+    global _font
+    if _font is None:
+        _font = "Helvetica"
+        for path in FONT_CANDIDATES:
+            if path and os.path.exists(path):
+                pdfmetrics.registerFont(TTFont(FONT_NAME, path))
+                _font = FONT_NAME
+                break
+        else:
+            print("⚠️ TTF-шрифт с кириллицей не найден, PDF будет с Helvetica (задайте EXPORT_FONT_PATH)")
+    return _font
+
+
+def export_paragraphs(history):
+    # Одно сообщение — один абзац; системные сообщения не выгружаем
+    return [m["content"] for m in history if m["role"] != "system"]
+
+
+def wrap_line(text, font, width):
+    lines = []
+    for line in simpleSplit(text, font, FONT_SIZE, width) or [""]:
+        # Слишком длинные «слова» (ссылки, хеши) режем по символам
+        while pdfmetrics.stringWidth(line, font, FONT_SIZE) > width and len(line) > 1:
+            cut = len(line) - 1
+            while cut > 1 and pdfmetrics.stringWidth(line[:cut], font, FONT_SIZE) > width:
+                cut = cut * 3 // 4
+            lines.append(line[:cut])
+            line = line[cut:]
+        lines.append(line)
+    return lines
+
+
+def render_pdf(paragraphs, out):
+    font = pdf_font()
+    width = PAGE_WIDTH - 2 * MARGIN
+    pdf = canvas.Canvas(out, pagesize=A4)
+    pdf.setFont(font, FONT_SIZE)
+    y = PAGE_HEIGHT - MARGIN
+
+    for paragraph in paragraphs:
+        for source_line in paragraph.split("\n"):
+            for line in wrap_line(source_line, font, width):
+                if y < MARGIN:
+                    pdf.showPage()
+                    pdf.setFont(font, FONT_SIZE)
+                    y = PAGE_HEIGHT - MARGIN
+                pdf.drawString(MARGIN, y, line)
+                y -= LEADING
+        y -= LEADING / 2  # отступ между сообщениями
+
+    pdf.save()
+    return out
+
+
+def render_docx(paragraphs, out):
+    doc = Document()
+    for paragraph in paragraphs:
+        doc.add_paragraph(paragraph)
+    doc.save(out)
+    return out
@@ -0,0 +1,33 @@
+import os
+import shutil
+
+# === gunicorn: несколько процессов бота ===
+# Запуск: gunicorn -c gunicorn.conf.py bot_main:app (python bot_main.py запускает то же самое)
+# Подписки, режимы, модели и история общие для всех процессов (SQLite + memory/),
+# поэтому STATE_DB_FILE и каталог memory должны лежать на одном локальном диске.
+# preload_app выключен: фоновые потоки (очереди, запись состояния) при fork не переносятся,
+# каждый процесс импортирует bot_main и запускает их сам.
+#
+# Что меняется при WEB_CONCURRENCY > 1:
+# - апдейты Telegram раскидываются по процессам. Апдейты одного чата не выполняются одновременно
+#   (flock на чат, memory/.chat_locks), но порядок между процессами — по времени прихода:
+#   строгий порядок внутри чата гарантирует только один процесс (WEB_CONCURRENCY=1, больше потоков);
+# - ожидание ввода после кнопки («♻️ Сброс пробника» -> ID) хранится в store, а не в памяти процесса;
+# - /metrics складывает снимки всех процессов (METRICS_DIR, обновляются раз в 5 с), датчики — с меткой pid;
+# - /stats/* и /webhook/stats показывают только ответивший процесс (его pid — в заголовке X-Worker-Pid);
+# - кеши в памяти (ответы, ссылки на оплату, экспорт) у каждого процесса свои.
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+# bot_main делит лимиты «на бота» (Telegram, OpenAI, OCR) на число процессов
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+timeout = 120
+graceful_timeout = 30
+preload_app = False
+
+
+def on_starting(server):
+    # Снимки метрик прошлого запуска не нужны: счётчики нового запуска начинаются с нуля
+    shutil.rmtree(os.getenv("METRICS_DIR", "metrics"), ignore_errors=True)
@@ -0,0 +1,246 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import timed
+
+# === История диалогов: LRU в памяти + append-only лог на диске ===
+# memory/<chat_id>.jsonl — по одному сообщению на строку. Каждый ход — одна
+# короткая дозапись; когда строк в логе становится больше compact_factor * max_history,
+# лог переписывается (атомарно) до последних max_history сообщений.
+# Горячие диалоги держатся в памяти, вытеснение — по бюджету памяти (байты).
+#
+# shared=True — каталог пишут несколько процессов: запись и чтение с диска идут под
+# flock (memory/.lock), а закешированный диалог перечитывается, если у лога поменялись
+# inode/размер/mtime (его дописал или сжал другой процесс).
+#
+# Сводка диалога ({"summary": True, ...}, см. summarizer.py) всегда стоит первой
+# и при обрезке до max_history не вытесняется; fold() заменяет ею старые ходы.
+
+
+class _Entry:
+    __slots__ = ("messages", "size", "log_lines", "version", "stamp")
+
+    def __init__(self, messages, size, log_lines, version=0, stamp=None):
+        self.messages = messages
+        self.size = size
+        self.log_lines = log_lines
+        self.version = version
+        self.stamp = stamp
+
+
+class HistoryStore:
+    def __init__(self, directory, max_history=20, memory_budget=32 * 1024 * 1024, compact_factor=2, shared=False):
+        self.directory = directory
+        self.max_history = max_history
+        self.memory_budget = memory_budget
+        self.compact_factor = compact_factor
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._clock = 0
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = None
+        self._lock_depth = 0
+        if shared:
+            import fcntl
+            self._fcntl = fcntl
+            self._lock_file = open(os.path.join(directory, ".lock"), "a")
+
+    @contextmanager
+    def _file_lock(self):
+        # Межпроцессная блокировка каталога (только shared); берётся под self._lock, реентерабельна
+        if not self.shared:
+            yield
+            return
+        if not self._lock_depth:
+            self._fcntl.flock(self._lock_file, self._fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if not self._lock_depth:
+                self._fcntl.flock(self._lock_file, self._fcntl.LOCK_UN)
+
+    def _stamp(self, chat_id):
+        try:
+            st = os.stat(self._log_path(chat_id))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _log_path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.jsonl")
+
+    def _legacy_path(self, chat_id):
+        return os.path.join(self.directory, f"{chat_id}.json")
+
+    @staticmethod
+    def _line(message):
+        return json.dumps(message, ensure_ascii=False) + "\n"
+
+    # --- Чтение ---
+    def load(self, chat_id):
+        with self._lock:
+            return list(self._entry(str(chat_id)).messages)
+
+    def version(self, chat_id):
+        # Уникален в пределах процесса для каждого состояния истории —
+        # годится как ключ для кешей поверх неё (в т.ч. после вытеснения из LRU)
+        with self._lock:
+            return self._entry(str(chat_id)).version
+
+    def _entry(self, chat_id):
+        entry = self._cache.get(chat_id)
+        if entry is not None and self.shared and entry.stamp != self._stamp(chat_id):
+            # Лог изменил другой процесс — наша копия устарела
+            del self._cache[chat_id]
+            self._bytes -= entry.size
+            self.reloads += 1
+            entry = None
+        if entry is not None:
+            self._cache.move_to_end(chat_id)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        with self._file_lock():
+            entry = self._read(chat_id)
+            if self.shared:
+                entry.stamp = self._stamp(chat_id)
+        self._cache[chat_id] = entry
+        self._bytes += entry.size
+        self._evict()
+        return entry
+
+    def _read(self, chat_id):
+        path = self._log_path(chat_id)
+        if not os.path.exists(path):
+            self._migrate_legacy(chat_id)
+        messages = []
+        log_lines = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    log_lines += 1
+                    try:
+                        messages.append(json.loads(line))
+                    except ValueError:
+                        # Недописанная строка после падения — пропускаем
+                        continue
+        messages = self._trim(messages)
+        size = sum(len(self._line(m)) for m in messages)
+        return _Entry(messages, size, log_lines, self._tick())
+
+    def _trim(self, messages):
+        # Последние max_history сообщений; сводка в начале сохраняется сверх них
+        if messages and messages[0].get("summary"):
+            return messages[:1] + messages[1:][-(self.max_history - 1):]
+        return messages[-self.max_history:]
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def _migrate_legacy(self, chat_id):
+        legacy = self._legacy_path(chat_id)
+        if not os.path.exists(legacy):
+            return
+        try:
+            with open(legacy, "r", encoding="utf-8") as f:
+                messages = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать старую историю {legacy}: {e}")
+            return
+        self._rewrite(chat_id, self._trim(messages))
+        os.remove(legacy)
+
+    # --- Запись ---
+    @timed("state_io_seconds", "Операции с хранилищами на диске", op="history_append")
+    def append(self, chat_id, *messages):
+        chat_id = str(chat_id)
+        with self._lock, self._file_lock():
+            entry = self._entry(chat_id)
+            lines = [self._line(m) for m in messages]
+            with open(self._log_path(chat_id), "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+            entry.log_lines += len(lines)
+            entry.messages.extend(messages)
+            delta = sum(len(line) for line in lines)
+            if len(entry.messages) > self.max_history:
+                kept = self._trim(entry.messages)
+                delta -= sum(len(self._line(m)) for m in entry.messages) - sum(len(self._line(m)) for m in kept)
+                entry.messages = kept
+            entry.size += delta
+            self._bytes += delta
+            entry.version = self._tick()
+            if entry.log_lines > self.max_history * self.compact_factor:
+                self._rewrite(chat_id, entry.messages)
+                entry.log_lines = len(entry.messages)
+            if self.shared:
+                entry.stamp = self._stamp(chat_id)
+            self._evict()
+
+    def replace(self, chat_id, messages):
+        # Полная перезапись (сброс/редкие операции)
+        chat_id = str(chat_id)
+        with self._lock, self._file_lock():
+            entry = self._entry(chat_id)
+            entry.messages = self._trim(list(messages))
+            size = sum(len(self._line(m)) for m in entry.messages)
+            self._bytes += size - entry.size
+            entry.size = size
+            entry.log_lines = len(entry.messages)
+            entry.version = self._tick()
+            self._rewrite(chat_id, entry.messages)
+            if self.shared:
+                entry.stamp = self._stamp(chat_id)
+            self._evict()
+
+    def fold(self, chat_id, folded, summary):
+        # Заменяет начало истории (folded) сводкой. False — история успела измениться
+        # (сброс, обрезка или другая сводка), сводка устарела и не применяется
+        chat_id = str(chat_id)
+        with self._lock, self._file_lock():
+            entry = self._entry(chat_id)
+            if not folded or entry.messages[:len(folded)] != folded:
+                return False
+            self.replace(chat_id, [summary] + entry.messages[len(folded):])
+            return True
+
+    @timed("state_io_seconds", "Операции с хранилищами на диске", op="history_rewrite")
+    def _rewrite(self, chat_id, messages):
+        path = self._log_path(chat_id)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("".join(self._line(m) for m in messages))
+        os.replace(tmp, path)
+
+    # --- Бюджет памяти ---
+    def _evict(self):
+        # Последний (самый свежий) диалог не вытесняем никогда
+        while self._bytes > self.memory_budget and len(self._cache) > 1:
+            _, entry = self._cache.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "chats": len(self._cache),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+            }
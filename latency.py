@@ -0,0 +1,52 @@
+import threading
+from collections import deque
+
+# === Бюджеты задержки по моделям ===
+# Для каждой модели храним окно последних задержек. Один трекер — один вид замеров:
+# время до первого токена и время полного ответа различаются в разы, поэтому для
+# потоковых и обычных запросов заводятся отдельные трекеры со своими потолками.
+# Бюджет = p95 * factor, но не меньше min_budget и не больше потолка модели;
+# пока замеров мало — потолок. Не уложился в бюджет — запрос уходит на запасную модель.
+
+
+class LatencyTracker:
+    def __init__(self, budgets=None, default_budget=20.0, min_budget=3.0, factor=2.0, window=200, min_samples=20):
+        self.budgets = budgets or {}    # модель -> потолок бюджета, с
+        self.default_budget = default_budget
+        self.min_budget = min_budget
+        self.factor = factor
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model, seconds):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, model, q=0.95):
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def ceiling(self, model):
+        return self.budgets.get(model, self.default_budget)
+
+    def budget(self, model):
+        ceiling = self.ceiling(model)
+        with self._lock:
+            enough = len(self._samples.get(model, ())) >= self.min_samples
+        if not enough:
+            return ceiling
+        return min(ceiling, max(self.min_budget, self.percentile(model) * self.factor))
+
+    def stats(self):
+        with self._lock:
+            models = list(self._samples)
+        return {model: {"p50": self.percentile(model, 0.5), "p95": self.percentile(model), "budget": self.budget(model),
+                        "samples": len(self._samples[model])} for model in models}
@@ -0,0 +1,221 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import openai
+
+# === Планировщик запросов к LLM ===
+# - глобальный лимит одновременных запросов к OpenAI;
+# - очередь ожидания с приоритетами: админ > платные подписчики > пробник > фоновые задачи;
+# - токен-бакет на пользователя (частота запросов по приоритету);
+# - повторы с экспоненциальной задержкой и джиттером, с учётом Retry-After.
+
+PRIORITY_ADMIN = 0
+PRIORITY_PAID = 1
+PRIORITY_TRIAL = 2
+PRIORITY_BACKGROUND = 3  # сводки истории и т.п. — не на пути ответа пользователю
+PRIORITY_NAMES = {PRIORITY_ADMIN: "admin", PRIORITY_PAID: "paid", PRIORITY_TRIAL: "trial",
+                  PRIORITY_BACKGROUND: "background"}
+
+# Ошибки, после которых имеет смысл повторить запрос
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class LLMBusyError(Exception):
+    # Очередь переполнена или ожидание слота дольше queue_timeout
+    pass
+
+
+class LLMRateLimited(Exception):
+    def __init__(self, retry_in):
+        super().__init__(f"rate limited, retry in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class TokenBucket:
+    def __init__(self, rate_per_min, burst):
+        self.rate = rate_per_min / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        # Возвращает 0, если токен взят, иначе — сколько секунд ждать
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate if self.rate else float("inf")
+
+
+def is_retryable(error):
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    # 5xx от API приходят как APIError
+    return isinstance(error, openai.error.APIError) and (error.http_status or 500) >= 500
+
+
+def is_server_error(error):
+    # Таймаут или 5xx: такой запрос есть смысл перевести на запасную модель
+    if isinstance(error, (openai.error.Timeout, openai.error.ServiceUnavailableError)):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status or 500) >= 500
+
+
+def retry_after(error):
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class LLMScheduler:
+    def __init__(self, max_concurrency=8, max_queue=200, queue_timeout=60, max_retries=3,
+                 base_delay=1.0, max_delay=30.0, rates=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # приоритет -> (запросов в минуту, burst); None — без ограничения
+        self.rates = rates or {PRIORITY_ADMIN: None, PRIORITY_PAID: (20, 5), PRIORITY_TRIAL: (6, 3)}
+
+        self._cond = threading.Condition()
+        self._waiting = []          # heap из (priority, seq)
+        self._seq = itertools.count()
+        self._running = 0
+        self._buckets = {}
+
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = {"queue_full": 0, "queue_timeout": 0, "rate_limited": 0}
+        self.wait_total = {p: 0.0 for p in PRIORITY_NAMES}
+        self.wait_count = {p: 0 for p in PRIORITY_NAMES}
+        self.wait_max = {p: 0.0 for p in PRIORITY_NAMES}
+
+    def _reject(self, reason):
+        with self.stats_lock:
+            self.rejected[reason] += 1
+
+    def check_rate(self, key, priority):
+        # LLMRateLimited, если пользователь превысил частоту запросов своего приоритета
+        rate = self.rates.get(priority)
+        if rate is None:
+            return
+        with self._cond:
+            bucket = self._buckets.get((key, priority))
+            if bucket is None:
+                bucket = self._buckets[(key, priority)] = TokenBucket(*rate)
+            wait = bucket.take()
+        if wait:
+            self._reject("rate_limited")
+            raise LLMRateLimited(wait)
+
+    @contextmanager
+    def slot(self, key, priority=PRIORITY_TRIAL, rate_limited=True):
+        # rate_limited=False — для внутренних шагов одного запроса (частота проверена один раз заранее)
+        if rate_limited:
+            self.check_rate(key, priority)
+        ticket = (priority, next(self._seq))
+        started = time.monotonic()
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self._reject("queue_full")
+                raise LLMBusyError("queue full")
+            heapq.heappush(self._waiting, ticket)
+            deadline = started + self.queue_timeout
+            # Ждём, пока есть свободный слот и наш билет — первый в очереди
+            while self._running >= self.max_concurrency or self._waiting[0] != ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    self._reject("queue_timeout")
+                    raise LLMBusyError("queue timeout")
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self._running += 1
+            self._cond.notify_all()
+
+        waited = time.monotonic() - started
+        with self.stats_lock:
+            self.requests += 1
+            self.wait_total[priority] += waited
+            self.wait_count[priority] += 1
+            self.wait_max[priority] = max(self.wait_max[priority], waited)
+        try:
+            yield waited
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def occupy(self):
+        # Занять место в лимите одновременных запросов без очереди — для запроса, который уже идёт
+        # вне slot (брошен по бюджету и дочитывается в фоне). -> release(), вызвать, когда он закончится
+        with self._cond:
+            self._running += 1
+
+        def release():
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+        return release
+
+    def retry(self, fn, retryable=is_retryable):
+        # Слот не отпускаем на время паузы: при шторме 429 это само по себе снижает нагрузку
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                if attempt >= self.max_retries or not retryable(e):
+                    with self.stats_lock:
+                        self.failures += 1
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                with self.stats_lock:
+                    self.retries += 1
+                print(f"[llm] {type(e).__name__}, повтор {attempt}/{self.max_retries} через {delay:.1f} с")
+                time.sleep(min(delay, self.max_delay))
+
+    def run(self, key, priority, fn):
+        with self.slot(key, priority):
+            return self.retry(fn)
+
+    def stats(self):
+        with self._cond:
+            running, queued = self._running, len(self._waiting)
+        with self.stats_lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "running": running,
+                "queued": queued,
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "rejected": dict(self.rejected),
+                "wait_avg": {PRIORITY_NAMES[p]: (self.wait_total[p] / self.wait_count[p] if self.wait_count[p] else 0)
+                             for p in PRIORITY_NAMES},
+                "wait_max": {PRIORITY_NAMES[p]: self.wait_max[p] for p in PRIORITY_NAMES},
+            }
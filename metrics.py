@@ -0,0 +1,274 @@
+import functools
+import json
+import os
+import threading
+import time
+
+# === Метрики в формате Prometheus (без внешних зависимостей) ===
+# counter(...).inc(), histogram(...).observe(), gauge(name, fn) — значение
+# снимается при каждом запросе /metrics. timed(...) — контекстный менеджер
+# и декоратор: одна пара perf_counter() и запись в dict под локом.
+#
+# Несколько процессов (gunicorn, enable_multiprocess): каждый процесс раз в interval секунд
+# (и при выходе) сбрасывает снимок своих метрик в <каталог>/<pid>.json, а /metrics любого
+# процесса складывает снимки всех — счётчики и гистограммы не зависят от того, какой процесс
+# ответил на запрос. Снимки завершившихся процессов остаются в сумме (счётчики не убывают);
+# датчики (gauge) — по процессам, с меткой pid, и только от живых процессов.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = {}
+_registry_lock = threading.Lock()
+_shared = {"dir": None}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key) + (list(extra) if extra else [])
+    if not items:
+        return ""
+    parts = []
+    for name, value in items:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{name}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        values = self.snapshot()
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in values.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # labels -> [счётчики по бакетам..., сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[idx] += 1
+                    break
+            data[-2] += value
+            data[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(data) for key, data in self._values.items()}
+
+    def render(self):
+        values = self.snapshot()
+        lines = []
+        for key, data in values.items():
+            cumulative = 0
+            for idx, bound in enumerate(self.buckets):
+                cumulative += data[idx]
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {data[-1]}")
+        return lines
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, help_text, fn):
+        # fn() -> число или dict {(("label", "value"), ...): число}
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def snapshot(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return {}
+        return dict(value) if isinstance(value, dict) else {(): value}
+
+    def render(self):
+        return [f"{self.name}{_format_labels(key)} {v}" for key, v in self.snapshot().items()]
+
+
+def _get_or_create(name, factory):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+
+def counter(name, help_text=""):
+    return _get_or_create(name, lambda: Counter(name, help_text))
+
+
+def histogram(name, help_text="", buckets=DEFAULT_BUCKETS):
+    return _get_or_create(name, lambda: Histogram(name, help_text, buckets))
+
+
+def gauge(name, fn, help_text=""):
+    with _registry_lock:
+        _registry[name] = Gauge(name, help_text, fn)
+
+
+def count_error(where, error):
+    counter("errors_total", "Ошибки по месту и типу").inc(where=where, type=type(error).__name__)
+
+
+class timed:
+    # with timed("openai_request_seconds", model="gpt-4o"): ...   или   @timed("...")
+    def __init__(self, name, help_text="", **labels):
+        self.metric = histogram(name, help_text)
+        self.labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metric.observe(time.perf_counter() - self._start, **self.labels)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.metric.observe(time.perf_counter() - start, **self.labels)
+        return wrapper
+
+
+# --- Несколько процессов ---
+def enable_multiprocess(directory, interval=5.0):
+    import atexit
+    os.makedirs(directory, exist_ok=True)
+    _shared["dir"] = directory
+    atexit.register(_write_snapshot)
+    thread = threading.Thread(target=_snapshot_loop, args=(interval,), name="metrics-snapshot", daemon=True)
+    thread.start()
+
+
+def _snapshot():
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {"pid": os.getpid(), "metrics": {
+        metric.name: {"kind": metric.kind, "help": metric.help, "buckets": getattr(metric, "buckets", None),
+                      "values": [[list(key), value] for key, value in metric.snapshot().items()]}
+        for metric in metrics}}
+
+
+def _write_snapshot():
+    path = os.path.join(_shared["dir"], f"{os.getpid()}.json")
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(_snapshot(), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить снимок метрик: {e}")
+
+
+def _snapshot_loop(interval):
+    while True:
+        time.sleep(interval)
+        _write_snapshot()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load_snapshots():
+    # Свой снимок — свежий, из памяти; чужие — с диска (отстают не больше чем на interval)
+    snapshots = [_snapshot()]
+    for name in os.listdir(_shared["dir"]):
+        if not name.endswith(".json") or name == f"{os.getpid()}.json":
+            continue
+        try:
+            with open(os.path.join(_shared["dir"], name), "r", encoding="utf-8") as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # процесс как раз переписывает снимок
+    return snapshots
+
+
+def _merged():
+    # Снимки всех процессов -> метрики того же вида, что в _registry, для render()
+    merged, gauges = {}, {}
+    for snapshot in _load_snapshots():
+        pid, alive = snapshot["pid"], _alive(snapshot["pid"])
+        for name, data in snapshot["metrics"].items():
+            metric = merged.get(name)
+            if metric is None:
+                if data["kind"] == "histogram":
+                    metric = Histogram(name, data["help"], data["buckets"])
+                elif data["kind"] == "gauge":
+                    values = gauges[name] = {}
+                    metric = Gauge(name, data["help"], lambda values=values: values)
+                else:
+                    metric = Counter(name, data["help"])
+                merged[name] = metric
+            for key, value in data["values"]:
+                key = tuple(tuple(item) for item in key)
+                if data["kind"] == "gauge":
+                    if alive:
+                        gauges[name][key + (("pid", pid),)] = value
+                elif data["kind"] == "histogram":
+                    current = metric._values.get(key)
+                    metric._values[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                else:
+                    metric._values[key] = metric._values.get(key, 0) + value
+    return list(merged.values())
+
+
+def render():
+    if _shared["dir"]:
+        metrics = _merged()
+    else:
+        with _registry_lock:
+            metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        if metric.help:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
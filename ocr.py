@@ -0,0 +1,249 @@
+import functools
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+import pytesseract
+from pdf2image import convert_from_path
+
+try:
+    import pymupdf as fitz
+except ImportError:  # PyMuPDF < 1.24.3
+    import fitz
+
+# === OCR: предобработка, распознавание и постраничная обработка PDF ===
+# Для каждой страницы PDF сначала берём встроенный текстовый слой (PyMuPDF) —
+# это миллисекунды. Только страницы без пригодного текста растеризуются
+# (по одной в воркере) и распознаются в пуле процессов. Одновременно в работе
+# не больше window страниц, поэтому пиковая память — O(window), а не O(страниц).
+
+OCR_LANG = "rus+eng"
+TARGET_DPI = 300
+MAX_SIDE = 4000            # фото без DPI: ограничиваем длинную сторону
+ADAPTIVE_BLOCK = 31        # окно адаптивного порога, px (нечётное)
+ADAPTIVE_C = 15
+MIN_TEXT_LAYER_CHARS = 20  # меньше — считаем, что текстового слоя нет (скан)
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+
+
+def preprocess_image_for_ocr(image: Image.Image, source_dpi=None, target_dpi=TARGET_DPI, deskew=False) -> Image.Image:
+    # Векторизованная предобработка на NumPy/OpenCV
+    gray = np.asarray(image.convert('L'))
+
+    # Уменьшаем до целевого DPI (или до MAX_SIDE, если DPI неизвестен)
+    source_dpi = source_dpi or (image.info.get('dpi') or (None,))[0]
+    if source_dpi and source_dpi > target_dpi:
+        scale = target_dpi / float(source_dpi)
+    else:
+        scale = min(1.0, MAX_SIDE / float(max(gray.shape)))
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # Чистим шум
+    gray = cv2.medianBlur(gray, 3)
+
+    # Адаптивная бинаризация: устойчива к теням и неравномерному свету на фото
+    bw = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                               ADAPTIVE_BLOCK, ADAPTIVE_C)
+
+    if deskew:
+        bw = deskew_binary(bw)
+
+    return Image.fromarray(bw)
+
+
+def deskew_binary(bw):
+    # Угол наклона по минимальному прямоугольнику вокруг тёмных (текстовых) пикселей
+    coords = np.column_stack(np.where(bw < 128))
+    if len(coords) < 50:
+        return bw
+    angle = cv2.minAreaRect(coords[:, ::-1].astype(np.float32))[-1]
+    # Разные версии OpenCV отдают угол в [0, 90) или (-90, 0] — приводим к (-45, 45]
+    if angle > 45:
+        angle -= 90
+    elif angle <= -45:
+        angle += 90
+    if abs(angle) < 0.3 or abs(angle) > 15:
+        return bw
+    h, w = bw.shape
+    matrix = cv2.getRotationMatrix2D((w / 2, h / 2), angle, 1.0)
+    return cv2.warpAffine(bw, matrix, (w, h), flags=cv2.INTER_NEAREST,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+
+
+def preprocess_image_for_ocr_legacy(image: Image.Image) -> Image.Image:
+    # Прежняя PIL-версия — оставлена для сравнения в bench/ocr_preprocess.py
+    # Перевод в оттенки серого
+    gray = image.convert('L')
+
+    # Усиление контраста
+    enhancer = ImageEnhance.Contrast(gray)
+    gray = enhancer.enhance(2.0)
+
+    # Чистим шум
+    gray = gray.filter(ImageFilter.MedianFilter(size=3))
+
+    # Бинаризация (черно-белое изображение)
+    bw = gray.point(lambda x: 0 if x < 140 else 255, '1')
+
+    return bw
+
+
+def _add_timing(timings, stage, started):
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+
+class OcrError(Exception):
+    pass
+
+
+def _picklable_errors(fn):
+    # Исключения из дочернего процесса передаются родителю через pickle. Ошибки pytesseract
+    # (TesseractNotFoundError, TesseractError) не восстанавливаются из pickle — и пул целиком
+    # падает с BrokenProcessPool. Поэтому наружу отдаём простое OcrError с текстом ошибки.
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            raise OcrError(f"{type(e).__name__}: {e}") from None
+    return wrapper
+
+
+def ocr_image(image, lang=OCR_LANG, debug_path=None, source_dpi=None, deskew=False, timings=None):
+    # timings (dict) — сюда пишется время этапов; из дочернего процесса оно возвращается родителю
+    started = time.perf_counter()
+    processed = preprocess_image_for_ocr(image, source_dpi=source_dpi, deskew=deskew)
+    _add_timing(timings, "preprocess", started)
+    if debug_path:
+        # Сохраняем то самое изображение, что ушло в Tesseract (для отладки)
+        try:
+            processed.save(debug_path)
+        except Exception:
+            pass
+    started = time.perf_counter()
+    text = pytesseract.image_to_string(processed, lang=lang)
+    _add_timing(timings, "tesseract", started)
+    return text
+
+
+@_picklable_errors
+def ocr_image_bytes(data, lang=OCR_LANG, debug_path=None, deskew=False):
+    # Возвращает (текст, время этапов)
+    timings = {}
+    text = ocr_image(Image.open(BytesIO(data)), lang=lang, debug_path=debug_path, deskew=deskew, timings=timings)
+    return text, timings
+
+
+@_picklable_errors
+def _ocr_pdf_page(pdf_path, page_no, dpi, lang, debug_path=None, deskew=False):
+    # Выполняется в дочернем процессе: растеризуем ровно одну страницу
+    timings = {}
+    started = time.perf_counter()
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page_no, last_page=page_no)
+    _add_timing(timings, "rasterize", started)
+    text = "\n".join(ocr_image(img, lang=lang, debug_path=debug_path, source_dpi=dpi, deskew=deskew, timings=timings)
+                     for img in images)
+    return text, timings
+
+
+def get_pool(workers=None):
+    # forkserver, а не fork: бот к этому моменту многопоточный (gthread, очереди, OpenCV), и fork
+    # мог бы унести в дочерний процесс захваченную чужим потоком блокировку. Процессы пула
+    # форкаются от однопоточного сервера, который импортирует только ocr. Главный модуль
+    # дочерние процессы тоже импортируют (как __mp_main__): под gunicorn это его скрипт запуска,
+    # поэтому бот запускается через gunicorn (Procfile, Dockerfile), а не python bot_main.py
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None:
+            _pool_workers = workers or os.cpu_count() or 1
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload([__name__])
+            _pool = ProcessPoolExecutor(max_workers=_pool_workers, mp_context=context)
+        return _pool
+
+
+def pool_workers():
+    return _pool_workers
+
+
+def _drop_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def submit(fn, *args, workers=None, **kwargs):
+    # Задача в пул процессов. Пул, у которого умер процесс (OOM и т.п.), больше не принимает
+    # задачи (BrokenProcessPool) — создаём его заново
+    pool = get_pool(workers)
+    try:
+        return pool.submit(fn, *args, **kwargs)
+    except BrokenProcessPool:
+        _drop_pool(pool)
+        return get_pool(workers).submit(fn, *args, **kwargs)
+
+
+def text_layer(page):
+    # Встроенный текст страницы или None, если он пустой/битый (шрифты без ToUnicode)
+    text = page.get_text("text").strip()
+    if len(text) < MIN_TEXT_LAYER_CHARS:
+        return None
+    if text.count("\ufffd") > len(text) * 0.1:
+        return None
+    return text
+
+
+def iter_pdf_text(pdf_bytes, dpi=300, max_pages=None, workers=None, window=None, lang=OCR_LANG, debug_path=None,
+                  deskew=False, on_timings=None):
+    # Отдаёт (номер страницы, всего страниц в документе, текст) строго по порядку страниц.
+    # on_timings(dict этап -> секунды) вызывается для каждой страницы
+    report = on_timings or (lambda timings: None)
+    get_pool(workers)
+    window = window or 2 * pool_workers()
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp, fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        tmp.write(pdf_bytes)
+        tmp.flush()
+        total = doc.page_count
+        limit = min(total, max_pages) if max_pages else total
+
+        pending = deque()  # (номер страницы, future или None, готовый текст)
+        next_page = 1
+        try:
+            while next_page <= limit or pending:
+                while next_page <= limit and len(pending) < window:
+                    started = time.perf_counter()
+                    text = text_layer(doc[next_page - 1])
+                    report({"text_layer": time.perf_counter() - started})
+                    if text is not None:
+                        pending.append((next_page, None, text))
+                    else:
+                        page_debug = debug_path if next_page == 1 else None
+                        future = submit(_ocr_pdf_page, tmp.name, next_page, dpi, lang, page_debug, deskew,
+                                        workers=workers)
+                        pending.append((next_page, future, None))
+                    next_page += 1
+                page_no, future, text = pending.popleft()
+                if future is not None:
+                    text, timings = future.result()
+                    report(timings)
+                yield page_no, total, text
+        finally:
+            for _, future, _ in pending:
+                if future is not None:
+                    future.cancel()
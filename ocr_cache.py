@@ -0,0 +1,91 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+from metrics import timed
+
+# === Кеш результатов OCR на диске (SQLite) ===
+# Ключи: "fu:<file_unique_id>" (можно проверить до скачивания файла)
+# и "sha:<sha256 содержимого>" (если тот же файл пришёл с другим file_unique_id).
+# Вытеснение: по TTL при чтении и по суммарному размеру — самые давно читанные.
+
+
+def content_key(data):
+    return "sha:" + hashlib.sha256(data).hexdigest()
+
+
+def unique_key(file_unique_id):
+    return "fu:" + file_unique_id
+
+
+class OcrCache:
+    def __init__(self, path, ttl=30 * 86400, max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_cache ("
+            " key TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ocr_cache_accessed ON ocr_cache (accessed)")
+        self._conn.commit()
+
+    @timed("state_io_seconds", "Операции с хранилищами на диске", op="ocr_cache_get")
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT text, created FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            text, created = row
+            if created < now - self.ttl:
+                self._conn.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE ocr_cache SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return text
+
+    @timed("state_io_seconds", "Операции с хранилищами на диске", op="ocr_cache_put")
+    def put(self, keys, text):
+        now = time.time()
+        size = len(text.encode("utf-8"))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO ocr_cache (key, text, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                [(key, text, size, now, now) for key in keys],
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM ocr_cache WHERE created < ?", (now - self.ttl,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM ocr_cache ORDER BY accessed"):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._conn.executemany("DELETE FROM ocr_cache WHERE key = ?", victims)
+
+    def stats(self):
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()
+            return {"entries": count, "bytes": total, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,203 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+
+from metrics import count_error
+from workers import ChatWorkerPool
+
+# === Исходящая очередь в Telegram ===
+# Хендлеры ставят отправку в очередь и сразу идут дальше (fire-and-forget),
+# при необходимости ждут результат через Future.result().
+# - порядок сообщений внутри чата сохраняется (своя очередь у каждого chat_id);
+# - лимиты: общий (~30 сообщений/с на бота) и на чат (~1/с, в группах ~20/мин);
+#   чат, упёршийся в лимит, откладывается до своей очереди, а поток отправляет другим чатам;
+# - 429 Too Many Requests повторяется через retry_after из ответа Telegram (тоже без сна в потоке);
+# - все потоки используют одну requests.Session с пулом keep-alive соединений.
+
+
+MESSAGE_LIMIT = 4096  # символов в одном сообщении Telegram
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    # Режет длинный текст на части не длиннее limit — по абзацам, строкам, в крайнем случае по символам
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class _Rate:
+    # Токен-бакет с резервированием: reserve() возвращает, сколько подождать до своей очереди
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds):
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def idle(self, now):
+        # Бакет снова полный — состояние можно забыть, новый _Rate будет таким же
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+def configure_http_session(pool_size):
+    # Одна сессия на всех (вместо сессии на поток с пересозданием каждые 10 минут)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    apihelper.session = session
+    apihelper.SESSION_TIME_TO_LIVE = None
+    return session
+
+
+class Outbox:
+    def __init__(self, bot, workers=4, queue_size=10000, global_rate=30, chat_rate=1.0, chat_burst=3,
+                 group_rate=20 / 60, max_retries=3, sweep_interval=60):
+        self.bot = bot
+        self.global_rate = _Rate(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.sweep_interval = sweep_interval
+        self._chats = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+        self._lock = threading.Lock()
+        self._pool = ChatWorkerPool(self._deliver, workers=workers, queue_size=queue_size, name="outbox",
+                                    delay=self._reserve)
+        self.blocking = _BlockingProxy(self)
+
+    # --- Постановка в очередь ---
+    def submit(self, chat_id, method, *args, **kwargs):
+        future = Future()
+        if not self._pool.submit(str(chat_id), (future, chat_id, method, args, kwargs, 0), timeout=5):
+            print(f"[outbox] Очередь переполнена, {method} для {chat_id} не отправлен")
+            future.set_exception(OutboxFull(method))
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, "send_message", chat_id, text, **kwargs)
+
+    def send_long_message(self, chat_id, text, **kwargs):
+        # Несколько сообщений подряд (порядок в чате сохраняется); клавиатура — у последнего
+        parts = split_text(text)
+        for part in parts[:-1]:
+            self.send_message(chat_id, part)
+        return self.send_message(chat_id, parts[-1], **kwargs)
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self.submit(chat_id, "send_document", chat_id, document, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self.submit(chat_id, "edit_message_text", text, chat_id, message_id, **kwargs)
+
+    def depth(self):
+        return self._pool.depth()
+
+    def stats(self):
+        with self._lock:
+            return {"depth": self.depth(), "sent": self.sent, "failed": self.failed, "flood_waits": self.flood_waits,
+                    "chats": len(self._chats)}
+
+    # --- Доставка ---
+    def _chat(self, chat_id):
+        rate = self._chats.get(chat_id)
+        if rate is None:
+            # Отрицательный chat_id — группа/канал, там лимит строже
+            per_sec = self.group_rate if int(chat_id) < 0 else self.chat_rate
+            rate = self._chats[chat_id] = _Rate(per_sec, self.chat_burst)
+        return rate
+
+    def _sweep(self, now):
+        # Под self._lock: забываем чаты, которые давно ничего не отправляли
+        self._next_sweep = now + self.sweep_interval
+        for chat_id in [chat_id for chat_id, rate in self._chats.items() if rate.idle(now)]:
+            del self._chats[chat_id]
+
+    def _reserve(self, chat_id):
+        # Для пула: занимает очередь отправки и возвращает, сколько до неё ждать
+        with self._lock:
+            if time.monotonic() >= self._next_sweep:
+                self._sweep(time.monotonic())
+            return max(self._chat(chat_id).reserve(), self.global_rate.reserve())
+
+    def _deliver(self, item):
+        future, chat_id, method, args, kwargs, attempt = item
+        if not attempt and not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = getattr(self.bot, method)(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and attempt < self.max_retries:
+                delay = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                with self._lock:
+                    self.flood_waits += 1
+                    self._chat(str(chat_id)).pause(delay)
+                print(f"[outbox] 429 для {chat_id}, повтор через {delay} с")
+                # Обратно в начало очереди чата: пул отложит его, пока не пройдёт пауза
+                self._pool.requeue(str(chat_id), (future, chat_id, method, args, kwargs, attempt + 1))
+                return
+            self._fail(future, e, method, chat_id)
+            return
+        except Exception as e:
+            self._fail(future, e, method, chat_id)
+            return
+        with self._lock:
+            self.sent += 1
+        future.set_result(result)
+
+    def _fail(self, future, error, method, chat_id):
+        with self._lock:
+            self.failed += 1
+        # "message is not modified" — штатная ситуация для правок, не шумим в логе
+        if "message is not modified" not in str(error):
+            count_error("outbox", error)
+            print(f"[outbox] {method} для {chat_id} не доставлен: {error}")
+        future.set_exception(error)
+
+
+class _BlockingProxy:
+    # Синхронный интерфейс поверх очереди: для тех, кому нужен ответ Telegram (message_id, file_id)
+    def __init__(self, outbox):
+        self._outbox = outbox
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._outbox.send_message(chat_id, text, **kwargs).result()
+
+    def send_document(self, chat_id, document, **kwargs):
+        return self._outbox.send_document(chat_id, document, **kwargs).result()
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        return self._outbox.edit_message_text(text, chat_id, message_id, **kwargs).result()
@@ -0,0 +1,157 @@
+import queue
+import threading
+import time
+
+# === Очередь платёжных событий (вебхуки ЮKassa) ===
+# Вебхук только записывает событие и сразу отвечает 200. Запись — в StateStore
+# (бакет payment_events, ключ — id платежа) и до ответа сбрасывается на диск: принятое
+# событие не теряется при падении процесса, а повтор того же уведомления от ЮKassa
+# распознаётся как дубликат даже после перезапуска.
+# Фоновый поток забирает событие (pending -> processing -> done) и вызывает handler.
+# При старте недообработанные события снова ставятся в очередь; handler должен быть
+# идемпотентным по payment_id — тогда каждое событие применяется ровно один раз.
+
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+class PaymentStoreError(Exception):
+    # Событие не удалось записать на диск — отвечаем ошибкой, ЮKassa повторит уведомление
+    pass
+
+
+class PaymentEvents:
+    def __init__(self, store, handler, bucket="payment_events", claim_timeout=120, max_attempts=5, retry_delay=5.0,
+                 keep_days=90):
+        self.store = store
+        self.handler = handler
+        self.bucket = bucket
+        self.claim_timeout = claim_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.keep_days = keep_days
+        self.accepted = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        # Всё, что не успели обработать до перезапуска, — обратно в очередь;
+        # старые обработанные записи удаляем (ЮKassa повторяет уведомления не дольше суток)
+        cutoff = time.time() - self.keep_days * 86400
+        for payment_id, record in self.store.items(self.bucket).items():
+            if record.get("status") in (PENDING, PROCESSING):
+                self._queue.put(payment_id)
+            elif record.get("processed_at", 0) < cutoff:
+                self.store.delete(self.bucket, payment_id)
+        if self._queue.qsize():
+            print(f"💳 Восстановлено необработанных платежей: {self._queue.qsize()}")
+        self._thread = threading.Thread(target=self._run, name="payments", daemon=True)
+        self._thread.start()
+        return self
+
+    # --- Приём ---
+    def submit(self, payment_id, event):
+        # True — новое событие (поставлено в очередь), False — дубликат.
+        # PaymentStoreError — запись не дошла до диска, подтверждать уведомление нельзя
+        created = []
+
+        def record(current):
+            if current is not None:
+                return current
+            created.append(True)
+            return {"status": PENDING, "event": event, "received_at": time.time(), "attempts": 0}
+
+        self.store.update(self.bucket, payment_id, record)
+        with self._stats_lock:
+            if created:
+                self.accepted += 1
+            else:
+                self.duplicates += 1
+        if created:
+            self._queue.put(payment_id)
+        # Без shared StateStore пишет на диск раз в секунду — принятое событие сбрасываем сразу.
+        # Дубликат тоже: первое уведомление могло не дойти до диска
+        if not self.store.flush():
+            raise PaymentStoreError(payment_id)
+        return bool(created)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._stats_lock:
+            return {"depth": self.depth(), "accepted": self.accepted, "duplicates": self.duplicates,
+                    "processed": self.processed, "failed": self.failed}
+
+    # --- Обработка ---
+    def _claim(self, payment_id):
+        # Атомарно pending -> processing; чужой захват, который завис дольше claim_timeout, перехватываем
+        claimed = []
+        seen = []
+        now = time.time()
+
+        def claim(current):
+            if current is None:
+                return current
+            seen.append(current.get("status"))
+            stale = current.get("status") == PROCESSING and now - current.get("claimed_at", 0) > self.claim_timeout
+            if current.get("status") == PENDING or stale:
+                current.update(status=PROCESSING, claimed_at=now, attempts=current.get("attempts", 0) + 1)
+                claimed.append(current)
+            return current
+
+        self.store.update(self.bucket, payment_id, claim)
+        if not claimed and seen and seen[-1] == PROCESSING:
+            # Обрабатывает другой процесс (или захват остался от упавшего) — проверим позже
+            self._requeue_later(payment_id, self.claim_timeout)
+        return claimed[0] if claimed else None
+
+    def _finish(self, payment_id, status, error=None):
+        def finish(current):
+            current = dict(current or {})
+            current.update(status=status, processed_at=time.time())
+            if error is not None:
+                current["error"] = str(error)
+            return current
+        self.store.update(self.bucket, payment_id, finish)
+
+    def _release(self, payment_id, error):
+        def release(current):
+            current = dict(current or {})
+            current.update(status=PENDING, error=str(error))
+            return current
+        self.store.update(self.bucket, payment_id, release)
+
+    def _requeue_later(self, payment_id, delay):
+        timer = threading.Timer(delay, self._queue.put, args=(payment_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _run(self):
+        while True:
+            payment_id = self._queue.get()
+            record = self._claim(payment_id)
+            if record is None:
+                continue  # уже обработано или обрабатывается другим процессом
+            try:
+                self.handler(payment_id, record["event"])
+            except Exception as e:
+                if record["attempts"] >= self.max_attempts:
+                    print(f"❌ Платёж {payment_id} не обработан после {record['attempts']} попыток: {e}")
+                    self._finish(payment_id, FAILED, e)
+                    with self._stats_lock:
+                        self.failed += 1
+                    continue
+                print(f"⚠️ Ошибка обработки платежа {payment_id}, повтор через {self.retry_delay} с: {e}")
+                self._release(payment_id, e)
+                self._requeue_later(payment_id, self.retry_delay)
+                continue
+            self._finish(payment_id, DONE)
+            with self._stats_lock:
+                self.processed += 1
@@ -0,0 +1,87 @@
+import re
+
+# === Маршрутизация текстовых сообщений ===
+# Вместо цепочки лямбд telebot (каждая проверяется по очереди на каждом сообщении):
+#   1) точное совпадение текста кнопки — один поиск в dict;
+#   2) совпадение без учёта регистра (стили) — второй dict;
+#   3) фразы-подстроки — один заранее скомпилированный regex на все фразы;
+#   4) обработчик по умолчанию.
+
+
+class KeywordMatcher:
+    # Одна скомпилированная альтернатива вместо any(word in text for word in words)
+    def __init__(self, words):
+        words = sorted({w.lower() for w in words if w}, key=len, reverse=True)
+        self.words = words
+        self._regex = re.compile("|".join(re.escape(w) for w in words)) if words else None
+
+    def search(self, text):
+        if self._regex is None or not text:
+            return None
+        match = self._regex.search(text.lower())
+        return match.group(0) if match else None
+
+    def __bool__(self):
+        return self._regex is not None
+
+
+class StyleFilter:
+    # Запрещённые слова по стилям: по одному KeywordMatcher на стиль, собираются один раз
+    def __init__(self, forbidden):
+        self._matchers = {mode: KeywordMatcher(words) for mode, words in forbidden.items()}
+
+    def violation(self, mode, text):
+        matcher = self._matchers.get(mode)
+        return matcher.search(text) if matcher else None
+
+
+class MessageRouter:
+    def __init__(self):
+        self._exact = {}
+        self._exact_ci = {}
+        self._phrases = []
+        self._default = None
+
+    def exact(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                self._exact[text] = handler
+            return handler
+        return decorator
+
+    def exact_ci(self, *texts):
+        def decorator(handler):
+            for text in texts:
+                self._exact_ci[text.lower()] = handler
+            return handler
+        return decorator
+
+    def contains(self, *phrases):
+        def decorator(handler):
+            self._phrases.append((KeywordMatcher(phrases), handler))
+            return handler
+        return decorator
+
+    def default(self, handler):
+        self._default = handler
+        return handler
+
+    def resolve(self, text):
+        handler = self._exact.get(text)
+        if handler is not None:
+            return handler
+        if text is None:
+            return self._default
+        lowered = text.lower()
+        handler = self._exact_ci.get(lowered)
+        if handler is not None:
+            return handler
+        for matcher, handler in self._phrases:
+            if matcher.search(lowered):
+                return handler
+        return self._default
+
+    def dispatch(self, message):
+        handler = self.resolve(message.text)
+        if handler is not None:
+            return handler(message)
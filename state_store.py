@@ -0,0 +1,256 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import nullcontext
+
+from metrics import timed
+
+# === Хранилище состояния: подписки, пробники, токены ===
+# Всё читается из памяти (dict по бакетам), запись — отложенная (write-behind)
+# пачкой в SQLite в режиме WAL. Обновления одного ключа атомарны через update().
+#
+# shared=True — несколько процессов (воркеры gunicorn) над одной базой:
+# - запись сразу (write-through), update() — транзакцией BEGIN IMMEDIATE, атомарно между процессами;
+# - каждая запись добавляет строку в журнал changes;
+# - перед чтением дёшево проверяем PRAGMA data_version: если базу менял другой процесс,
+#   перечитываем из неё только ключи, изменённые после нашего последнего seq.
+
+_DELETED = object()
+_MISSING = object()
+
+
+class StateStore:
+    def __init__(self, path, flush_interval=1.0, shared=False, keep_changes=100_000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.keep_changes = keep_changes
+        self.reloads = 0
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._db_lock = threading.RLock()   # соединение одно на процесс — обращения к нему по очереди
+        self._cache = {}
+        self._dirty = {}
+        self._seq = 0
+        self._data_version = None
+        self._writes = 0
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " bucket TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (bucket, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS changes ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " bucket TEXT NOT NULL,"
+            " key TEXT NOT NULL)"
+        )
+        self._load_all()
+
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="state-flush", daemon=True)
+        self._flusher.start()
+
+    def _load_all(self):
+        with self._db_lock:
+            self._conn.execute("BEGIN")
+            try:
+                rows = self._conn.execute("SELECT bucket, key, value FROM state").fetchall()
+                self._seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+            finally:
+                self._conn.execute("COMMIT")
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        cache = {}
+        for bucket, key, value in rows:
+            cache.setdefault(bucket, {})[key] = json.loads(value)
+        for (bucket, key), value in self._dirty.items():
+            if value is _DELETED:
+                cache.get(bucket, {}).pop(key, None)
+            else:
+                cache.setdefault(bucket, {})[key] = value
+        self._cache = cache
+
+    # --- Синхронизация с другими процессами (shared) ---
+    def _sync(self):
+        # Вызывается под self._lock. data_version меняется только от коммитов других соединений
+        if not self.shared:
+            return
+        with self._db_lock:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return
+            self._data_version = version
+            oldest = self._conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+            if oldest is not None and oldest > self._seq + 1:
+                # Отстали дальше, чем хранится журнал, — перечитываем всё
+                stale = True
+            else:
+                stale = False
+                changed = self._conn.execute(
+                    "SELECT seq, bucket, key FROM changes WHERE seq > ? ORDER BY seq", (self._seq,)).fetchall()
+                keys = {(bucket, key) for _, bucket, key in changed if (bucket, key) not in self._dirty}
+                values = {}
+                for bucket, key in keys:
+                    row = self._conn.execute(
+                        "SELECT value FROM state WHERE bucket = ? AND key = ?", (bucket, key)).fetchone()
+                    values[(bucket, key)] = json.loads(row[0]) if row else _DELETED
+                if changed:
+                    self._seq = changed[-1][0]
+        if stale:
+            self._load_all()
+            self.reloads += 1
+            return
+        for (bucket, key), value in values.items():
+            if value is _DELETED:
+                self._cache.get(bucket, {}).pop(key, None)
+            else:
+                self._cache.setdefault(bucket, {})[key] = value
+
+    # --- Чтение (O(1), только память) ---
+    def get(self, bucket, key, default=None):
+        with self._lock:
+            self._sync()
+            value = self._cache.get(bucket, {}).get(str(key), default)
+            return dict(value) if isinstance(value, dict) else value
+
+    def items(self, bucket):
+        with self._lock:
+            self._sync()
+            return {k: (dict(v) if isinstance(v, dict) else v) for k, v in self._cache.get(bucket, {}).items()}
+
+    def count(self, bucket):
+        with self._lock:
+            self._sync()
+            return len(self._cache.get(bucket, {}))
+
+    def __contains__(self, bucket_key):
+        bucket, key = bucket_key
+        with self._lock:
+            self._sync()
+            return str(key) in self._cache.get(bucket, {})
+
+    # --- Запись ---
+    def set(self, bucket, key, value):
+        key = str(key)
+        with self._lock:
+            self._cache.setdefault(bucket, {})[key] = value
+            self._dirty[(bucket, key)] = value
+        if self.shared:
+            self.flush()
+
+    def delete(self, bucket, key):
+        key = str(key)
+        with self._lock:
+            self._sync()
+            if self._cache.get(bucket, {}).pop(key, _DELETED) is not _DELETED:
+                self._dirty[(bucket, key)] = _DELETED
+        if self.shared:
+            self.flush()
+
+    def update(self, bucket, key, fn, default=None):
+        # Атомарное read-modify-write одного ключа: fn получает копию текущего значения
+        key = str(key)
+        if self.shared:
+            return self._update_shared(bucket, key, fn, default)
+        with self._lock:
+            current = self._cache.get(bucket, {}).get(key, default)
+            if isinstance(current, dict):
+                current = dict(current)
+            new_value = fn(current)
+            self._cache.setdefault(bucket, {})[key] = new_value
+            self._dirty[(bucket, key)] = new_value
+            return new_value
+
+    def _update_shared(self, bucket, key, fn, default):
+        # Читаем и пишем в одной транзакции с блокировкой записи — атомарно между процессами
+        with self._lock, self._db_lock:
+            # Несохранённое после ошибки записи — новее того, что в базе
+            pending = self._dirty.pop((bucket, key), _MISSING)
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if pending is _MISSING:
+                    row = self._conn.execute(
+                        "SELECT value FROM state WHERE bucket = ? AND key = ?", (bucket, key)).fetchone()
+                    current = json.loads(row[0]) if row else default
+                else:
+                    current = default if pending is _DELETED else pending
+                new_value = fn(current)
+                self._apply({(bucket, key): new_value})
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                if pending is not _MISSING:
+                    self._dirty[(bucket, key)] = pending
+                raise
+            self._cache.setdefault(bucket, {})[key] = new_value
+            return new_value
+
+    def _apply(self, dirty):
+        # Внутри открытой транзакции, под self._db_lock
+        upserts = [(b, k, json.dumps(v, ensure_ascii=False)) for (b, k), v in dirty.items() if v is not _DELETED]
+        deletes = [(b, k) for (b, k), v in dirty.items() if v is _DELETED]
+        if upserts:
+            self._conn.executemany("INSERT OR REPLACE INTO state (bucket, key, value) VALUES (?, ?, ?)", upserts)
+        if deletes:
+            self._conn.executemany("DELETE FROM state WHERE bucket = ? AND key = ?", deletes)
+        if self.shared:
+            self._conn.executemany("INSERT INTO changes (bucket, key) VALUES (?, ?)", list(dirty))
+            self._writes += len(dirty)
+            if self._writes >= 1000:
+                # Журнал изменений нужен только отстающим процессам — держим хвост
+                self._writes = 0
+                self._conn.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?",
+                                   (self.keep_changes,))
+
+    # --- Миграция старых json-файлов ---
+    def import_json(self, bucket, path):
+        if self._cache.get(bucket) or not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать {path} для миграции: {e}")
+            return 0
+        for key, value in data.items():
+            self.set(bucket, key, value)
+        self.flush()
+        print(f"📦 Перенесено {len(data)} записей из {path} в {self.path}:{bucket}")
+        return len(data)
+
+    # --- Отложенная запись на диск ---
+    def flush(self):
+        # -> True, если всё записанное до вызова уже на диске (для тех, кому нужна надёжная запись).
+        # shared: пишем под self._lock, чтобы _sync не перечитал ключ, запись которого ещё в полёте
+        with self._flush_lock, (self._lock if self.shared else nullcontext()):
+            with self._lock:
+                if not self._dirty:
+                    return True
+                dirty, self._dirty = self._dirty, {}
+            try:
+                with self._db_lock, self._conn, timed("state_io_seconds", "Операции с хранилищами на диске", op="state_flush"):
+                    self._conn.execute("BEGIN IMMEDIATE" if self.shared else "BEGIN")
+                    self._apply(dirty)
+            except Exception as e:
+                print(f"❌ Ошибка записи состояния в {self.path}: {e}")
+                with self._lock:
+                    # Возвращаем несохранённое, если поверх не успели записать новее
+                    for item_key, value in dirty.items():
+                        self._dirty.setdefault(item_key, value)
+                return False
+            return True
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+        self._conn.close()
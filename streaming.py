@@ -0,0 +1,91 @@
+import time
+
+from telebot.apihelper import ApiTelegramException
+
+# === Потоковый ответ: плейсхолдер + редкие edit_message_text по мере прихода токенов ===
+# Правки объединяются (не чаще edit_interval на сообщение), чтобы не упираться
+# в лимиты Telegram; после 4096 символов текст переносится в новое сообщение.
+
+TELEGRAM_MAX_MESSAGE = 4096
+
+
+def _split_point(text, limit):
+    # Режем по последнему переводу строки/пробелу, чтобы не рвать слова
+    cut = text.rfind("\n", 0, limit)
+    if cut < limit // 2:
+        cut = text.rfind(" ", 0, limit)
+    if cut < limit // 2:
+        cut = limit
+    return cut
+
+
+class StreamingReply:
+    def __init__(self, bot, chat_id, placeholder="✍️ Печатаю...", edit_interval=1.0, max_len=TELEGRAM_MAX_MESSAGE):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.placeholder = placeholder
+        self.edit_interval = edit_interval
+        self.max_len = max_len
+        self.text = ""
+        self.message_ids = []
+        self._segment = ""        # текст текущего (последнего) сообщения
+        self._shown = ""          # что реально показано в текущем сообщении
+        self._next_edit_at = 0.0
+
+    def start(self):
+        msg = self.bot.send_message(self.chat_id, self.placeholder)
+        self.message_ids.append(msg.message_id)
+        self._next_edit_at = time.monotonic() + self.edit_interval
+        return self
+
+    def feed(self, delta):
+        if not delta:
+            return
+        self.text += delta
+        self._segment += delta
+        while len(self._segment) > self.max_len:
+            self._rollover()
+        if time.monotonic() >= self._next_edit_at:
+            self._edit(self._segment)
+
+    def finish(self, reply_markup=None):
+        final = self._segment.strip() or "🤷"
+        self._edit(final, reply_markup=reply_markup, force=True)
+
+    def fail(self, error_text):
+        if self.text.strip():
+            self._segment += f"\n\n{error_text}"
+            self._edit(self._segment[:self.max_len], force=True)
+        else:
+            self._edit(error_text, force=True)
+
+    def _rollover(self):
+        cut = _split_point(self._segment, self.max_len)
+        head, tail = self._segment[:cut], self._segment[cut:].lstrip()
+        self._edit(head, force=True)
+        self._segment = tail
+        msg = self.bot.send_message(self.chat_id, tail[:self.max_len] or self.placeholder)
+        self.message_ids.append(msg.message_id)
+        self._shown = tail[:self.max_len]
+        self._next_edit_at = time.monotonic() + self.edit_interval
+
+    def _edit(self, text, reply_markup=None, force=False):
+        if not text or (text == self._shown and reply_markup is None):
+            return
+        while True:
+            try:
+                self.bot.edit_message_text(text, self.chat_id, self.message_ids[-1], reply_markup=reply_markup)
+                self._shown = text
+                break
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                    if force:
+                        time.sleep(retry_after)
+                        continue
+                    self._next_edit_at = time.monotonic() + retry_after
+                    return
+                if "message is not modified" in str(e.description):
+                    break
+                raise
+        self._next_edit_at = time.monotonic() + self.edit_interval
@@ -0,0 +1,120 @@
+import queue
+import threading
+
+from metrics import counter, timed
+from tokens import count_tokens, message_tokens
+
+# === Сворачивание длинных диалогов в сводку ===
+# Когда история чата переваливает за порог токенов (свой для каждой модели) или подходит
+# к max_history (дальше HistoryStore молча отбросил бы старые ходы), самые
+# старые ходы вместе с прежней сводкой отдаются дешёвой модели, а в истории их
+# заменяет одно сообщение-сводка: {"role": "system", "summary": True, "covers": N},
+# где covers — сколько токенов исходных сообщений она заменяет (для учёта экономии).
+# Работает в фоне после ответа пользователю; на один чат — не больше одной задачи.
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+
+def is_summary(message):
+    return bool(message.get("summary"))
+
+
+def history_tokens(history, model="gpt-3.5-turbo"):
+    return sum(message_tokens(m, model) for m in history)
+
+
+def saved_tokens(messages):
+    # Сколько токенов промпта сэкономила сводка (исходные сообщения минус сама сводка)
+    return sum(max(0, m.get("covers", 0) - m.get("tokens", 0)) for m in messages if is_summary(m))
+
+
+class Summarizer:
+    def __init__(self, histories, summarize, thresholds=None, default_threshold=3000, keep_recent=6,
+                 model="gpt-3.5-turbo", workers=1, margin=4):
+        self.histories = histories
+        self.summarize = summarize      # fn(chat_id, прежняя сводка или "", сообщения) -> текст сводки
+        self.thresholds = thresholds or {}  # модель -> порог токенов истории (0 — не сворачивать)
+        self.default_threshold = default_threshold
+        self.keep_recent = keep_recent  # сколько последних сообщений всегда остаются дословно
+        self.margin = margin            # за сколько сообщений до max_history сворачивать (свернуть до обрезки)
+        self.model = model              # модель, которой пишется сводка (для подсчёта токенов)
+        self.folded = 0
+        self.stale = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        for idx in range(workers):
+            threading.Thread(target=self._run, name=f"summarizer-{idx}", daemon=True).start()
+
+    def threshold(self, model):
+        return self.thresholds.get(model, self.default_threshold)
+
+    def maybe_schedule(self, chat_id, model, history):
+        # Вызывается после ответа, history — уже вместе с новым ходом
+        threshold = self.threshold(model)
+        if not threshold or len(history) <= self.keep_recent + 1:
+            return False
+        near_limit = len(history) >= self.histories.max_history - self.margin
+        if not near_limit and history_tokens(history, model) <= threshold:
+            return False
+        chat_id = str(chat_id)
+        with self._lock:
+            if chat_id in self._pending:
+                return False
+            self._pending.add(chat_id)
+        self._queue.put(chat_id)
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"pending": pending, "folded": self.folded, "stale": self.stale, "failed": self.failed}
+
+    def _split(self, history):
+        # Сворачиваем всё, кроме keep_recent последних; граница — на реплике пользователя
+        cut = len(history) - self.keep_recent
+        while cut > 0 and history[cut].get("role") != "user":
+            cut -= 1
+        folded = history[:cut]
+        if not any(not is_summary(m) for m in folded):
+            return None
+        return folded
+
+    def fold(self, chat_id):
+        history = self.histories.load(chat_id)
+        folded = self._split(history)
+        if folded is None:
+            return False
+        previous = folded[0] if is_summary(folded[0]) else None
+        turns = folded[1:] if previous else folded
+        with timed("summary_seconds", "Построение сводки диалога"):
+            text = self.summarize(chat_id, previous["content"][len(SUMMARY_PREFIX):] if previous else "",
+                                  turns).strip()
+        if not text:
+            return False
+        covers = (previous.get("covers", 0) if previous else 0) + history_tokens(turns, self.model)
+        content = SUMMARY_PREFIX + text
+        summary = {"role": "system", "content": content, "tokens": count_tokens(content, self.model),
+                   "summary": True, "covers": covers}
+        if not self.histories.fold(chat_id, folded, summary):
+            self.stale += 1
+            return False
+        self.folded += 1
+        counter("summary_folds_total", "Свёрнутые в сводку части диалогов").inc()
+        return True
+
+    def _run(self):
+        while True:
+            chat_id = self._queue.get()
+            try:
+                self.fold(chat_id)
+            except Exception as e:
+                self.failed += 1
+                print(f"⚠️ Не удалось свернуть историю {chat_id}: {type(e).__name__}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(chat_id)
@@ -0,0 +1,102 @@
+import threading
+import time
+
+try:
+    import tiktoken
+except ImportError:  # без tiktoken считаем грубо (см. estimate_tokens)
+    tiktoken = None
+
+# === Подсчёт токенов и обрезка контекста под бюджет модели ===
+
+# Служебные токены на каждое сообщение и на «затравку» ответа (формат ChatML)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+# Словарь кодировки скачивается при первом использовании (в образе он уже лежит в TIKTOKEN_CACHE_DIR).
+# Не скачался — считаем грубо и пробуем снова не раньше чем через RETRY_AFTER секунд
+RETRY_AFTER = 60
+
+_encodings = {}   # модель -> кодировка (только удачные загрузки)
+_failed_at = {}   # модель -> время последней неудачной загрузки
+_load_lock = threading.Lock()
+
+
+def _load(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _encoding(model):
+    encoding = _encodings.get(model)
+    if encoding is not None or tiktoken is None:
+        return encoding
+    failed_at = _failed_at.get(model)
+    if failed_at is not None and time.monotonic() - failed_at < RETRY_AFTER:
+        return None
+    # Скачивает один поток, остальные пока считают грубо
+    if not _load_lock.acquire(blocking=False):
+        return None
+    try:
+        if model not in _encodings:
+            _encodings[model] = _load(model)
+            _failed_at.pop(model, None)
+        return _encodings[model]
+    except Exception as e:
+        if failed_at is None:
+            print(f"⚠️ tiktoken недоступен для {model}, считаем грубо до повторной попытки: {e}")
+        _failed_at[model] = time.monotonic()
+        return None
+    finally:
+        _load_lock.release()
+
+
+def estimate_tokens(text):
+    # Без кодировки: ~4 символа на токен у латиницы, ~2 у кириллицы и прочего не-ASCII
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return max(1, ascii_chars // 4 + (len(text) - ascii_chars + 1) // 2)
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def message_tokens(message, model="gpt-3.5-turbo"):
+    # Счётчик кешируется прямо в сообщении (поле "tokens" хранится вместе с историей)
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message.get("content", ""), model)
+        message["tokens"] = tokens
+    return tokens + TOKENS_PER_MESSAGE
+
+
+def with_tokens(role, content, model="gpt-3.5-turbo"):
+    return {"role": role, "content": content, "tokens": count_tokens(content, model)}
+
+
+def to_api(messages):
+    # В API уходят только role/content
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+
+def fit_history(history, budget, model="gpt-3.5-turbo"):
+    # Берём самые свежие сообщения, пока влезают в бюджет
+    kept = []
+    used = 0
+    for message in reversed(history):
+        cost = message_tokens(message, model)
+        if used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+    return kept, used
+
+
+def prompt_tokens(messages, model="gpt-3.5-turbo"):
+    return sum(message_tokens(m, model) for m in messages) + TOKENS_PER_REPLY
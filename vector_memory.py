@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+
+from cache import TTLCache
+from metrics import counter, timed
+
+# === Долгая память пользователя: векторный индекс на диске ===
+# memory/vectors/<провайдер>/<chat_id>.f32   — матрица float32 (строка = один ход), только дозапись;
+# memory/vectors/<провайдер>/<chat_id>.jsonl — тексты тех же ходов в том же порядке.
+# Поиск читает матрицу через np.memmap (в память не грузится целиком), косинус = скалярное
+# произведение нормированных векторов. Новые ходы копятся в очереди и эмбеддятся пачкой
+# в фоновом потоке. Провайдер эмбеддингов подключаемый: OpenAIEmbedder — через API (рабочий),
+# HashingEmbedder — локальный и детерминированный, без сети: совпадение слов, а не смысла,
+# годится для тестов и офлайн-прогонов. numpy импортируется при первом эмбеддинге/поиске.
+# shared=True — каталог пишут несколько процессов: дозапись текста и вектора идёт под flock.
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    # Хеширование слов, их начал (грубая замена стемминга: «собака»/«собаку») и биграмм
+    # в фиксированное число измерений со знаком; короткие служебные слова пропускаются
+    def __init__(self, dim=1024, stem=5, min_word=4):
+        self.dim = dim
+        self.stem = stem
+        self.min_word = min_word
+        self.name = f"hash{dim}"
+
+    def _features(self, text):
+        words = [w for w in WORD_RE.findall(text.lower().replace("ё", "е")) if len(w) >= self.min_word]
+        stems = [w[:self.stem] + "~" for w in words if len(w) > self.stem]
+        return words + stems + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts, urgent=False):
+        import numpy as np
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                vectors[row, value % self.dim] += 1.0 if value >> 63 else -1.0
+        return _normalize(vectors)
+
+
+class OpenAIEmbedder:
+    def __init__(self, model="text-embedding-3-small", dim=1536, run=None):
+        self.model = model
+        self.dim = dim
+        self.name = model
+        self.run = run or (lambda fn, urgent: fn())  # обёртка вызова (планировщик llm)
+
+    def embed(self, texts, urgent=False):
+        # urgent — эмбеддинг запроса, его ждёт ответ пользователю (фоновые пачки — нет)
+        import numpy as np
+        import openai
+        response = self.run(lambda: openai.Embedding.create(model=self.model, input=list(texts)), urgent)
+        data = sorted(response["data"], key=lambda item: item["index"])
+        return _normalize(np.array([item["embedding"] for item in data], dtype=np.float32))
+
+
+def _normalize(vectors):
+    import numpy as np
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorMemory:
+    def __init__(self, directory, embedder, batch_size=32, batch_wait=1.0, min_score=0.2, max_chars=1500,
+                 texts_cache_size=1000, shared=False):
+        self.embedder = embedder
+        self.directory = os.path.join(directory, embedder.name)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait    # сколько ждать, пока наберётся пачка
+        self.min_score = min_score
+        self.max_chars = max_chars
+        self.added = 0
+        self.failed = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._texts = TTLCache(maxsize=texts_cache_size, ttl=3600)  # chat_id -> (прочитано байт, тексты)
+        self._fcntl = None
+        if shared:
+            import fcntl
+            self._fcntl = fcntl
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._run, name="vector-memory", daemon=True).start()
+
+    def _paths(self, chat_id):
+        base = os.path.join(self.directory, str(chat_id))
+        return base + ".f32", base + ".jsonl"
+
+    # --- Запись ---
+    def add(self, chat_id, text, key=None):
+        # Неблокирующе: эмбеддинг и запись — в фоне, пачкой с другими чатами.
+        # key — по чему искать (по умолчанию сам text), сохраняется и возвращается text
+        text = text.strip()[:self.max_chars]
+        if text:
+            self._queue.put((str(chat_id), text, (key or text)[:self.max_chars]))
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=self.batch_wait))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                with timed("memory_embed_seconds", "Эмбеддинг пачки ходов для долгой памяти"):
+                    vectors = self.embedder.embed([key for _, _, key in batch])
+                for (chat_id, text, _), vector in zip(batch, vectors):
+                    self._append(chat_id, vector, text)
+                self.added += len(batch)
+                counter("memory_snippets_total", "Ходы, добавленные в долгую память").inc(len(batch))
+            except Exception as e:
+                self.failed += len(batch)
+                print(f"⚠️ Долгая память: не удалось сохранить {len(batch)} ходов: {type(e).__name__}: {e}")
+
+    def _append(self, chat_id, vector, text):
+        import numpy as np
+        vectors_path, texts_path = self._paths(chat_id)
+        with self._lock, open(texts_path, "a", encoding="utf-8") as texts_file:
+            if self._fcntl:
+                self._fcntl.flock(texts_file, self._fcntl.LOCK_EX)
+            # Сначала текст, потом вектор: строк без текста при чтении не бывает
+            texts_file.write(json.dumps(text, ensure_ascii=False) + "\n")
+            texts_file.flush()
+            with open(vectors_path, "ab") as f:
+                f.write(np.asarray(vector, dtype=np.float32).tobytes())
+
+    # --- Поиск ---
+    def _load_texts(self, chat_id, path):
+        # Тексты кешируются и дочитываются с места, где остановились (файл только растёт)
+        offset, texts = self._texts.get(chat_id, (0, []))
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return []
+        if size < offset:
+            offset, texts = 0, []
+        if size > offset:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read(size - offset)
+            complete = data.rfind(b"\n") + 1  # недописанную строку дочитаем в следующий раз
+            texts = texts + [json.loads(line) for line in data[:complete].decode("utf-8").splitlines() if line]
+            self._texts.set(chat_id, (offset + complete, texts))
+        return texts
+
+    @timed("memory_search_seconds", "Поиск по долгой памяти")
+    def search(self, chat_id, query, k=3, skip_recent=0):
+        # -> [(score, текст)] по убыванию похожести; последние skip_recent ходов уже есть в промпте
+        import numpy as np
+        chat_id = str(chat_id)
+        vectors_path, texts_path = self._paths(chat_id)
+        with self._lock:
+            texts = self._load_texts(chat_id, texts_path)
+            try:
+                rows = os.path.getsize(vectors_path) // (4 * self.embedder.dim)
+            except FileNotFoundError:
+                return []
+        rows = min(rows, len(texts)) - skip_recent
+        if rows <= 0 or not query.strip():
+            return []
+        matrix = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, self.embedder.dim))
+        scores = matrix @ self.embedder.embed([query], urgent=True)[0]
+        top = min(k, rows)
+        best = np.argpartition(-scores, top - 1)[:top]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), texts[i]) for i in best if scores[i] >= self.min_score]
+
+    def stats(self):
+        return {"provider": self.embedder.name, "queued": self.depth(), "added": self.added, "failed": self.failed}
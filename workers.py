@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+import zlib
+from collections import deque
+from contextlib import contextmanager
+
+# === Пул воркеров с порядком внутри чата ===
+# У каждого ключа (chat_id) своя очередь; общий набор потоков берёт следующий готовый чат.
+# Пока элемент чата обрабатывается, чат «в работе» и другим потокам не выдаётся,
+# поэтому апдейты одного чата идут строго по порядку, а разные чаты — параллельно:
+# долгий OCR или запрос к модели занимает один поток, а не всех, кто с ним в одной очереди.
+# Готовые чаты обслуживаются по кругу (после элемента чат встаёт в конец).
+# delay(key) -> сколько чату подождать перед следующим элементом (лимиты частоты):
+# такой чат откладывается по времени готовности, и поток тут же берёт другой — не спит.
+# Общий размер очередей ограничен: при переполнении submit() возвращает False,
+# и вызывающий сам решает, что делать (backpressure).
+
+
+class ChatWorkerPool:
+    def __init__(self, handler, workers=8, queue_size=1000, name="worker", delay=None):
+        self.handler = handler
+        self.delay = delay
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self._chats = {}        # ключ -> deque элементов; ключ здесь, пока чат ждёт или в работе
+        self._ready = deque()   # чаты, которые можно брать в работу
+        self._deferred = []     # куча (время готовности, seq, ключ) — чаты, ждущие своей очереди
+        self._reserved = set()  # отложенные чаты, которым delay() уже выделил очередь
+        self._seq = itertools.count()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._threads = []
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{name}-{idx}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, item, timeout=0):
+        with self._lock:
+            if self._size >= self.queue_size and timeout:
+                self._not_full.wait_for(lambda: self._size < self.queue_size, timeout)
+            if self._size >= self.queue_size:
+                self.rejected += 1
+                return False
+            items = self._chats.get(key)
+            if items is None:
+                items = self._chats[key] = deque()
+                self._ready.append(key)
+                self._has_work.notify()
+            items.append(item)
+            self._size += 1
+            return True
+
+    def requeue(self, key, item):
+        # Из handler'а: вернуть элемент в начало очереди своего чата (повтор после паузы)
+        with self._lock:
+            self._chats[key].appendleft(item)
+            self._size += 1
+
+    def depth(self):
+        with self._lock:
+            return self._size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "depth": self._size,
+                "chats": len(self._chats),
+                "deferred": len(self._deferred),
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+            }
+
+    def _next_key(self):
+        # Под self._lock: следующий готовый чат (отложенные — когда наступит их время)
+        while True:
+            now = time.monotonic()
+            while self._deferred and self._deferred[0][0] <= now:
+                _, _, key = heapq.heappop(self._deferred)
+                self._ready.append(key)
+            if self._ready:
+                return self._ready.popleft()
+            self._has_work.wait(self._deferred[0][0] - now if self._deferred else None)
+
+    def _take(self):
+        # -> (ключ, элемент); чат, которому надо подождать, откладывается, а поток берёт следующий
+        while True:
+            with self._lock:
+                key = self._next_key()
+                reserved = key in self._reserved
+                self._reserved.discard(key)
+            wait = self.delay(key) if self.delay and not reserved else 0
+            with self._lock:
+                if wait > 0:
+                    heapq.heappush(self._deferred, (time.monotonic() + wait, next(self._seq), key))
+                    self._reserved.add(key)
+                    self._has_work.notify()  # ждущий поток пересчитает, когда просыпаться
+                    continue
+                self._size -= 1
+                self._not_full.notify()
+                return key, self._chats[key].popleft()
+
+    def _done(self, key, ok):
+        # Под self._lock: чат освободился — в конец очереди готовых или из пула, если пуст
+        if ok:
+            self.processed += 1
+        else:
+            self.failed += 1
+        if self._chats[key]:
+            self._ready.append(key)
+            self._has_work.notify()
+        else:
+            del self._chats[key]
+
+    def _run(self):
+        while True:
+            key, item = self._take()
+            try:
+                self.handler(item)
+                ok = True
+            except Exception:
+                traceback.print_exc()
+                ok = False
+            with self._lock:
+                self._done(key, ok)
+
+
+class ChatFileLocks:
+    # Межпроцессная блокировка чата (несколько процессов gunicorn): flock на одном из stripes
+    # файлов каталога. Апдейты одного чата из разных процессов не выполняются одновременно;
+    # файл открывается на каждый захват — flock на общем дескрипторе потоки бы не разделял.
+    def __init__(self, directory, stripes=1024):
+        import fcntl
+        self._fcntl = fcntl
+        self.directory = directory
+        self.stripes = stripes
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def hold(self, key):
+        path = os.path.join(self.directory, f"{zlib.crc32(str(key).encode()) % self.stripes}.lock")
+        with open(path, "a") as f:
+            self._fcntl.flock(f, self._fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                self._fcntl.flock(f, self._fcntl.LOCK_UN)